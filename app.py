@@ -2,16 +2,62 @@
 import os
 import uuid
 import json
+import base64
+import hashlib
+import gzip
+import mimetypes
+import bisect
+import heapq
 import sqlite3
+import queue
+import atexit
+import threading
+import time
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from array import array
+from collections import Counter, OrderedDict
 from datetime import datetime, timedelta
-from functools import wraps
-from werkzeug.security import generate_password_hash, check_password_hash
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, send_from_directory
+from functools import partial, wraps
+import click
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, send_from_directory, g, abort
 import re
 
+try:
+    import psycopg2
+    import psycopg2.extras
+except ImportError:  # PostgreSQL support is optional
+    psycopg2 = None
+
+try:
+    import redis
+except ImportError:  # only needed for cross-worker events and the shared object cache
+    redis = None
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # without Pillow, images are served without variants
+    Image = None
+
+try:
+    import fcntl
+except ImportError:  # write-behind likes need POSIX file locks
+    fcntl = None
+
+try:
+    import brotli
+except ImportError:  # compress-static then writes gzip copies only
+    brotli = None
+
 app = Flask(__name__)
 app.config.from_pyfile('config.py')
-app.config['DATABASE'] = os.path.join(app.instance_path, 'sociafam.db')
+# DATABASE is either a PostgreSQL URL or an SQLite file (plain paths are
+# relative to the instance folder)
+if '://' not in app.config['DATABASE']:
+    app.config['DATABASE'] = os.path.join(app.instance_path, app.config['DATABASE'])
 app.config['UPLOAD_FOLDER'] = os.path.join('static', 'uploads')
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
@@ -22,28 +68,231 @@ os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'profiles'), exist_ok=True
 os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'posts'), exist_ok=True)
 os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'reels'), exist_ok=True)
 os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'stories'), exist_ok=True)
+os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'messages'), exist_ok=True)
 
-# Database initialization
-def init_db():
-    with app.app_context():
-        db = get_db()
-        with app.open_resource('schema.sql', mode='r') as f:
-            db.cursor().executescript(f.read())
-        db.commit()
+def database_dialect():
+    return 'postgresql' if app.config['DATABASE'].startswith(('postgres://', 'postgresql://')) else 'sqlite'
+
+def sqlite_path():
+    return app.config['DATABASE'].replace('sqlite:///', '', 1)
+
+def translate_placeholders(sql):
+    """Rewrite qmark placeholders as psycopg2's %s, leaving string literals alone."""
+    out = []
+    in_string = False
+    for char in sql:
+        if char == "'":
+            in_string = not in_string
+        if char == '%':
+            out.append('%%')
+        elif char == '?' and not in_string:
+            out.append('%s')
+        else:
+            out.append(char)
+    return ''.join(out)
+
+def translate_schema(script):
+    """Adapt the SQLite DDL in schema_sql and MIGRATIONS for PostgreSQL.
+    
+    Foreign keys are dropped because SQLite never enforced them here and
+    messages references groups before the groups table exists.
+    """
+    script = script.replace('INTEGER PRIMARY KEY AUTOINCREMENT', 'SERIAL PRIMARY KEY')
+    return re.sub(r',(\s*--[^\n]*)?\s*FOREIGN KEY \(\w+\) REFERENCES \w+ \(\w+\)', r'\1', script)
+
+class CommitHooks:
+    """Work queued with after_commit runs once the current transaction commits.
+    
+    Callbacks queued in a transaction that rolls back or fails to commit are
+    dropped, so they suit side effects that must not outlive the data, like
+    deleting files or evicting cached rows.
+    """
+    
+    def after_commit(self, callback, *args):
+        self._after_commit.append((callback, args))
+    
+    def _run_after_commit(self):
+        callbacks, self._after_commit = self._after_commit, []
+        for callback, args in callbacks:
+            try:
+                callback(*args)
+            except Exception:
+                app.logger.exception('After-commit callback %s failed', getattr(callback, '__name__', callback))
+
+class SQLiteConnection(CommitHooks, sqlite3.Connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._after_commit = []
+    
+    def commit(self):
+        try:
+            super().commit()
+        except Exception:
+            self._after_commit.clear()
+            raise
+        self._run_after_commit()
+    
+    def rollback(self):
+        self._after_commit.clear()
+        super().rollback()
+
+class PostgresConnection(CommitHooks):
+    """Gives a psycopg2 connection the sqlite3.Connection interface app.py uses."""
+    
+    def __init__(self, conn):
+        self._conn = conn
+        self._after_commit = []
+    
+    def _cursor(self):
+        return self._conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    
+    def execute(self, sql, params=()):
+        cursor = self._cursor()
+        cursor.execute(translate_placeholders(sql), tuple(params))
+        return cursor
+    
+    def executemany(self, sql, seq_of_params):
+        cursor = self._cursor()
+        cursor.executemany(translate_placeholders(sql), [tuple(params) for params in seq_of_params])
+        return cursor
+    
+    def executescript(self, script):
+        # Like sqlite3, commit first and let the script manage its own transactions
+        self._conn.commit()
+        self._conn.autocommit = True
+        try:
+            self._cursor().execute(translate_schema(script))
+        finally:
+            self._conn.autocommit = False
+    
+    @property
+    def in_transaction(self):
+        return self._conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    
+    def commit(self):
+        try:
+            self._conn.commit()
+        except Exception:
+            self._after_commit.clear()
+            raise
+        self._run_after_commit()
+    
+    def rollback(self):
+        self._after_commit.clear()
+        self._conn.rollback()
+    
+    def close(self):
+        self._conn.close()
+
+def connect_db():
+    if database_dialect() == 'postgresql':
+        if psycopg2 is None:
+            raise RuntimeError('A PostgreSQL DATABASE requires the psycopg2 package')
+        return PostgresConnection(psycopg2.connect(app.config['DATABASE']))
+    
+    # Pooled connections move between threads, one request at a time
+    db = sqlite3.connect(
+        sqlite_path(),
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        timeout=app.config['SQLITE_BUSY_TIMEOUT_MS'] / 1000,
+        cached_statements=app.config['SQLITE_CACHED_STATEMENTS'],
+        check_same_thread=False,
+        factory=SQLiteConnection
+    )
+    db.row_factory = sqlite3.Row
+    
+    # WAL lets readers proceed while a writer holds the lock; NORMAL sync is
+    # durable across application crashes in WAL mode
+    db.execute(f"PRAGMA journal_mode = {app.config['SQLITE_JOURNAL_MODE']}")
+    db.execute(f"PRAGMA synchronous = {app.config['SQLITE_SYNCHRONOUS']}")
+    db.execute(f"PRAGMA busy_timeout = {int(app.config['SQLITE_BUSY_TIMEOUT_MS'])}")
+    db.execute(f"PRAGMA mmap_size = {int(app.config['SQLITE_MMAP_SIZE'])}")
+    db.execute(f"PRAGMA cache_size = {-int(app.config['SQLITE_CACHE_SIZE_KB'])}")
+    db.execute(f"PRAGMA temp_store = {app.config['SQLITE_TEMP_STORE']}")
+    return db
+
+class ConnectionPool:
+    """Bounded pool of open connections shared by the threads of one worker.
+    
+    Each connection handed out is tagged with its pool, so a connection
+    borrowed before the pool was replaced goes back to (and frees a slot
+    in) the pool it came from, which then closes it.
+    """
+    
+    def __init__(self, connect, size, timeout):
+        self._connect = connect
+        self._timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._closed = False
+    
+    def acquire(self):
+        if not self._slots.acquire(timeout=self._timeout):
+            raise RuntimeError('Timed out waiting for a database connection')
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            db = self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+        db.pool = self
+        return db
+    
+    def release(self, db):
+        if db.pool is not self:
+            raise ValueError('Connection released to a pool it was not acquired from')
+        try:
+            if self._closed:
+                db.close()
+                return
+            # Never hand an unfinished transaction to the next borrower
+            if db.in_transaction:
+                db.rollback()
+            self._idle.put(db)
+            if self._closed:
+                self.close()
+        except Exception:
+            db.close()
+        finally:
+            self._slots.release()
+    
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+_pool = None
+_pool_key = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Return this process's pool, rebuilding it after a fork or config change."""
+    global _pool, _pool_key
+    key = (os.getpid(), app.config['DATABASE'])
+    with _pool_lock:
+        if _pool_key != key:
+            if _pool is not None and _pool_key[0] == key[0]:
+                _pool.close()
+            _pool = ConnectionPool(connect_db, app.config['DB_POOL_SIZE'], app.config['DB_POOL_TIMEOUT'])
+            _pool_key = key
+        return _pool
 
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(
-            app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = sqlite3.Row
+        g.db = get_pool().acquire()
     return g.db
 
 @app.teardown_appcontext
 def close_db(error):
-    if hasattr(g, 'db'):
-        g.db.close()
+    db = g.pop('db', None)
+    if db is not None:
+        db.pool.release(db)
 
 # Database schema (will be executed on first run)
 schema_sql = """
@@ -274,15 +523,423 @@ CREATE TABLE IF NOT EXISTS settings (
 );
 """
 
-# Write schema to file
-with open(os.path.join(app.root_path, 'schema.sql'), 'w') as f:
-    f.write(schema_sql)
+# Rebuilds the denormalized engagement counters on posts and reels from the
+# base tables. Used by migration 2 and the rebuild-counters command.
+COUNTER_REBUILD_SQL = """
+UPDATE posts SET
+    likes_count = (SELECT COUNT(*) FROM likes WHERE post_id = posts.id),
+    comments_count = (SELECT COUNT(*) FROM comments WHERE post_id = posts.id),
+    reposts_count = (SELECT COUNT(*) FROM reposts WHERE original_post_id = posts.id),
+    saves_count = (SELECT COUNT(*) FROM saved_items WHERE post_id = posts.id);
+UPDATE reels SET
+    likes_count = (SELECT COUNT(*) FROM likes WHERE reel_id = reels.id),
+    comments_count = (SELECT COUNT(*) FROM comments WHERE reel_id = reels.id),
+    reposts_count = (SELECT COUNT(*) FROM reposts WHERE original_reel_id = reels.id),
+    saves_count = (SELECT COUNT(*) FROM saved_items WHERE reel_id = reels.id);
+"""
+
+# Rebuilds the per-user and direct conversation unread counters and the group
+# message summaries from the notifications and messages tables. Used by
+# rebuild-counters.
+UNREAD_REBUILD_SQL = """
+UPDATE conversations SET unread_count = (
+    SELECT COUNT(*) FROM messages
+    WHERE receiver_id = conversations.user_id AND sender_id = conversations.peer_id AND is_read = FALSE
+) WHERE peer_id IS NOT NULL;
+UPDATE users SET
+    unread_notifications = (SELECT COUNT(*) FROM notifications WHERE user_id = users.id AND is_read = FALSE),
+    unread_messages = (SELECT COUNT(*) FROM messages WHERE receiver_id = users.id AND is_read = FALSE);
+UPDATE groups SET
+    message_count = (SELECT COUNT(*) FROM messages WHERE group_id = groups.id),
+    last_message_id = (SELECT MAX(id) FROM messages WHERE group_id = groups.id);
+UPDATE groups SET
+    last_message_at = (SELECT created_at FROM messages WHERE id = groups.last_message_id),
+    last_message_preview = (SELECT substr(content, 1, 100) FROM messages WHERE id = groups.last_message_id);
+UPDATE conversations SET read_count = (SELECT message_count FROM groups WHERE id = conversations.group_id)
+WHERE group_id IS NOT NULL AND read_count > (SELECT message_count FROM groups WHERE id = conversations.group_id);
+"""
+
+# Rebuilds user_stats from the base tables and the engagement counters.
+# Used by migration 10 and the rebuild-counters command.
+USER_STATS_REBUILD_SQL = """
+DELETE FROM user_stats;
+INSERT INTO user_stats (user_id, followers_count, following_count, friends_count, posts_count, likes_count)
+    SELECT u.id,
+        (SELECT COUNT(*) FROM followers WHERE followed_id = u.id AND status = 'accepted'),
+        (SELECT COUNT(*) FROM followers WHERE follower_id = u.id AND status = 'accepted'),
+        (SELECT COUNT(*) FROM friends WHERE user1_id = u.id) + (SELECT COUNT(*) FROM friends WHERE user2_id = u.id),
+        (SELECT COUNT(*) FROM posts WHERE user_id = u.id),
+        (SELECT COALESCE(SUM(likes_count), 0) FROM posts WHERE user_id = u.id) +
+        (SELECT COALESCE(SUM(likes_count), 0) FROM reels WHERE user_id = u.id)
+    FROM users u;
+"""
+
+# Schema migrations, applied in order on top of schema_sql by init_db().
+# Each entry is (version, name, sql); applied versions are recorded in
+# schema_migrations so every migration runs exactly once per database.
+# sql may be a {dialect: sql} dict for backend-specific features, in which
+# case dialects without an entry just record the version.
+MIGRATIONS = [
+    (1, 'hot query indexes', """
+CREATE INDEX IF NOT EXISTS idx_followers_follower ON followers (follower_id, status, followed_id);
+CREATE INDEX IF NOT EXISTS idx_followers_followed ON followers (followed_id, status, follower_id);
+CREATE INDEX IF NOT EXISTS idx_friends_user2 ON friends (user2_id, user1_id);
+CREATE INDEX IF NOT EXISTS idx_posts_user ON posts (user_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_reels_created ON reels (created_at);
+CREATE INDEX IF NOT EXISTS idx_reels_user ON reels (user_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_stories_user ON stories (user_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_likes_post ON likes (post_id, user_id);
+CREATE INDEX IF NOT EXISTS idx_likes_reel ON likes (reel_id, user_id);
+CREATE INDEX IF NOT EXISTS idx_comments_post ON comments (post_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_comments_reel ON comments (reel_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_saved_items_post ON saved_items (post_id, user_id);
+CREATE INDEX IF NOT EXISTS idx_saved_items_reel ON saved_items (reel_id, user_id);
+CREATE INDEX IF NOT EXISTS idx_reposts_post ON reposts (original_post_id, user_id);
+CREATE INDEX IF NOT EXISTS idx_messages_pair ON messages (sender_id, receiver_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_messages_receiver ON messages (receiver_id, is_read, sender_id);
+CREATE INDEX IF NOT EXISTS idx_messages_group ON messages (group_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_notifications_user ON notifications (user_id, is_read, created_at);
+CREATE INDEX IF NOT EXISTS idx_group_members_user ON group_members (user_id, group_id);
+CREATE INDEX IF NOT EXISTS idx_reports_status ON reports (status, created_at);
+"""),
+    (2, 'engagement counters', """
+ALTER TABLE posts ADD COLUMN likes_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE posts ADD COLUMN comments_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE posts ADD COLUMN reposts_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE posts ADD COLUMN saves_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE reels ADD COLUMN likes_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE reels ADD COLUMN comments_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE reels ADD COLUMN reposts_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE reels ADD COLUMN saves_count INTEGER NOT NULL DEFAULT 0;
+CREATE INDEX IF NOT EXISTS idx_reposts_reel ON reposts (original_reel_id, user_id);
+""" + COUNTER_REBUILD_SQL),
+    (3, 'notification listing index', """
+CREATE INDEX IF NOT EXISTS idx_notifications_user_created ON notifications (user_id, created_at);
+"""),
+    (4, 'home timeline', """
+CREATE TABLE IF NOT EXISTS timeline (
+    user_id INTEGER NOT NULL, -- timeline owner
+    post_id INTEGER NOT NULL,
+    actor_id INTEGER NOT NULL, -- author or reposter that put the post here
+    created_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (user_id, post_id),
+    FOREIGN KEY (user_id) REFERENCES users (id),
+    FOREIGN KEY (post_id) REFERENCES posts (id)
+);
+CREATE INDEX IF NOT EXISTS idx_timeline_user_created ON timeline (user_id, created_at, post_id);
+CREATE INDEX IF NOT EXISTS idx_timeline_post ON timeline (post_id);
+ALTER TABLE posts ADD COLUMN fanned_out BOOLEAN NOT NULL DEFAULT TRUE;
+CREATE INDEX IF NOT EXISTS idx_posts_user_pull ON posts (user_id, created_at) WHERE fanned_out = FALSE;
+INSERT INTO timeline (user_id, post_id, actor_id, created_at)
+    SELECT user_id, id, user_id, created_at FROM posts WHERE TRUE
+    ON CONFLICT DO NOTHING;
+INSERT INTO timeline (user_id, post_id, actor_id, created_at)
+    SELECT f.follower_id, p.id, p.user_id, p.created_at
+    FROM followers f JOIN posts p ON p.user_id = f.followed_id
+    WHERE f.status = 'accepted'
+    ON CONFLICT DO NOTHING;
+INSERT INTO timeline (user_id, post_id, actor_id, created_at)
+    SELECT f.follower_id, r.original_post_id, r.user_id, r.created_at
+    FROM followers f JOIN reposts r ON r.user_id = f.followed_id
+    WHERE f.status = 'accepted' AND r.original_post_id IS NOT NULL
+    ON CONFLICT DO NOTHING;
+"""),
+    (5, 'notification coalescing', """
+ALTER TABLE notifications ADD COLUMN target_type TEXT;
+ALTER TABLE notifications ADD COLUMN target_id INTEGER;
+ALTER TABLE notifications ADD COLUMN actor_count INTEGER NOT NULL DEFAULT 1;
+ALTER TABLE notifications ADD COLUMN group_key TEXT;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_notifications_unread_group ON notifications (user_id, group_key) WHERE is_read = FALSE;
+"""),
+    (6, 'unread counters', """
+ALTER TABLE users ADD COLUMN unread_notifications INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE users ADD COLUMN unread_messages INTEGER NOT NULL DEFAULT 0;
+CREATE TABLE IF NOT EXISTS conversation_unread (
+    user_id INTEGER NOT NULL,
+    peer_id INTEGER NOT NULL,
+    unread_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, peer_id)
+);
+INSERT INTO conversation_unread (user_id, peer_id, unread_count)
+    SELECT receiver_id, sender_id, COUNT(*) FROM messages
+    WHERE receiver_id IS NOT NULL AND is_read = FALSE
+    GROUP BY receiver_id, sender_id;
+UPDATE users SET
+    unread_notifications = (SELECT COUNT(*) FROM notifications WHERE user_id = users.id AND is_read = FALSE),
+    unread_messages = (SELECT COUNT(*) FROM messages WHERE receiver_id = users.id AND is_read = FALSE);
+"""),
+    (7, 'conversation summaries', """
+CREATE TABLE IF NOT EXISTS conversations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL, -- inbox owner
+    peer_id INTEGER, -- other participant of a direct conversation
+    group_id INTEGER, -- group of a group conversation
+    last_message_id INTEGER,
+    last_message_at TIMESTAMP,
+    last_message_preview TEXT,
+    unread_count INTEGER NOT NULL DEFAULT 0,
+    FOREIGN KEY (user_id) REFERENCES users (id),
+    FOREIGN KEY (peer_id) REFERENCES users (id),
+    FOREIGN KEY (group_id) REFERENCES groups (id)
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_conversations_peer ON conversations (user_id, peer_id) WHERE peer_id IS NOT NULL;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_conversations_group ON conversations (user_id, group_id) WHERE group_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_conversations_inbox ON conversations (user_id, last_message_at);
+CREATE INDEX IF NOT EXISTS idx_conversations_group_id ON conversations (group_id);
+INSERT INTO conversations (user_id, peer_id, last_message_id)
+    SELECT owner_id, peer_id, MAX(id) FROM (
+        SELECT sender_id AS owner_id, receiver_id AS peer_id, id FROM messages WHERE receiver_id IS NOT NULL
+        UNION ALL
+        SELECT receiver_id, sender_id, id FROM messages WHERE receiver_id IS NOT NULL
+    ) AS pairs
+    GROUP BY owner_id, peer_id;
+INSERT INTO conversations (user_id, group_id, last_message_id)
+    SELECT user_id, group_id, (SELECT MAX(id) FROM messages WHERE messages.group_id = group_members.group_id)
+    FROM group_members;
+UPDATE conversations SET
+    last_message_at = (SELECT created_at FROM messages WHERE id = conversations.last_message_id),
+    last_message_preview = (SELECT substr(content, 1, 100) FROM messages WHERE id = conversations.last_message_id);
+UPDATE conversations SET unread_count = COALESCE((
+    SELECT unread_count FROM conversation_unread cu
+    WHERE cu.user_id = conversations.user_id AND cu.peer_id = conversations.peer_id
+), 0) WHERE peer_id IS NOT NULL;
+DROP TABLE conversation_unread;
+"""),
+    (8, 'full-text search', {'sqlite': """
+CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+    username, real_name, content='users', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+);
+CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN
+    INSERT INTO users_fts (rowid, username, real_name) VALUES (new.id, new.username, new.real_name);
+END;
+CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN
+    INSERT INTO users_fts (users_fts, rowid, username, real_name) VALUES ('delete', old.id, old.username, old.real_name);
+END;
+CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF username, real_name ON users BEGIN
+    INSERT INTO users_fts (users_fts, rowid, username, real_name) VALUES ('delete', old.id, old.username, old.real_name);
+    INSERT INTO users_fts (rowid, username, real_name) VALUES (new.id, new.username, new.real_name);
+END;
+INSERT INTO users_fts (users_fts) VALUES ('rebuild');
+
+CREATE VIRTUAL TABLE IF NOT EXISTS groups_fts USING fts5(
+    name, description, content='groups', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+);
+CREATE TRIGGER IF NOT EXISTS groups_fts_insert AFTER INSERT ON groups BEGIN
+    INSERT INTO groups_fts (rowid, name, description) VALUES (new.id, new.name, new.description);
+END;
+CREATE TRIGGER IF NOT EXISTS groups_fts_delete AFTER DELETE ON groups BEGIN
+    INSERT INTO groups_fts (groups_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+END;
+CREATE TRIGGER IF NOT EXISTS groups_fts_update AFTER UPDATE OF name, description ON groups BEGIN
+    INSERT INTO groups_fts (groups_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+    INSERT INTO groups_fts (rowid, name, description) VALUES (new.id, new.name, new.description);
+END;
+INSERT INTO groups_fts (groups_fts) VALUES ('rebuild');
+
+CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(
+    description, content='posts', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+);
+CREATE TRIGGER IF NOT EXISTS posts_fts_insert AFTER INSERT ON posts BEGIN
+    INSERT INTO posts_fts (rowid, description) VALUES (new.id, new.description);
+END;
+CREATE TRIGGER IF NOT EXISTS posts_fts_delete AFTER DELETE ON posts BEGIN
+    INSERT INTO posts_fts (posts_fts, rowid, description) VALUES ('delete', old.id, old.description);
+END;
+CREATE TRIGGER IF NOT EXISTS posts_fts_update AFTER UPDATE OF description ON posts BEGIN
+    INSERT INTO posts_fts (posts_fts, rowid, description) VALUES ('delete', old.id, old.description);
+    INSERT INTO posts_fts (rowid, description) VALUES (new.id, new.description);
+END;
+INSERT INTO posts_fts (posts_fts) VALUES ('rebuild');
+"""}),
+    (9, 'friend suggestions', """
+CREATE TABLE IF NOT EXISTS friend_suggestions (
+    user_id INTEGER NOT NULL,
+    suggested_id INTEGER NOT NULL,
+    score REAL NOT NULL,
+    mutual_count INTEGER NOT NULL DEFAULT 0,
+    computed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, suggested_id),
+    FOREIGN KEY (user_id) REFERENCES users (id),
+    FOREIGN KEY (suggested_id) REFERENCES users (id)
+);
+CREATE INDEX IF NOT EXISTS idx_friend_suggestions_rank ON friend_suggestions (user_id, score);
+CREATE TABLE IF NOT EXISTS friend_suggestion_queue (
+    user_id INTEGER PRIMARY KEY, -- users whose stored suggestions are out of date
+    queued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users (id)
+);
+CREATE INDEX IF NOT EXISTS idx_users_location ON users (location);
+CREATE INDEX IF NOT EXISTS idx_users_university ON users (university);
+CREATE INDEX IF NOT EXISTS idx_users_secondary_school ON users (secondary_school);
+INSERT INTO friend_suggestion_queue (user_id) SELECT id FROM users;
+"""),
+    (10, 'user stats', """
+CREATE TABLE IF NOT EXISTS user_stats (
+    user_id INTEGER PRIMARY KEY,
+    followers_count INTEGER NOT NULL DEFAULT 0,
+    following_count INTEGER NOT NULL DEFAULT 0,
+    friends_count INTEGER NOT NULL DEFAULT 0,
+    posts_count INTEGER NOT NULL DEFAULT 0,
+    likes_count INTEGER NOT NULL DEFAULT 0, -- likes received on the user's posts and reels
+    FOREIGN KEY (user_id) REFERENCES users (id)
+);
+""" + USER_STATS_REBUILD_SQL),
+    (11, 'media variants', """
+CREATE TABLE IF NOT EXISTS media_variants (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    media_path TEXT NOT NULL, -- original upload, relative to UPLOAD_FOLDER
+    variant TEXT NOT NULL, -- 'thumb', 'display', 'poster'
+    variant_path TEXT NOT NULL, -- relative to UPLOAD_FOLDER
+    width INTEGER,
+    height INTEGER,
+    size_bytes INTEGER,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE(media_path, variant)
+);
+"""),
+    (12, 'upload sessions', """
+CREATE TABLE IF NOT EXISTS upload_sessions (
+    id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    kind TEXT NOT NULL, -- 'reel' or 'story'
+    filename TEXT NOT NULL, -- client's file name
+    total_size INTEGER NOT NULL,
+    received_bytes INTEGER NOT NULL DEFAULT 0,
+    sha256 TEXT, -- expected checksum, if given at init
+    description TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users (id)
+);
+CREATE INDEX IF NOT EXISTS idx_upload_sessions_updated ON upload_sessions (updated_at);
+"""),
+    (13, 'media store', """
+CREATE TABLE IF NOT EXISTS media_blobs (
+    sha256 TEXT PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL, -- relative to UPLOAD_FOLDER
+    size_bytes INTEGER NOT NULL,
+    ref_count INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_media_blobs_unreferenced ON media_blobs (path) WHERE ref_count <= 0;
+"""),
+    (14, 'content expiry', {'sqlite': """
+ALTER TABLE stories ADD COLUMN expires_at TIMESTAMP;
+UPDATE stories SET expires_at = datetime(created_at, '+' || duration || ' hours');
+CREATE INDEX IF NOT EXISTS idx_stories_user_expires ON stories (user_id, expires_at);
+CREATE INDEX IF NOT EXISTS idx_stories_expires ON stories (expires_at);
+CREATE INDEX IF NOT EXISTS idx_messages_expires ON messages (expires_at) WHERE expires_at IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_conversations_last_message ON conversations (last_message_id);
+""", 'postgresql': """
+ALTER TABLE stories ADD COLUMN expires_at TIMESTAMP;
+UPDATE stories SET expires_at = created_at + duration * INTERVAL '1 hour';
+CREATE INDEX IF NOT EXISTS idx_stories_user_expires ON stories (user_id, expires_at);
+CREATE INDEX IF NOT EXISTS idx_stories_expires ON stories (expires_at);
+CREATE INDEX IF NOT EXISTS idx_messages_expires ON messages (expires_at) WHERE expires_at IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_conversations_last_message ON conversations (last_message_id);
+"""}),
+    (15, 'group read cursors', """
+ALTER TABLE groups ADD COLUMN last_message_id INTEGER;
+ALTER TABLE groups ADD COLUMN last_message_at TIMESTAMP;
+ALTER TABLE groups ADD COLUMN last_message_preview TEXT;
+ALTER TABLE groups ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE conversations ADD COLUMN read_count INTEGER NOT NULL DEFAULT 0;
+UPDATE groups SET
+    message_count = (SELECT COUNT(*) FROM messages WHERE group_id = groups.id),
+    last_message_id = (SELECT MAX(id) FROM messages WHERE group_id = groups.id);
+UPDATE groups SET
+    last_message_at = (SELECT created_at FROM messages WHERE id = groups.last_message_id),
+    last_message_preview = (SELECT substr(content, 1, 100) FROM messages WHERE id = groups.last_message_id);
+UPDATE conversations SET
+    read_count = (SELECT message_count FROM groups WHERE id = conversations.group_id) - unread_count
+WHERE group_id IS NOT NULL;
+"""),
+    (16, 'group join requests', """
+CREATE TABLE IF NOT EXISTS group_join_requests (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    group_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending', -- 'pending', 'approved', 'rejected'
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    decided_at TIMESTAMP,
+    decided_by INTEGER,
+    FOREIGN KEY (group_id) REFERENCES groups (id),
+    FOREIGN KEY (user_id) REFERENCES users (id),
+    FOREIGN KEY (decided_by) REFERENCES users (id),
+    UNIQUE(group_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS idx_group_join_requests_pending ON group_join_requests (group_id, created_at)
+    WHERE status = 'pending';
+"""),
+    (17, 'pulled reposts', """
+ALTER TABLE reposts ADD COLUMN fanned_out BOOLEAN NOT NULL DEFAULT TRUE;
+CREATE INDEX IF NOT EXISTS idx_reposts_user_pull ON reposts (user_id, created_at) WHERE fanned_out = FALSE;
+-- Reposts that never reached their followers' timelines are pulled from now on
+UPDATE reposts SET fanned_out = FALSE
+WHERE original_post_id IS NOT NULL
+    AND EXISTS (SELECT 1 FROM followers f WHERE f.followed_id = reposts.user_id AND f.status = 'accepted')
+    AND NOT EXISTS (SELECT 1 FROM timeline t
+                    WHERE t.post_id = reposts.original_post_id AND t.actor_id = reposts.user_id);
+"""),
+    (18, 'notification actors', """
+CREATE TABLE IF NOT EXISTS notification_actors (
+    notification_id INTEGER NOT NULL,
+    actor_id INTEGER NOT NULL,
+    PRIMARY KEY (notification_id, actor_id)
+);
+INSERT INTO notification_actors (notification_id, actor_id)
+    SELECT id, source_id FROM notifications
+    WHERE is_read = FALSE AND source_id IS NOT NULL AND type != 'message'
+    ON CONFLICT DO NOTHING;
+ALTER TABLE notifications ADD COLUMN updated_at TIMESTAMP;
+UPDATE notifications SET updated_at = created_at;
+"""),
+    (19, 'inbox activity', """
+ALTER TABLE conversations ADD COLUMN last_activity TIMESTAMP;
+UPDATE conversations SET last_activity = CASE
+    WHEN group_id IS NULL THEN last_message_at
+    ELSE (SELECT last_message_at FROM groups WHERE id = conversations.group_id)
+END;
+DROP INDEX IF EXISTS idx_conversations_inbox;
+CREATE INDEX IF NOT EXISTS idx_conversations_inbox ON conversations (user_id, last_activity, id);
+"""),
+]
+
+def run_migrations(db):
+    db.execute(
+        '''CREATE TABLE IF NOT EXISTS schema_migrations (
+               version INTEGER PRIMARY KEY,
+               name TEXT NOT NULL,
+               applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+           )'''
+    )
+    applied = {row['version'] for row in db.execute('SELECT version FROM schema_migrations').fetchall()}
+    
+    for version, name, sql in MIGRATIONS:
+        if version in applied:
+            continue
+        if isinstance(sql, dict):
+            sql = sql.get(database_dialect(), '')
+        
+        # Run the migration and its bookkeeping row in a single transaction
+        try:
+            db.executescript(
+                'BEGIN;\n' + sql +
+                f"\nINSERT INTO schema_migrations (version, name) VALUES ({version}, '{name}');\nCOMMIT;"
+            )
+        except Exception:
+            db.rollback()
+            raise
 
 # Initialize database
 def init_db():
     with app.app_context():
         db = get_db()
         db.executescript(schema_sql)
+        run_migrations(db)
         
         # Create admin user if not exists
         admin_exists = db.execute(
@@ -299,6 +956,10 @@ def init_db():
             db.commit()
 
 # Helper functions
+def utc_timestamp(hours=0):
+    """The UTC time hours from now, formatted like CURRENT_TIMESTAMP."""
+    return (datetime.utcnow() + timedelta(hours=hours)).strftime('%Y-%m-%d %H:%M:%S')
+
 def generate_unique_key():
     import random
     import string
@@ -306,6 +967,99 @@ def generate_unique_key():
     numbers = ''.join(random.choices(string.digits, k=2))
     return letters + numbers
 
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire ttl seconds after being set."""
+    
+    def __init__(self, maxsize, ttl):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+    
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+    
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self._ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+    
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+# Keyset pagination. A cursor is an opaque token for the (created_at, id) of
+# the last row a client has seen; the next page starts strictly after it, so
+# page N costs the same as page 1 and concurrent inserts don't shift pages.
+class InvalidCursor(ValueError):
+    pass
+
+@app.errorhandler(InvalidCursor)
+def handle_invalid_cursor(error):
+    return jsonify({'error': 'Invalid cursor'}), 400
+
+def encode_cursor(created_at, row_id):
+    raw = json.dumps([str(created_at), row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, row_id = json.loads(raw)
+        return str(created_at), int(row_id)
+    except (ValueError, TypeError):
+        raise InvalidCursor(cursor)
+
+def keyset_clause(alias, cursor, keyword='AND', time_column='created_at', id_column='id'):
+    """Return (sql, params) restricting a newest-first query to rows after cursor."""
+    if not cursor:
+        return '', ()
+    return (f'{keyword} ({alias}.{time_column}, {alias}.{id_column}) < (?, ?)',
+            decode_cursor(cursor))
+
+def paginated_response(rows, limit, sort_key='created_at', hydrate=None):
+    """Respond with a page fetched as limit + 1 rows.
+    
+    Clients that pass ``cursor`` (empty for the first page) get an object
+    with ``items`` and ``next_cursor``; legacy page-based clients keep
+    getting a bare list. hydrate, if given, turns the page's rows into
+    items; the cursor still comes from the rows, so items it drops do not
+    end the listing early.
+    """
+    items = hydrate(rows[:limit]) if hydrate else [dict(row) for row in rows[:limit]]
+    if 'cursor' not in request.args:
+        return jsonify(items)
+    
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = encode_cursor(last[sort_key], last['id'])
+    return jsonify({'items': items, 'next_cursor': next_cursor})
+
+def get_limit(default, maximum=None):
+    """Read the ``limit`` query argument, clamped to 1..MAX_PAGE_SIZE."""
+    limit = request.args.get('limit', default, type=int)
+    return max(1, min(limit, maximum or app.config['MAX_PAGE_SIZE']))
+
+def get_page():
+    """Read the legacy 1-based ``page`` query argument; anything below 1 is page 1."""
+    return max(1, request.args.get('page', 1, type=int))
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -328,6 +1082,491 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# Real-time push. Write endpoints publish events to a user and every open
+# /api/stream connection of that user receives them, so idle clients wait on
+# a queue instead of polling the database. The broker also carries cache
+# invalidations, so a write on one worker evicts the entry on all of them.
+class EventBroker:
+    """In-process pub/sub with one bounded queue per open stream."""
+    
+    # Whether invalidations reach other worker processes
+    shared = False
+    
+    def __init__(self, queue_size):
+        self._queue_size = queue_size
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._invalidation_handlers = []
+    
+    def subscribe(self, user_id):
+        events = queue.Queue(maxsize=self._queue_size)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(events)
+        return events
+    
+    def unsubscribe(self, user_id, events):
+        with self._lock:
+            streams = self._subscribers.get(user_id, set())
+            streams.discard(events)
+            if not streams:
+                self._subscribers.pop(user_id, None)
+    
+    def deliver(self, user_id, event):
+        with self._lock:
+            streams = list(self._subscribers.get(user_id, ()))
+        for events in streams:
+            try:
+                events.put_nowait(event)
+            except queue.Full:
+                pass  # a stalled client misses events rather than blocking writers
+    
+    def publish(self, user_id, event_type, data):
+        self.deliver(user_id, {'event': event_type, 'data': data})
+    
+    def on_invalidate(self, handler):
+        """Call handler(namespace, object_id) for every invalidation published.
+        
+        A namespace of None means anything may have changed.
+        """
+        with self._lock:
+            self._invalidation_handlers.append(handler)
+    
+    def invalidate(self, namespace, object_id):
+        self.deliver_invalidation(namespace, object_id)
+    
+    def deliver_invalidation(self, namespace, object_id):
+        with self._lock:
+            handlers = list(self._invalidation_handlers)
+        for handler in handlers:
+            handler(namespace, object_id)
+
+class RedisEventBroker(EventBroker):
+    """Relays events through Redis pub/sub so streams on every worker see them."""
+    
+    channel = 'sociafam:events'
+    invalidation_channel = 'sociafam:invalidations'
+    shared = True
+    retry_min_delay = 0.5  # seconds
+    retry_max_delay = 30
+    
+    def __init__(self, url, queue_size):
+        super().__init__(queue_size)
+        self._redis = redis.Redis.from_url(url)
+        self._listener = None
+    
+    def publish(self, user_id, event_type, data):
+        self._redis.publish(self.channel, json.dumps(
+            {'user_id': user_id, 'event': event_type, 'data': data}, default=str
+        ))
+    
+    def invalidate(self, namespace, object_id):
+        self._redis.publish(self.invalidation_channel, json.dumps([namespace, object_id]))
+    
+    def _start_listener(self):
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen, daemon=True)
+                self._listener.start()
+    
+    def subscribe(self, user_id):
+        # Only workers that hold open streams or caches need to listen
+        self._start_listener()
+        return super().subscribe(user_id)
+    
+    def on_invalidate(self, handler):
+        super().on_invalidate(handler)
+        self._start_listener()
+    
+    def _dispatch(self, message):
+        payload = json.loads(message['data'])
+        channel = message['channel']
+        if isinstance(channel, bytes):
+            channel = channel.decode()
+        if channel == self.invalidation_channel:
+            self.deliver_invalidation(*payload)
+        else:
+            self.deliver(payload['user_id'], {'event': payload['event'], 'data': payload['data']})
+    
+    def _listen(self):
+        # Resubscribe after Redis drops or restarts, backing off exponentially
+        # while it stays down. Events published in the gap are lost.
+        delay = self.retry_min_delay
+        while True:
+            pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(self.channel, self.invalidation_channel)
+                if delay > self.retry_min_delay:
+                    app.logger.info('Event listener resubscribed')
+                    # Invalidations published while it was down are lost
+                    self.deliver_invalidation(None, None)
+                delay = self.retry_min_delay
+                for message in pubsub.listen():
+                    try:
+                        self._dispatch(message)
+                    except (ValueError, KeyError, TypeError):
+                        app.logger.warning('Dropped malformed event %r', message['data'])
+            except redis.RedisError:
+                app.logger.warning(
+                    'Event listener lost Redis, retrying in %.1fs', delay, exc_info=True
+                )
+            finally:
+                pubsub.close()
+            time.sleep(delay)
+            delay = min(delay * 2, self.retry_max_delay)
+
+_broker = None
+_broker_pid = None
+
+def get_broker():
+    global _broker, _broker_pid
+    with _pool_lock:
+        if _broker_pid != os.getpid():
+            if app.config['PUBSUB_URL']:
+                if redis is None:
+                    raise RuntimeError('PUBSUB_URL requires the redis package')
+                _broker = RedisEventBroker(app.config['PUBSUB_URL'], app.config['STREAM_QUEUE_SIZE'])
+            else:
+                _broker = EventBroker(app.config['STREAM_QUEUE_SIZE'])
+            _broker_pid = os.getpid()
+        return _broker
+
+def publish_event(user_id, event_type, data):
+    get_broker().publish(int(user_id), event_type, data)
+
+# Unread counters. users.unread_notifications / unread_messages and
+# conversations.unread_count are kept current on every insert and read, and the
+# per-user totals are served from a write-through cache, so badge polling is
+# a dictionary lookup. Other workers' writes show up once the entry expires.
+unread_cache = TTLCache(app.config['UNREAD_CACHE_SIZE'], app.config['UNREAD_CACHE_TTL'])
+
+def get_unread_counts(db, user_id):
+    counts = unread_cache.get(int(user_id))
+    if counts is None:
+        row = db.execute(
+            'SELECT unread_notifications, unread_messages FROM users WHERE id = ?', (user_id,)
+        ).fetchone()
+        counts = {'notifications': row[0], 'messages': row[1]} if row else {'notifications': 0, 'messages': 0}
+        unread_cache.set(int(user_id), counts)
+    return counts
+
+def store_unread_counts(user_id, notifications, messages):
+    counts = {'notifications': notifications, 'messages': messages}
+    unread_cache.set(int(user_id), counts)
+    return counts
+
+# Conversation summaries. Every inbox entry (one row per DM partner and per
+# group membership) is a conversations row, so the inbox is a single range
+# scan of the owner's rows. Direct rows carry their last message and unread
+# count. A group's last message and message_count live on the group, and each
+# member's row keeps a read cursor, read_count, so its unread count is the
+# difference. Every row, direct or group, carries last_activity, the inbox's
+# sort key, which a group message bumps on each member's row in one UPDATE.
+CONVERSATION_UPSERT_SQL = '''
+    INSERT INTO conversations (user_id, peer_id, last_message_id, last_message_at,
+                               last_message_preview, unread_count, last_activity)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (user_id, peer_id) WHERE peer_id IS NOT NULL DO UPDATE SET
+        last_message_id = excluded.last_message_id,
+        last_message_at = excluded.last_message_at,
+        last_message_preview = excluded.last_message_preview,
+        unread_count = conversations.unread_count + excluded.unread_count,
+        last_activity = excluded.last_activity
+'''
+
+def message_preview(message):
+    return message['content'][:100] if message['content'] else f"[{message['message_type']}]"
+
+def record_message(db, message):
+    """Update conversation summaries and unread counters for a new message.
+    
+    Call inside the sending transaction. Returns the receiver's
+    (unread_notifications, unread_messages) for direct messages.
+    """
+    preview = message_preview(message)
+    if message['group_id']:
+        group = db.execute(
+            '''UPDATE groups SET
+                   last_message_id = ?, last_message_at = ?, last_message_preview = ?,
+                   message_count = message_count + 1
+               WHERE id = ? RETURNING message_count''',
+            (message['id'], message['created_at'], preview, message['group_id'])
+        ).fetchone()
+        # The sender has read the group up to their own message
+        db.execute(
+            '''UPDATE conversations SET
+                   last_activity = ?,
+                   read_count = CASE WHEN user_id = ? THEN ? ELSE read_count END
+               WHERE group_id = ?''',
+            (message['created_at'], message['sender_id'], group['message_count'], message['group_id'])
+        )
+        return None
+    
+    db.executemany(CONVERSATION_UPSERT_SQL, [
+        (message['sender_id'], message['receiver_id'], message['id'], message['created_at'], preview, 0,
+         message['created_at']),
+        (message['receiver_id'], message['sender_id'], message['id'], message['created_at'], preview, 1,
+         message['created_at']),
+    ])
+    row = db.execute(
+        '''UPDATE users SET unread_messages = unread_messages + 1 WHERE id = ?
+           RETURNING unread_notifications, unread_messages''',
+        (message['receiver_id'],)
+    ).fetchone()
+    return (row[0], row[1]) if row else None
+
+def add_group_conversation(db, group_id, user_id):
+    # New members start with the group's history read
+    db.execute(
+        '''INSERT INTO conversations (user_id, group_id, read_count, last_activity)
+           SELECT ?, id, message_count, last_message_at FROM groups WHERE id = ?
+           ON CONFLICT (user_id, group_id) WHERE group_id IS NOT NULL DO NOTHING''',
+        (user_id, group_id)
+    )
+
+def mark_group_read(db, user_id, group_id):
+    db.execute(
+        '''UPDATE conversations SET read_count = (SELECT message_count FROM groups WHERE id = ?)
+           WHERE user_id = ? AND group_id = ? AND read_count < (SELECT message_count FROM groups WHERE id = ?)''',
+        (group_id, user_id, group_id, group_id)
+    )
+
+def mark_conversation_read(db, user_id, peer_id):
+    """Mark peer_id's messages to user_id as read and settle the counters."""
+    read = db.execute(
+        'UPDATE messages SET is_read = TRUE WHERE sender_id = ? AND receiver_id = ? AND is_read = FALSE',
+        (peer_id, user_id)
+    ).rowcount
+    if read <= 0:
+        return None
+    db.execute(
+        'UPDATE conversations SET unread_count = 0 WHERE user_id = ? AND peer_id = ?', (user_id, peer_id)
+    )
+    row = db.execute(
+        '''UPDATE users SET unread_messages = CASE WHEN unread_messages > ? THEN unread_messages - ? ELSE 0 END
+           WHERE id = ? RETURNING unread_notifications, unread_messages''',
+        (read, read, user_id)
+    ).fetchone()
+    return (row[0], row[1])
+
+# Notification pipeline. Requests only enqueue events; a background thread
+# coalesces them per (recipient, type, target) and flushes each batch with a
+# few executemany statements. While a notification is unread, further events
+# for the same target fold into it ("X and 41 others liked your post"), so a
+# viral post produces one row per recipient rather than one per like.
+# actor_count counts distinct actors, kept in notification_actors until the
+# notification is read; message notifications count messages instead.
+# created_at is when the row was opened and never changes, so keyset pages
+# stay stable; updated_at moves with the latest event.
+NOTIFICATION_UPSERT_SQL = '''
+    INSERT INTO notifications (user_id, type, source_id, content, target_type, target_id,
+                               group_key, actor_count, created_at, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (user_id, group_key) WHERE is_read = FALSE DO UPDATE SET
+        source_id = excluded.source_id,
+        actor_count = notifications.actor_count + excluded.actor_count,
+        updated_at = excluded.updated_at
+'''
+
+# Run per (actor, recipient, group_key) before the actor is recorded
+NOTIFICATION_COUNT_ACTOR_SQL = '''
+    UPDATE notifications SET actor_count = actor_count + 1
+    WHERE user_id = ? AND group_key = ? AND is_read = FALSE
+        AND NOT EXISTS (SELECT 1 FROM notification_actors a
+                        WHERE a.notification_id = notifications.id AND a.actor_id = ?)
+'''
+
+NOTIFICATION_ADD_ACTOR_SQL = '''
+    INSERT INTO notification_actors (notification_id, actor_id)
+    SELECT id, ? FROM notifications WHERE user_id = ? AND group_key = ? AND is_read = FALSE
+    ON CONFLICT DO NOTHING
+'''
+
+# What each notification type says after the actor's name
+NOTIFICATION_PHRASES = {
+    'like': 'liked your post',
+    'comment': 'commented on your post',
+    'repost': 'reposted your post',
+    'follow': 'started following you',
+    'friend_request': 'requested to follow you',
+    'message': 'sent you a message',
+    'group_join_request': 'asked to join your group',
+}
+
+def notification_message(notif):
+    name = notif['username'] or 'Someone'
+    others = notif['actor_count'] - 1
+    if notif['type'] == 'message':
+        if others:
+            return f"{name} sent you {others + 1} messages"
+        return f"{name} {notif['content']}"
+    if others:
+        return f"{name} and {others} {'other' if others == 1 else 'others'} {notif['content']}"
+    return f"{name} {notif['content']}"
+
+def wants_notification(settings, notif_type):
+    if settings is None:
+        return True
+    if not settings['notifications_enabled']:
+        return False
+    types = settings['notification_types'] or 'all'
+    return types == 'all' or notif_type in [t.strip() for t in types.split(',')]
+
+class NotificationPipeline:
+    """Coalescing write buffer for notifications, flushed off the request path.
+    
+    A batch that fails to flush is folded back into the queue and retried
+    with the next one, up to max_attempts times.
+    """
+    
+    max_attempts = 5
+    
+    def __init__(self, interval, batch_size):
+        self._interval = interval
+        self._batch_size = batch_size
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._wakeup = threading.Event()
+        self._thread = None
+    
+    def enqueue(self, user_id, notif_type, source_id, target_type=None, target_id=None):
+        now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        with self._lock:
+            self._merge({
+                'user_id': int(user_id), 'type': notif_type, 'source_id': source_id,
+                'target_type': target_type, 'target_id': target_id,
+                'actors': {source_id}, 'events': 1, 'created_at': now, 'attempts': 0
+            })
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            if len(self._pending) >= self._batch_size:
+                self._wakeup.set()
+    
+    def _merge(self, entry):
+        # Caller holds self._lock
+        key = (entry['user_id'], entry['type'], entry['target_type'], entry['target_id'])
+        pending = self._pending.get(key)
+        if pending is None:
+            self._pending[key] = entry
+            return
+        # A requeued entry is older than whatever has arrived since
+        newer = max((pending, entry), key=lambda e: e['created_at'])
+        pending.update(
+            source_id=newer['source_id'], created_at=newer['created_at'],
+            actors=pending['actors'] | entry['actors'], events=pending['events'] + entry['events'],
+            attempts=max(pending['attempts'], entry['attempts'])
+        )
+    
+    def _requeue(self, batch):
+        with self._lock:
+            for entry in batch:
+                if entry['attempts'] + 1 >= self.max_attempts:
+                    app.logger.error('Dropping %s notification for user %s after %s attempts',
+                                     entry['type'], entry['user_id'], self.max_attempts)
+                    continue
+                self._merge(dict(entry, attempts=entry['attempts'] + 1))
+    
+    def _run(self):
+        while True:
+            self._wakeup.wait(self._interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                app.logger.exception('Notification flush failed')
+    
+    def flush(self):
+        with self._lock:
+            batch = list(self._pending.values())
+            self._pending.clear()
+        if not batch:
+            return
+        
+        try:
+            counts, batch = self._write(batch)
+        except Exception:
+            self._requeue(batch)
+            raise
+        
+        for entry in batch:
+            publish_event(entry['user_id'], 'notification', {
+                'user_id': entry['user_id'], 'type': entry['type'], 'source_id': entry['source_id'],
+                'target_type': entry['target_type'], 'target_id': entry['target_id'],
+                'actor_count': entry['events'] if entry['type'] == 'message' else len(entry['actors']),
+                'created_at': entry['created_at']
+            })
+        for row in counts:
+            publish_event(row[0], 'unread', store_unread_counts(row[0], row[1], row[2]))
+    
+    def _write(self, batch):
+        with app.app_context():
+            db = get_db()
+            
+            # Honour each recipient's notification settings, one query per batch
+            user_ids = sorted({entry['user_id'] for entry in batch})
+            placeholders = ', '.join('?' * len(user_ids))
+            settings = {
+                row['user_id']: row for row in db.execute(
+                    f'''SELECT user_id, notifications_enabled, notification_types
+                        FROM settings WHERE user_id IN ({placeholders})''',
+                    user_ids
+                ).fetchall()
+            }
+            batch = [entry for entry in batch
+                     if wants_notification(settings.get(entry['user_id']), entry['type'])]
+            if not batch:
+                return [], []
+            
+            group_keys = [f"{entry['type']}:{entry['target_type']}:{entry['target_id']}" for entry in batch]
+            db.executemany(NOTIFICATION_UPSERT_SQL, [
+                (entry['user_id'], entry['type'], entry['source_id'],
+                 NOTIFICATION_PHRASES[entry['type']], entry['target_type'], entry['target_id'],
+                 group_key, entry['events'] if entry['type'] == 'message' else 0,
+                 entry['created_at'], entry['created_at'])
+                for entry, group_key in zip(batch, group_keys)
+            ])
+            actors = [(actor_id, entry['user_id'], group_key)
+                      for entry, group_key in zip(batch, group_keys) if entry['type'] != 'message'
+                      for actor_id in entry['actors']]
+            db.executemany(NOTIFICATION_COUNT_ACTOR_SQL,
+                           [(user_id, group_key, actor_id) for actor_id, user_id, group_key in actors])
+            db.executemany(NOTIFICATION_ADD_ACTOR_SQL, actors)
+            
+            # Coalesced events may or may not have opened a new unread row, so
+            # recount the (bounded) unread rows of just the affected users
+            user_ids = sorted({entry['user_id'] for entry in batch})
+            placeholders = ', '.join('?' * len(user_ids))
+            counts = db.execute(
+                f'''UPDATE users SET unread_notifications = (
+                        SELECT COUNT(*) FROM notifications
+                        WHERE user_id = users.id AND is_read = FALSE
+                    ) WHERE id IN ({placeholders})
+                    RETURNING id, unread_notifications, unread_messages''',
+                user_ids
+            ).fetchall()
+            db.commit()
+        return counts, batch
+
+_notification_pipeline = None
+_notification_pipeline_pid = None
+
+def get_notification_pipeline():
+    global _notification_pipeline, _notification_pipeline_pid
+    with _pool_lock:
+        if _notification_pipeline_pid != os.getpid():
+            _notification_pipeline = NotificationPipeline(
+                app.config['NOTIFICATION_FLUSH_INTERVAL'], app.config['NOTIFICATION_BATCH_SIZE']
+            )
+            atexit.register(_notification_pipeline.flush)
+            _notification_pipeline_pid = os.getpid()
+        return _notification_pipeline
+
+def notify(user_id, notif_type, target_type=None, target_id=None):
+    """Queue a notification that the current user acted on something of user_id's."""
+    if str(user_id) == str(session['user_id']):
+        return
+    get_notification_pipeline().enqueue(user_id, notif_type, session['user_id'], target_type, target_id)
+
 # Authentication routes
 @app.route('/')
 def index():
@@ -398,7 +1637,9 @@ def register():
         db.execute(
             'INSERT INTO settings (user_id) VALUES (?)', (user_id,)
         )
+        queue_friend_suggestions(db, [user_id])
         db.commit()
+        refresh_suggestions(db, user_id)
         
         return jsonify({'success': True, 'unique_key': unique_key})
     except Exception as e:
@@ -452,7 +1693,442 @@ def logout():
     session.clear()
     return redirect(url_for('login'))
 
+# Media pipeline. Uploads are saved untouched and the request returns at once;
+# a background pool then writes WebP 'thumb' and 'display' variants of images
+# and a 'poster' frame (plus its thumb) for videos into media_variants. Feed
+# queries pick the variants up by path, falling back to the original until
+# they exist.
+UPLOAD_FOLDERS = {
+    'profile': 'profiles',
+    'post': 'posts',
+    'story': 'stories',
+    'reel': 'reels',
+    'message': 'messages',
+}
+IMAGE_EXTENSIONS = {'jpg', 'jpeg', 'png', 'gif', 'webp', 'bmp', 'tiff'}
+VIDEO_EXTENSIONS = {'mp4', 'mov', 'avi', 'mkv', 'webm', 'm4v'}
+
+def media_type_of(filename):
+    ext = filename.rsplit('.', 1)[-1].lower()
+    if ext in VIDEO_EXTENSIONS:
+        return 'video'
+    if ext in IMAGE_EXTENSIONS:
+        return 'image'
+    return None
+
+# Media store. Uploads are stored once per distinct content, sharded by their
+# SHA-256 as media/ab/cd/<sha256>.<ext>, and the posts, reels, stories,
+# messages and users columns hold that path. media_blobs counts the rows
+# referring to each blob; the last release deletes the file and its variants.
+# Blob rows are taken and released inside the caller's transaction, so a
+# concurrent upload of the same content waits on the row lock and re-places
+# the file if the blob was collected meanwhile.
+MEDIA_STORE = 'media'
+
+def blob_path(digest, ext):
+    return f'{MEDIA_STORE}/{digest[:2]}/{digest[2:4]}/{digest}.{ext}'
+
+def incoming_upload_dir():
+    path = os.path.join(app.instance_path, 'uploads')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def add_blob(db, temp_path, digest, ext):
+    """Take a reference to the blob holding temp_path's content and return its path.
+    
+    temp_path is moved into the store, or deleted if the blob already exists.
+    """
+    blob = db.execute(
+        '''INSERT INTO media_blobs (sha256, path, size_bytes, ref_count) VALUES (?, ?, ?, 1)
+           ON CONFLICT (sha256) DO UPDATE SET ref_count = media_blobs.ref_count + 1
+           RETURNING path, ref_count''',
+        (digest, blob_path(digest, ext), os.path.getsize(temp_path))
+    ).fetchone()
+    target = os.path.join(app.config['UPLOAD_FOLDER'], blob['path'])
+    if os.path.exists(target):
+        os.remove(temp_path)
+    else:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(temp_path, target)
+    
+    if blob['ref_count'] == 1:
+        db.after_commit(get_media_pipeline().submit, blob['path'])
+    return blob['path']
+
+def save_upload(file):
+    """Store an uploaded file in the media store and return its path.
+    
+    Runs in the request's transaction, which holds the new reference.
+    """
+    ext = file.filename.rsplit('.', 1)[-1].lower()
+    digest = hashlib.sha256()
+    fd, temp_path = tempfile.mkstemp(dir=incoming_upload_dir())
+    with os.fdopen(fd, 'wb') as out:
+        for block in iter(lambda: file.stream.read(1024 * 1024), b''):
+            digest.update(block)
+            out.write(block)
+    return add_blob(get_db(), temp_path, digest.hexdigest(), ext)
+
+def adopt_upload(path, original_name, digest):
+    """Store a file already on disk whose SHA-256 is known, like save_upload."""
+    ext = original_name.rsplit('.', 1)[-1].lower()
+    return add_blob(get_db(), path, digest, ext)
+
+def commit_removing_files(db, paths):
+    """Commit db's transaction and delete paths (under UPLOAD_FOLDER) with it.
+    
+    The files are renamed aside before the commit and put back if it fails.
+    An upload of the same content that gets in right after the commit finds
+    no file and stores its own; the renamed copies are unlinked after that.
+    """
+    moved = []
+    try:
+        for relative in paths:
+            full_path = os.path.join(app.config['UPLOAD_FOLDER'], relative)
+            try:
+                os.replace(full_path, full_path + '.deleted')
+            except FileNotFoundError:
+                continue
+            moved.append(full_path)
+        db.commit()
+    except Exception:
+        db.rollback()
+        for full_path in moved:
+            os.replace(full_path + '.deleted', full_path)
+        raise
+    for full_path in moved:
+        os.remove(full_path + '.deleted')
+
+def collect_blob(db, path):
+    """Delete the blob at path and its variants if nothing refers to it any more.
+    
+    Runs in a transaction of its own once the last release has committed,
+    so a release that rolls back never loses a file. Returns whether the
+    blob was deleted.
+    """
+    blob = db.execute(
+        'DELETE FROM media_blobs WHERE path = ? AND ref_count <= 0 RETURNING path', (path,)
+    ).fetchone()
+    if blob is None:
+        db.rollback()
+        return False
+    variants = db.execute(
+        'DELETE FROM media_variants WHERE media_path = ? RETURNING variant_path', (path,)
+    ).fetchall()
+    commit_removing_files(db, [path] + [row[0] for row in variants])
+    return True
+
+def release_media(db, path):
+    """Drop one reference to a stored upload; legacy paths are ignored."""
+    if not path or not path.startswith(MEDIA_STORE + '/'):
+        return
+    blob = db.execute(
+        'UPDATE media_blobs SET ref_count = ref_count - 1 WHERE path = ? RETURNING ref_count', (path,)
+    ).fetchone()
+    if blob and blob['ref_count'] <= 0:
+        db.after_commit(collect_blob, db, path)
+
+def upload_path_sql(column, kind):
+    """SQL for the path under UPLOAD_FOLDER of the upload named in column.
+    
+    Uploads from before the media store are bare names in kind's folder.
+    """
+    return f"CASE WHEN {column} LIKE '{MEDIA_STORE}/%' THEN {column} ELSE '{UPLOAD_FOLDERS[kind]}/' || {column} END"
+
+def variant_sql(path_sql, variant, alias):
+    return f"(SELECT variant_path FROM media_variants WHERE media_path = {path_sql} AND variant = '{variant}') as {alias}"
+
+def media_variant_columns(column, kind):
+    """Select columns for the variants of the upload named in column, or NULLs."""
+    path_sql = upload_path_sql(column, kind)
+    return ', '.join([
+        variant_sql(path_sql, 'display', 'media_display'),
+        variant_sql(path_sql, 'thumb', 'media_thumb'),
+        variant_sql(path_sql, 'poster', 'media_poster'),
+    ])
+
+def profile_pic_thumb_column(alias='u'):
+    return variant_sql(upload_path_sql(f'{alias}.profile_pic', 'profile'), 'thumb', 'profile_pic_thumb')
+
+def write_image_variants(image, media_path, variants):
+    """Save WebP copies of image resized per {variant: longest side}; returns media_variants rows."""
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+    stem = os.path.splitext(media_path)[0]
+    rows = []
+    for variant, max_side in variants.items():
+        resized = image.copy()
+        resized.thumbnail((max_side, max_side))
+        variant_path = f'variants/{stem}_{variant}.webp'
+        target = os.path.join(app.config['UPLOAD_FOLDER'], variant_path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        resized.save(target, 'WEBP', quality=app.config['MEDIA_WEBP_QUALITY'])
+        rows.append((media_path, variant, variant_path, resized.width, resized.height, os.path.getsize(target)))
+    return rows
+
+def extract_poster(media_path):
+    """Grab a frame from the video at media_path with ffmpeg; returns its path or None."""
+    ffmpeg = shutil.which(app.config['FFMPEG_PATH'])
+    if ffmpeg is None:
+        return None
+    poster_path = f'variants/{os.path.splitext(media_path)[0]}_poster.jpg'
+    target = os.path.join(app.config['UPLOAD_FOLDER'], poster_path)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    source = os.path.join(app.config['UPLOAD_FOLDER'], media_path)
+    max_side = app.config['MEDIA_IMAGE_VARIANTS']['display']
+    # One second in avoids black lead-in frames; very short clips use the first
+    for offset in ('1', '0'):
+        subprocess.run(
+            [ffmpeg, '-v', 'error', '-y', '-ss', offset, '-i', source, '-frames:v', '1',
+             '-vf', f"scale='min({max_side},iw)':-2", target],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=60
+        )
+        if os.path.exists(target) and os.path.getsize(target) > 0:
+            return poster_path
+    return None
+
+def process_media(db, media_path):
+    """Generate and record the variants of one upload; the caller commits."""
+    media_type = media_type_of(media_path)
+    source = os.path.join(app.config['UPLOAD_FOLDER'], media_path)
+    rows = []
+    if media_type == 'image' and Image is not None:
+        with Image.open(source) as image:
+            rows = write_image_variants(
+                ImageOps.exif_transpose(image), media_path, app.config['MEDIA_IMAGE_VARIANTS']
+            )
+    elif media_type == 'video':
+        poster_path = extract_poster(media_path)
+        if poster_path:
+            poster_file = os.path.join(app.config['UPLOAD_FOLDER'], poster_path)
+            rows.append((media_path, 'poster', poster_path, None, None, os.path.getsize(poster_file)))
+            if Image is not None:
+                with Image.open(poster_file) as poster:
+                    thumb = {'thumb': app.config['MEDIA_IMAGE_VARIANTS']['thumb']}
+                    rows.extend(write_image_variants(poster, media_path, thumb))
+    
+    db.executemany(
+        '''INSERT INTO media_variants (media_path, variant, variant_path, width, height, size_bytes)
+           VALUES (?, ?, ?, ?, ?, ?)
+           ON CONFLICT (media_path, variant) DO UPDATE SET
+               variant_path = excluded.variant_path, width = excluded.width,
+               height = excluded.height, size_bytes = excluded.size_bytes''',
+        rows
+    )
+    return len(rows)
+
+class MediaPipeline:
+    """Generates upload variants on a background thread pool."""
+    
+    def __init__(self, workers):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='media')
+    
+    def submit(self, media_path):
+        if media_type_of(media_path) is not None:
+            self._executor.submit(self._process, media_path)
+    
+    def _process(self, media_path):
+        try:
+            with app.app_context():
+                db = get_db()
+                process_media(db, media_path)
+                db.commit()
+        except Exception:
+            app.logger.exception('Could not generate variants for %s', media_path)
+
+_media_pipeline = None
+_media_pipeline_pid = None
+
+def get_media_pipeline():
+    global _media_pipeline, _media_pipeline_pid
+    with _pool_lock:
+        if _media_pipeline_pid != os.getpid():
+            _media_pipeline = MediaPipeline(app.config['MEDIA_WORKERS'])
+            _media_pipeline_pid = os.getpid()
+        return _media_pipeline
+
+# Content expiry. Stories and disappearing messages carry an expires_at
+# timestamp (UTC, like CURRENT_TIMESTAMP); reads filter on it and a
+# background thread deletes expired rows in batches, releasing their media
+# and settling the conversation summaries and unread counters.
+def purge_expired_stories(db, now, batch_size):
+    stories = db.execute(
+        '''DELETE FROM stories WHERE id IN (
+               SELECT id FROM stories WHERE expires_at <= ? ORDER BY expires_at LIMIT ?
+           ) RETURNING media_url''',
+        (now, batch_size)
+    ).fetchall()
+    for story in stories:
+        release_media(db, story['media_url'])
+    return len(stories)
+
+def purge_expired_messages(db, now, batch_size):
+    """Delete a batch of expired messages; returns (purged, unread_counts).
+    
+    unread_counts maps each affected receiver to their new
+    (unread_notifications, unread_messages).
+    """
+    messages = db.execute(
+        '''DELETE FROM messages WHERE id IN (
+               SELECT id FROM messages WHERE expires_at <= ? ORDER BY expires_at LIMIT ?
+           ) RETURNING id, sender_id, receiver_id, is_read, media_url''',
+        (now, batch_size)
+    ).fetchall()
+    if not messages:
+        return 0, {}
+    
+    unread = Counter()
+    for message in messages:
+        release_media(db, message['media_url'])
+        if message['receiver_id'] and not message['is_read']:
+            unread[(message['receiver_id'], message['sender_id'])] += 1
+    
+    counts = {}
+    for (receiver_id, sender_id), removed in unread.items():
+        db.execute(
+            '''UPDATE conversations SET
+                   unread_count = CASE WHEN unread_count > ? THEN unread_count - ? ELSE 0 END
+               WHERE user_id = ? AND peer_id = ?''',
+            (removed, removed, receiver_id, sender_id)
+        )
+        row = db.execute(
+            '''UPDATE users SET unread_messages = CASE WHEN unread_messages > ? THEN unread_messages - ? ELSE 0 END
+               WHERE id = ? RETURNING unread_notifications, unread_messages''',
+            (removed, removed, receiver_id)
+        ).fetchone()
+        if row:
+            counts[receiver_id] = (row[0], row[1])
+    
+    # Conversations whose last message expired fall back to the newest one
+    # left, or drop out of the inbox if there is none
+    placeholders = ', '.join('?' * len(messages))
+    stale = db.execute(
+        f'''UPDATE conversations SET last_message_id = CASE
+               WHEN group_id IS NOT NULL THEN (SELECT MAX(id) FROM messages WHERE group_id = conversations.group_id)
+               ELSE (SELECT MAX(id) FROM messages
+                     WHERE (sender_id = conversations.user_id AND receiver_id = conversations.peer_id)
+                     OR (sender_id = conversations.peer_id AND receiver_id = conversations.user_id))
+           END
+           WHERE last_message_id IN ({placeholders})
+           RETURNING id''',
+        [message['id'] for message in messages]
+    ).fetchall()
+    if stale:
+        placeholders = ', '.join('?' * len(stale))
+        db.execute(
+            f'''UPDATE conversations SET
+                   last_message_at = (SELECT created_at FROM messages WHERE id = conversations.last_message_id),
+                   last_message_preview = (SELECT substr(content, 1, 100) FROM messages
+                                           WHERE id = conversations.last_message_id),
+                   last_activity = (SELECT created_at FROM messages WHERE id = conversations.last_message_id)
+               WHERE id IN ({placeholders})''',
+            [row[0] for row in stale]
+        )
+    return len(messages), counts
+
+def purge_expired(batch_size):
+    """Purge everything expired so far, one committed batch at a time.
+    
+    Returns the number of (stories, messages) deleted.
+    """
+    now = utc_timestamp()
+    stories = messages = 0
+    with app.app_context():
+        db = get_db()
+        while True:
+            purged = purge_expired_stories(db, now, batch_size)
+            db.commit()
+            stories += purged
+            if purged < batch_size:
+                break
+        while True:
+            purged, counts = purge_expired_messages(db, now, batch_size)
+            db.commit()
+            messages += purged
+            for user_id, (notifications, unread_messages) in counts.items():
+                publish_event(user_id, 'unread', store_unread_counts(user_id, notifications, unread_messages))
+            if purged < batch_size:
+                break
+    return stories, messages
+
+class ExpiryScheduler:
+    """Runs purge_expired every interval seconds on a daemon thread."""
+    
+    def __init__(self, interval, batch_size):
+        self._interval = interval
+        self._batch_size = batch_size
+        self._thread = threading.Thread(target=self._run, daemon=True)
+    
+    def start(self):
+        self._thread.start()
+    
+    def _run(self):
+        while True:
+            try:
+                purge_expired(self._batch_size)
+            except Exception:
+                app.logger.exception('Expiry purge failed')
+            time.sleep(self._interval)
+
+_expiry_scheduler = None
+_expiry_scheduler_pid = None
+
+def get_expiry_scheduler():
+    global _expiry_scheduler, _expiry_scheduler_pid
+    with _pool_lock:
+        if _expiry_scheduler_pid != os.getpid():
+            _expiry_scheduler = ExpiryScheduler(app.config['EXPIRY_INTERVAL'], app.config['EXPIRY_BATCH_SIZE'])
+            if app.config['EXPIRY_INTERVAL']:
+                _expiry_scheduler.start()
+            _expiry_scheduler_pid = os.getpid()
+        return _expiry_scheduler
+
+@app.before_request
+def start_expiry_scheduler():
+    # Each worker process starts its own scheduler with its first request
+    if _expiry_scheduler_pid != os.getpid():
+        get_expiry_scheduler()
+
+# Profile stats. user_stats holds each user's follower, following, friend,
+# post and received-like totals, adjusted in the same transaction as the
+# write that changes them, with a per-worker TTL cache in front. Users
+# without a row yet have all-zero stats.
+USER_STATS_FIELDS = ('followers_count', 'following_count', 'friends_count', 'posts_count', 'likes_count')
+user_stats_cache = TTLCache(app.config['USER_STATS_CACHE_SIZE'], app.config['USER_STATS_CACHE_TTL'])
+
+USER_STATS_SQL = f'SELECT {", ".join(USER_STATS_FIELDS)} FROM user_stats WHERE user_id = ?'
+
+def get_user_stats(db, user_id):
+    stats = user_stats_cache.get(int(user_id))
+    if stats is None:
+        row = db.execute(USER_STATS_SQL, (user_id,)).fetchone()
+        stats = dict(row) if row else dict.fromkeys(USER_STATS_FIELDS, 0)
+        user_stats_cache.set(int(user_id), stats)
+    return stats
+
+def adjust_user_stats(db, user_id, **deltas):
+    """Add deltas (keyed by USER_STATS_FIELDS) to user_id's stats.
+    
+    Runs in the caller's transaction; the cached copy is evicted once the
+    caller has committed.
+    """
+    columns = ', '.join(deltas)
+    updates = ', '.join(f'{column} = user_stats.{column} + excluded.{column}' for column in deltas)
+    db.execute(
+        f'''INSERT INTO user_stats (user_id, {columns}) VALUES (?, {', '.join('?' * len(deltas))})
+           ON CONFLICT (user_id) DO UPDATE SET {updates}''',
+        (user_id, *deltas.values())
+    )
+    # Evicting before the commit would let another thread cache the old row again
+    db.after_commit(user_stats_cache.delete, int(user_id))
+
 # User routes
+PROFILE_USER_SQL = """
+    SELECT u.*,
+    EXISTS(SELECT 1 FROM followers WHERE follower_id = ? AND followed_id = u.id AND status = 'accepted') as is_following
+    FROM users u WHERE u.id = ?
+"""
+
 @app.route('/api/user/profile', methods=['GET'])
 @login_required
 def get_user_profile():
@@ -460,74 +2136,31 @@ def get_user_profile():
     
     db = get_db()
     user = db.execute(
-        'SELECT * FROM users WHERE id = ?', (user_id,)
+        PROFILE_USER_SQL,
+        (session['user_id'], user_id)
     ).fetchone()
     
     if not user:
         return jsonify({'error': 'User not found'}), 404
     
-    # Get counts
-    followers_count = db.execute(
-        'SELECT COUNT(*) FROM followers WHERE followed_id = ? AND status = "accepted"', (user_id,)
-    ).fetchone()[0]
-    
-    following_count = db.execute(
-        'SELECT COUNT(*) FROM followers WHERE follower_id = ? AND status = "accepted"', (user_id,)
-    ).fetchone()[0]
-    
-    friends_count = db.execute(
-        'SELECT COUNT(*) FROM friends WHERE user1_id = ? OR user2_id = ?', (user_id, user_id)
-    ).fetchone()[0]
-    
-    posts_count = db.execute(
-        'SELECT COUNT(*) FROM posts WHERE user_id = ?', (user_id,)
-    ).fetchone()[0]
-    
-    likes_count = db.execute(
-        '''SELECT COUNT(*) FROM likes 
-           WHERE post_id IN (SELECT id FROM posts WHERE user_id = ?) 
-           OR reel_id IN (SELECT id FROM reels WHERE user_id = ?)''',
-        (user_id, user_id)
-    ).fetchone()[0]
+    # Counts come from user_stats, usually straight from the cache
+    stats = get_user_stats(db, user['id'])
     
     # Check if current user is following this user
-    is_following = False
-    if str(user_id) != str(session['user_id']):
-        follow = db.execute(
-            'SELECT * FROM followers WHERE follower_id = ? AND followed_id = ? AND status = "accepted"',
-            (session['user_id'], user_id)
-        ).fetchone()
-        is_following = follow is not None
+    is_following = bool(user['is_following']) and user['id'] != session['user_id']
     
     # Check if users are friends
-    is_friend = db.execute(
-        '''SELECT * FROM friends 
-           WHERE (user1_id = ? AND user2_id = ?) 
-           OR (user1_id = ? AND user2_id = ?)''',
-        (session['user_id'], user_id, user_id, session['user_id'])
-    ).fetchone()
-    is_friend = is_friend is not None
+    is_friend = social_graph.are_friends(db, session['user_id'], user_id)
     
     # Get mutual friends
-    mutual_friends = db.execute(
-        '''SELECT u.* FROM users u
-           JOIN friends f1 ON (f1.user1_id = u.id OR f1.user2_id = u.id)
-           JOIN friends f2 ON (f2.user1_id = u.id OR f2.user2_id = u.id)
-           WHERE (f1.user1_id = ? OR f1.user2_id = ?)
-           AND (f2.user1_id = ? OR f2.user2_id = ?)
-           AND u.id != ? AND u.id != ?''',
-        (session['user_id'], session['user_id'], user_id, user_id, session['user_id'], user_id)
-    ).fetchall()
+    mutual_count, mutual_friends = social_graph.mutual_friend_summaries(db, session['user_id'], user_id, 3)
     
     user_data = dict(user)
-    user_data['followers_count'] = followers_count
-    user_data['following_count'] = following_count
-    user_data['friends_count'] = friends_count
-    user_data['posts_count'] = posts_count
-    user_data['likes_count'] = likes_count
+    user_data.update(stats)
     user_data['is_following'] = is_following
     user_data['is_friend'] = is_friend
-    user_data['mutual_friends'] = [dict(friend) for friend in mutual_friends[:3]]  # First 3 mutual friends
+    user_data['mutual_friends'] = mutual_friends  # First 3 mutual friends
+    user_data['mutual_friends_count'] = mutual_count
     
     return jsonify(user_data)
 
@@ -562,8 +2195,13 @@ def update_user_profile():
         values.append(session['user_id'])
         query = f'UPDATE users SET {", ".join(update_fields)} WHERE id = ?'
         db.execute(query, values)
+        if data.keys() & {'location', 'university', 'secondary_school'}:
+            queue_friend_suggestions(db, [session['user_id']])
         db.commit()
         
+        get_object_cache().delete('user', session['user_id'])
+        if 'username' in data or 'real_name' in data:
+            refresh_suggestions(db, session['user_id'])
         if 'username' in data:
             session['username'] = data['username']
     
@@ -579,50 +2217,651 @@ def upload_profile_pic():
     if file.filename == '':
         return jsonify({'error': 'No file selected'}), 400
     
-    # Generate unique filename
-    filename = f"profile_{session['user_id']}_{datetime.now().strftime('%Y%m%d%H%M%S')}.{file.filename.split('.')[-1]}"
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], 'profiles', filename)
-    file.save(filepath)
+    filename = save_upload(file)
     
     # Update database
     db = get_db()
+    previous = db.execute(
+        'SELECT profile_pic FROM users WHERE id = ?', (session['user_id'],)
+    ).fetchone()
     db.execute(
         'UPDATE users SET profile_pic = ? WHERE id = ?',
         (filename, session['user_id'])
     )
+    release_media(db, previous['profile_pic'])
     db.commit()
+    get_object_cache().delete('user', session['user_id'])
+    refresh_suggestions(db, session['user_id'])
     
     return jsonify({'success': True, 'filename': filename})
 
+# Object cache. Post bodies and user summary cards are cached by ID, so feed
+# routes select only IDs, counters and ordering columns and multi-get the
+# rest. Each worker keeps its own LRU unless OBJECT_CACHE_URL points at a
+# shared Redis; either way, writes that change an object delete its entry.
+# Local deletes are broadcast over the PUBSUB_URL broker; without one, other
+# workers can't hear them and keep entries for OBJECT_CACHE_UNSYNCED_TTL at most.
+# Counters are never cached: they change on every like.
+class ObjectCache:
+    """Per-worker LRU of objects keyed by (namespace, id), with hit/miss counts."""
+    
+    def __init__(self, maxsize, ttl, broker=None):
+        self._entries = TTLCache(maxsize, ttl)
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._broker = broker
+        if broker is not None:
+            broker.on_invalidate(self._invalidated)
+    
+    def get_many(self, namespace, ids):
+        found = self._get_many(namespace, ids)
+        with self._lock:
+            stats = self._stats.setdefault(namespace, {'hits': 0, 'misses': 0})
+            stats['hits'] += len(found)
+            stats['misses'] += len(ids) - len(found)
+        return found
+    
+    def set_many(self, namespace, objects):
+        if objects:
+            self._set_many(namespace, objects)
+    
+    def delete(self, namespace, object_id):
+        self._delete(namespace, int(object_id))
+        if self._broker is not None:
+            self._broker.invalidate(namespace, int(object_id))
+    
+    def _invalidated(self, namespace, object_id):
+        if namespace is None:
+            self._entries.clear()
+        else:
+            self._delete(namespace, object_id)
+    
+    def stats(self):
+        with self._lock:
+            return {
+                namespace: dict(stats, hit_rate=stats['hits'] / ((stats['hits'] + stats['misses']) or 1))
+                for namespace, stats in self._stats.items()
+            }
+    
+    def _get_many(self, namespace, ids):
+        found = {}
+        for object_id in ids:
+            value = self._entries.get((namespace, object_id))
+            if value is not None:
+                found[object_id] = value
+        return found
+    
+    def _set_many(self, namespace, objects):
+        for object_id, value in objects.items():
+            self._entries.set((namespace, object_id), value)
+    
+    def _delete(self, namespace, object_id):
+        self._entries.delete((namespace, object_id))
+
+# Cached rows are stored in Redis as JSON, with timestamps tagged so they
+# come back as the datetimes the database returned
+def encode_cached_datetime(value):
+    if isinstance(value, datetime):
+        return {'$datetime': value.isoformat()}
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+def decode_cached_datetime(obj):
+    if len(obj) == 1 and '$datetime' in obj:
+        return datetime.fromisoformat(obj['$datetime'])
+    return obj
+
+class RedisObjectCache(ObjectCache):
+    """Keeps the objects in Redis so every worker shares them and their invalidations."""
+    
+    prefix = 'sociafam:objects'
+    
+    def __init__(self, url, ttl):
+        super().__init__(0, ttl)
+        self._redis = redis.Redis.from_url(url)
+        self._ttl = ttl
+    
+    def _key(self, namespace, object_id):
+        return f'{self.prefix}:{namespace}:{object_id}'
+    
+    def _get_many(self, namespace, ids):
+        if not ids:
+            return {}
+        values = self._redis.mget([self._key(namespace, object_id) for object_id in ids])
+        return {
+            object_id: json.loads(value, object_hook=decode_cached_datetime)
+            for object_id, value in zip(ids, values) if value is not None
+        }
+    
+    def _set_many(self, namespace, objects):
+        pipe = self._redis.pipeline(transaction=False)
+        for object_id, value in objects.items():
+            pipe.set(self._key(namespace, object_id), json.dumps(value, default=encode_cached_datetime), ex=self._ttl)
+        pipe.execute()
+    
+    def _delete(self, namespace, object_id):
+        self._redis.delete(self._key(namespace, object_id))
+
+_object_cache = None
+_object_cache_pid = None
+
+def get_object_cache():
+    global _object_cache, _object_cache_pid
+    broker = get_broker()
+    with _pool_lock:
+        if _object_cache_pid != os.getpid():
+            if app.config['OBJECT_CACHE_URL']:
+                if redis is None:
+                    raise RuntimeError('OBJECT_CACHE_URL requires the redis package')
+                _object_cache = RedisObjectCache(app.config['OBJECT_CACHE_URL'], app.config['OBJECT_CACHE_TTL'])
+            elif broker.shared:
+                _object_cache = ObjectCache(app.config['OBJECT_CACHE_SIZE'], app.config['OBJECT_CACHE_TTL'], broker)
+            else:
+                _object_cache = ObjectCache(
+                    app.config['OBJECT_CACHE_SIZE'],
+                    min(app.config['OBJECT_CACHE_TTL'], app.config['OBJECT_CACHE_UNSYNCED_TTL'])
+                )
+            _object_cache_pid = os.getpid()
+        return _object_cache
+
+def variants_pending(path, variant):
+    # Images whose variants are still being generated are not cached, so
+    # the variant shows up as soon as it exists
+    return variant is None and Image is not None and media_type_of(path or '') == 'image'
+
+def load_objects(db, namespace, ids, sql, pending):
+    """Multi-get objects by ID, reading misses with sql (an IN query on ids)."""
+    ids = list(dict.fromkeys(ids))
+    cache = get_object_cache()
+    objects = cache.get_many(namespace, ids)
+    missing = [object_id for object_id in ids if object_id not in objects]
+    if missing:
+        placeholders = ', '.join('?' * len(missing))
+        loaded = {row['id']: dict(row) for row in db.execute(sql.format(placeholders), missing).fetchall()}
+        cache.set_many(namespace, {
+            object_id: value for object_id, value in loaded.items() if not pending(value)
+        })
+        objects.update(loaded)
+    return objects
+
+def get_user_cards(db, user_ids):
+    return load_objects(
+        db, 'user', user_ids,
+        f'''SELECT u.id, u.username, u.real_name, u.profile_pic, {profile_pic_thumb_column()}
+            FROM users u WHERE u.id IN ({{}})''',
+        lambda card: variants_pending(card['profile_pic'], card['profile_pic_thumb'])
+    )
+
+def get_post_bodies(db, post_ids):
+    return load_objects(
+        db, 'post', post_ids,
+        f'''SELECT p.id, p.user_id, p.content_type, p.content, p.description, p.visibility, p.created_at,
+            {media_variant_columns('p.content', 'post')}
+            FROM posts p WHERE p.id IN ({{}})''',
+        lambda body: body['content_type'] == 'image' and variants_pending(body['content'], body['media_display'])
+    )
+
+POST_ROW_COLUMNS = 'p.id, p.user_id, p.likes_count, p.comments_count, p.reposts_count, p.saves_count'
+
+def with_user_cards(db, rows):
+    """Return rows as dicts with their author's (user_id's) summary card merged in."""
+    cards = get_user_cards(db, [row['user_id'] for row in rows])
+    items = []
+    for row in rows:
+        card = cards.get(row['user_id'])
+        if card:
+            items.append(dict(row, username=card['username'], real_name=card['real_name'],
+                              profile_pic=card['profile_pic'], profile_pic_thumb=card['profile_pic_thumb']))
+    return items
+
+def assemble_posts(db, rows):
+    """Combine rows of POST_ROW_COLUMNS (plus any extras) with cached bodies and cards."""
+    bodies = get_post_bodies(db, [row['id'] for row in rows])
+    return with_user_cards(db, [dict(bodies[row['id']], **dict(row)) for row in rows if row['id'] in bodies])
+
+# Home timeline. Posts and reposts are pushed into each accepted follower's
+# timeline when they are written, so reading the feed is a slice of one
+# pre-sorted index. Accounts above FANOUT_FOLLOWER_THRESHOLD are skipped on
+# write (posts.fanned_out or reposts.fanned_out is FALSE) and pulled in when
+# the feed is read instead. A timeline row records the one account that put
+# it there; removing that account's rows re-adds any post another followed
+# account still puts there.
+def accepted_follower_count(db, user_id):
+    return db.execute(
+        "SELECT COUNT(*) FROM followers WHERE followed_id = ? AND status = 'accepted'", (user_id,)
+    ).fetchone()[0]
+
+def fan_out_post(db, post_id, actor_id, created_at):
+    """Push a post into the timelines of actor_id's accepted followers."""
+    db.execute(
+        '''INSERT INTO timeline (user_id, post_id, actor_id, created_at)
+           SELECT follower_id, ?, ?, ? FROM followers
+           WHERE followed_id = ? AND status = 'accepted'
+           ON CONFLICT DO NOTHING''',
+        (post_id, actor_id, created_at, actor_id)
+    )
+
+def backfill_timeline(db, follower_id, followed_id):
+    """Copy followed_id's recent fanned-out posts into a new follower's timeline."""
+    db.execute(
+        '''INSERT INTO timeline (user_id, post_id, actor_id, created_at)
+           SELECT ?, id, user_id, created_at FROM posts
+           WHERE user_id = ? AND fanned_out = TRUE
+           ORDER BY created_at DESC
+           LIMIT ?
+           ON CONFLICT DO NOTHING''',
+        (follower_id, followed_id, app.config['TIMELINE_BACKFILL_LIMIT'])
+    )
+
+def refill_timeline(db, removed):
+    """Re-add removed (user_id, post_id) entries still authored or reposted by a followed account."""
+    if not removed:
+        return
+    db.executemany(
+        '''INSERT INTO timeline (user_id, post_id, actor_id, created_at)
+           SELECT f.follower_id, p.id, p.user_id, p.created_at
+           FROM followers f JOIN posts p ON p.user_id = f.followed_id AND p.fanned_out = TRUE
+           WHERE f.follower_id = ? AND f.status = 'accepted' AND p.id = ?
+           ON CONFLICT DO NOTHING''',
+        removed
+    )
+    db.executemany(
+        '''INSERT INTO timeline (user_id, post_id, actor_id, created_at)
+           SELECT f.follower_id, r.original_post_id, r.user_id, r.created_at
+           FROM reposts r JOIN followers f ON f.followed_id = r.user_id AND f.status = 'accepted'
+           WHERE f.follower_id = ? AND r.original_post_id = ? AND r.fanned_out = TRUE
+           ON CONFLICT DO NOTHING''',
+        removed
+    )
+
+# Viewer state. Feed queries return the same base rows to every viewer and
+# hydrate_viewer_state overlays the viewer's flags on a page of items, with
+# one IN query per relation. Which items a viewer has liked, saved or
+# reposted is cached per worker for VIEWER_STATE_CACHE_TTL seconds as the
+# hits among the IDs checked so far, so paging through a feed only queries
+# items it hasn't seen yet.
+VIEWER_RELATIONS = {
+    'liked': ('likes', {'post': 'post_id', 'reel': 'reel_id'}),
+    'saved': ('saved_items', {'post': 'post_id', 'reel': 'reel_id'}),
+    'reposted': ('reposts', {'post': 'original_post_id', 'reel': 'original_reel_id'}),
+}
+viewer_state_cache = TTLCache(app.config['VIEWER_STATE_CACHE_SIZE'], app.config['VIEWER_STATE_CACHE_TTL'])
+
+def viewer_relation_ids(db, viewer_id, relation, kind, ids):
+    """Return which of ids (of posts or reels, per kind) the viewer has in relation."""
+    key = (int(viewer_id), relation, kind)
+    entry = viewer_state_cache.get(key)
+    # Entries are extended in place rather than refreshed, so each one is
+    # dropped VIEWER_STATE_CACHE_TTL seconds after its first query
+    if entry is None or time.monotonic() - entry[0] > app.config['VIEWER_STATE_CACHE_TTL']:
+        entry = (time.monotonic(), frozenset(), frozenset())
+    started, checked, hits = entry
+    
+    missing = sorted(set(ids) - checked)
+    if missing:
+        table, columns = VIEWER_RELATIONS[relation]
+        column = columns[kind]
+        placeholders = ', '.join('?' * len(missing))
+        found = db.execute(
+            f'SELECT {column} FROM {table} WHERE user_id = ? AND {column} IN ({placeholders})',
+            (viewer_id, *missing)
+        ).fetchall()
+        checked = checked.union(missing)
+        hits = hits.union(row[0] for row in found)
+        viewer_state_cache.set(key, (started, checked, hits))
+    return hits
+
+def record_viewer_state(viewer_id, relation, kind, item_id, present):
+    """Update a cached relation after the viewer toggles it on item_id."""
+    key = (int(viewer_id), relation, kind)
+    entry = viewer_state_cache.get(key)
+    if entry is not None:
+        started, checked, hits = entry
+        hits = hits | {item_id} if present else hits - {item_id}
+        viewer_state_cache.set(key, (started, checked | {item_id}, hits))
+
+def hydrate_viewer_state(db, viewer_id, rows, kind='post'):
+    """Return rows as dicts carrying viewer_id's flags for each post or reel."""
+    items = [dict(row) for row in rows]
+    if not items:
+        return items
+    
+    ids = [item['id'] for item in items]
+    liked = viewer_relation_ids(db, viewer_id, 'liked', kind, ids)
+    saved = viewer_relation_ids(db, viewer_id, 'saved', kind, ids)
+    reposted = viewer_relation_ids(db, viewer_id, 'reposted', kind, ids)
+    following = get_following_ids(db, viewer_id)
+    
+    authors = sorted({item['user_id'] for item in items})
+    placeholders = ', '.join('?' * len(authors))
+    blocked = {
+        row[0] for row in db.execute(
+            f'SELECT blocked_id FROM blocks WHERE blocker_id = ? AND blocked_id IN ({placeholders})',
+            (viewer_id, *authors)
+        ).fetchall()
+    }
+    
+    for item in items:
+        item['is_liked'] = item['id'] in liked
+        item['is_saved'] = item['id'] in saved
+        item['is_reposted'] = item['id'] in reposted
+        item['is_following_author'] = item['user_id'] in following
+        item['is_author_blocked'] = item['user_id'] in blocked
+    return items
+
+# Write-behind likes and saves. With LIKE_WRITE_BEHIND on, a toggle flips an
+# in-memory state for (relation, post, user) and answers with the stored
+# counter plus the pending changes, so a viral post no longer queues a write
+# transaction per like. A background thread writes the final states in one
+# transaction every LIKE_FLUSH_INTERVAL seconds. Every toggle is appended to
+# a per-worker journal first, fsynced in groups before the toggle returns
+# (LIKE_JOURNAL_FSYNC); journals left by a crashed worker are replayed by the
+# next one to start. Each entry carries the state its key had when it was
+# first buffered, and replay skips keys that have changed since, so a journal
+# never overwrites newer writes.
+#
+# The in-memory states are only right while one process writes engagement:
+# as soon as another worker is running, every worker hands its pending states
+# to the database and toggles synchronously until it is alone again.
+ENGAGEMENT_TABLES = {'like': ('likes', 'likes_count'), 'save': ('saved_items', 'saves_count')}
+
+def apply_engagement(db, states):
+    """Write final {(relation, post_id, user_id): present} states; returns rows changed."""
+    deltas = Counter()
+    for (relation, post_id, user_id), present in states.items():
+        table = ENGAGEMENT_TABLES[relation][0]
+        if present:
+            changed = db.execute(
+                f'''INSERT INTO {table} (user_id, post_id)
+                    SELECT ?, ? WHERE EXISTS (SELECT 1 FROM posts WHERE id = ?)
+                    AND NOT EXISTS (SELECT 1 FROM {table} WHERE post_id = ? AND user_id = ?)''',
+                (user_id, post_id, post_id, post_id, user_id)
+            ).rowcount
+        else:
+            changed = -db.execute(
+                f'DELETE FROM {table} WHERE post_id = ? AND user_id = ?', (post_id, user_id)
+            ).rowcount
+        deltas[(relation, post_id)] += changed
+    
+    for (relation, post_id), delta in deltas.items():
+        if not delta:
+            continue
+        counter = ENGAGEMENT_TABLES[relation][1]
+        post = db.execute(
+            f'UPDATE posts SET {counter} = {counter} + ? WHERE id = ? RETURNING user_id', (delta, post_id)
+        ).fetchone()
+        if post and relation == 'like':
+            adjust_user_stats(db, post['user_id'], likes_count=delta)
+    return sum(abs(delta) for delta in deltas.values())
+
+def engagement_present(db, relation, post_id, user_id):
+    table = ENGAGEMENT_TABLES[relation][0]
+    return db.execute(
+        f'SELECT 1 FROM {table} WHERE post_id = ? AND user_id = ?', (post_id, user_id)
+    ).fetchone() is not None
+
+def read_journal(path):
+    """Return {(relation, post_id, user_id): (stored, present)} from a journal."""
+    states = {}
+    with open(path) as journal:
+        for line in journal:
+            try:
+                relation, post_id, user_id, stored, present = json.loads(line)
+            except ValueError:
+                break  # a write torn by the crash ends the journal
+            states[(relation, post_id, user_id)] = (stored, present)
+    return states
+
+class EngagementBuffer:
+    """Applies like/save toggles in memory and writes them behind in batches."""
+    
+    def __init__(self, interval, journal_dir, fsync=True):
+        self._interval = interval
+        self._journal_dir = journal_dir
+        self._fsync = fsync
+        self._lock = threading.Lock()
+        self._pending = {}  # (relation, post_id, user_id) -> [stored, present]
+        self._deltas = Counter()  # (relation, post_id) -> pending counter change
+        self._thread = None
+        self._written = 0  # journal entries written, and of those fsynced
+        self._synced = 0
+        self._sync_lock = threading.Lock()
+        
+        os.makedirs(journal_dir, exist_ok=True)
+        # Every worker holds a shared lock on workers.lock while it runs, so
+        # one that can take it exclusively is the only one
+        self._workers = open(os.path.join(journal_dir, 'workers.lock'), 'a+')
+        fcntl.lockf(self._workers, fcntl.LOCK_SH)
+        self.replay()
+        # The lock marks the journal as live for as long as this worker runs
+        self._journal = open(os.path.join(journal_dir, f'{os.getpid()}.journal'), 'a')
+        fcntl.flock(self._journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    
+    def _alone(self):
+        try:
+            fcntl.lockf(self._workers, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        fcntl.lockf(self._workers, fcntl.LOCK_SH)
+        return True
+    
+    def replay(self):
+        """Apply the journals of workers that exited without flushing."""
+        for name in sorted(os.listdir(self._journal_dir)):
+            if not name.endswith('.journal'):
+                continue
+            path = os.path.join(self._journal_dir, name)
+            with open(path, 'a') as journal:
+                try:
+                    fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue  # its worker is still running
+                entries = read_journal(path)
+                if entries:
+                    with app.app_context():
+                        db = get_db()
+                        # Keys written since the journal's worker buffered them
+                        # keep the newer state
+                        states = {
+                            key: present for key, (stored, present) in entries.items()
+                            if engagement_present(db, *key) == stored
+                        }
+                        changed = apply_engagement(db, states)
+                        db.commit()
+                    app.logger.info(
+                        'Replayed %s: %d changes, %d superseded keys skipped',
+                        name, changed, len(entries) - len(states)
+                    )
+                os.remove(path)
+    
+    def toggle(self, db, relation, post_id, user_id):
+        """Flip user_id's like or save of post_id; returns (present, counter).
+        
+        Returns None instead, having written out this worker's pending states,
+        when other workers are running; the caller then writes synchronously.
+        """
+        table, counter = ENGAGEMENT_TABLES[relation]
+        key = (relation, int(post_id), int(user_id))
+        with self._lock:
+            if not self._alone():
+                if self._pending:
+                    self._write_pending(db)
+                shared = True
+            else:
+                shared = False
+                entry = self._pending.get(key)
+                if entry is None:
+                    stored = engagement_present(db, relation, post_id, user_id)
+                    entry = self._pending[key] = [stored, stored]
+                entry[1] = not entry[1]
+                self._deltas[key[:2]] += 1 if entry[1] else -1
+                self._journal.write(json.dumps([*key, *entry]) + '\n')
+                self._journal.flush()
+                self._written += 1
+                written = self._written
+                
+                count = db.execute(f'SELECT {counter} FROM posts WHERE id = ?', (post_id,)).fetchone()[0]
+                count += self._deltas[key[:2]]
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, daemon=True)
+                    self._thread.start()
+        if shared:
+            self._await_other_journals()
+            return None
+        self._sync_journal(written)
+        return entry[1], count
+    
+    def _sync_journal(self, written):
+        # Group commit: one fsync covers every entry written before it began
+        if not self._fsync:
+            return
+        with self._sync_lock:
+            if self._synced >= written:
+                return
+            target = self._written
+            os.fsync(self._journal.fileno())
+            self._synced = target
+    
+    def _await_other_journals(self):
+        # Synchronous toggles must not read a state another worker still
+        # holds in memory; those workers write it out within an interval
+        deadline = time.monotonic() + 4 * self._interval + 1
+        own = os.path.basename(self._journal.name)
+        while True:
+            pending = False
+            for name in os.listdir(self._journal_dir):
+                if name.endswith('.journal') and name != own:
+                    try:
+                        pending = pending or os.path.getsize(os.path.join(self._journal_dir, name)) > 0
+                    except FileNotFoundError:
+                        pass
+            if not pending:
+                return
+            if time.monotonic() > deadline:
+                app.logger.warning('Other workers still hold buffered likes; writing anyway')
+                return
+            # A crashed worker's journal never empties by itself
+            self.replay()
+            time.sleep(0.01)
+    
+    def _run(self):
+        while True:
+            time.sleep(self._interval)
+            try:
+                self.flush()
+            except Exception:
+                app.logger.exception('Like flush failed')
+    
+    def _write_pending(self, db):
+        # Called with the lock held
+        states = {key: entry[1] for key, entry in self._pending.items() if entry[0] != entry[1]}
+        if states:
+            apply_engagement(db, states)
+            db.commit()
+        self._pending.clear()
+        self._deltas.clear()
+        self._journal.seek(0)
+        self._journal.truncate()
+    
+    def flush(self):
+        # Toggles wait for the flush, so a count read mid-flush can't include
+        # a change both in the table and in the pending deltas. The connection
+        # is taken first: toggling requests already hold theirs while they wait.
+        with app.app_context():
+            db = get_db()
+            with self._lock:
+                self._write_pending(db)
+
+_engagement_buffer = None
+_engagement_buffer_pid = None
+
+def get_engagement_buffer():
+    global _engagement_buffer, _engagement_buffer_pid
+    with _pool_lock:
+        if _engagement_buffer_pid != os.getpid():
+            if fcntl is None:
+                raise RuntimeError('LIKE_WRITE_BEHIND requires POSIX file locking (fcntl)')
+            _engagement_buffer = EngagementBuffer(
+                app.config['LIKE_FLUSH_INTERVAL'], os.path.join(app.instance_path, 'journal'),
+                app.config['LIKE_JOURNAL_FSYNC']
+            )
+            atexit.register(_engagement_buffer.flush)
+            _engagement_buffer_pid = os.getpid()
+        return _engagement_buffer
+
+# Hot-path statements shared with HOT_QUERIES, so check-query-plans and
+# tests/test_query_plans.py explain exactly what the routes run. {keyset}
+# takes keyset_clause()'s SQL.
+FEED_TIMELINE_SQL = f'''
+    SELECT {POST_ROW_COLUMNS}, t.created_at as timeline_at, t.actor_id as shared_by
+    FROM timeline t
+    JOIN posts p ON p.id = t.post_id
+    WHERE t.user_id = ? {{keyset}}
+    ORDER BY t.created_at DESC, t.post_id DESC
+    LIMIT ?
+'''
+
+FEED_PULLED_POSTS_SQL = f'''
+    SELECT {POST_ROW_COLUMNS}, p.created_at as timeline_at, p.user_id as shared_by
+    FROM followers f
+    JOIN posts p ON p.user_id = f.followed_id AND p.fanned_out = FALSE
+    WHERE f.follower_id = ? AND f.status = 'accepted' {{keyset}}
+    ORDER BY p.created_at DESC, p.id DESC
+    LIMIT ?
+'''
+
+FEED_PULLED_REPOSTS_SQL = f'''
+    SELECT {POST_ROW_COLUMNS}, r.created_at as timeline_at, r.user_id as shared_by
+    FROM followers f
+    JOIN reposts r ON r.user_id = f.followed_id AND r.fanned_out = FALSE
+    JOIN posts p ON p.id = r.original_post_id
+    WHERE f.follower_id = ? AND f.status = 'accepted' {{keyset}}
+    ORDER BY r.created_at DESC, r.original_post_id DESC
+    LIMIT ?
+'''
+
 # Posts routes
 @app.route('/api/posts', methods=['GET'])
 @login_required
 def get_posts():
-    page = request.args.get('page', 1, type=int)
-    limit = request.args.get('limit', 10, type=int)
-    offset = (page - 1) * limit
+    page = get_page()
+    limit = get_limit(10)
+    cursor = request.args.get('cursor')
+    offset = (page - 1) * limit if cursor is None else 0
     
     db = get_db()
     
-    # Get posts from users that the current user follows
+    # Pre-sorted slice of the materialized timeline
+    keyset_sql, keyset_params = keyset_clause('t', cursor, id_column='post_id')
     posts = db.execute(
-        '''SELECT p.*, u.username, u.real_name, u.profile_pic,
-           (SELECT COUNT(*) FROM likes WHERE post_id = p.id) as likes_count,
-           (SELECT COUNT(*) FROM comments WHERE post_id = p.id) as comments_count,
-           EXISTS(SELECT 1 FROM likes WHERE post_id = p.id AND user_id = ?) as is_liked,
-           EXISTS(SELECT 1 FROM saved_items WHERE post_id = p.id AND user_id = ?) as is_saved
-           FROM posts p
-           JOIN users u ON p.user_id = u.id
-           WHERE p.user_id IN (
-               SELECT followed_id FROM followers 
-               WHERE follower_id = ? AND status = 'accepted'
-           ) OR p.user_id = ?
-           ORDER BY p.created_at DESC
-           LIMIT ? OFFSET ?''',
-        (session['user_id'], session['user_id'], session['user_id'], session['user_id'], limit, offset)
+        FEED_TIMELINE_SQL.format(keyset=keyset_sql),
+        (session['user_id'], *keyset_params, offset + limit + 1)
     ).fetchall()
     
-    return jsonify([dict(post) for post in posts])
+    # Merge in posts from followed accounts that were too large to fan out
+    keyset_sql, keyset_params = keyset_clause('p', cursor)
+    pulled = db.execute(
+        FEED_PULLED_POSTS_SQL.format(keyset=keyset_sql),
+        (session['user_id'], *keyset_params, offset + limit + 1)
+    ).fetchall()
+    
+    keyset_sql, keyset_params = keyset_clause('r', cursor, id_column='original_post_id')
+    pulled += db.execute(
+        FEED_PULLED_REPOSTS_SQL.format(keyset=keyset_sql),
+        (session['user_id'], *keyset_params, offset + limit + 1)
+    ).fetchall()
+    
+    if pulled:
+        # A post can arrive from several sources; show it once, at its newest
+        merged = sorted(posts + pulled, key=lambda row: (row['timeline_at'], row['id']), reverse=True)
+        seen = set()
+        posts = []
+        for row in merged:
+            if row['id'] not in seen:
+                seen.add(row['id'])
+                posts.append(row)
+    
+    page = hydrate_viewer_state(db, session['user_id'], assemble_posts(db, posts[offset:offset + limit + 1]))
+    return paginated_response(page, limit, sort_key='timeline_at')
 
 @app.route('/api/posts/create', methods=['POST'])
 @login_required
@@ -639,14 +2878,23 @@ def create_post():
     if content_type in ['image', 'video'] and 'file' in request.files:
         file = request.files['file']
         if file.filename != '':
-            filename = f"post_{session['user_id']}_{datetime.now().strftime('%Y%m%d%H%M%S')}.{file.filename.split('.')[-1]}"
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], 'posts', filename)
-            file.save(filepath)
+            filename = save_upload(file)
     
+    fanned_out = accepted_follower_count(db, session['user_id']) <= app.config['FANOUT_FOLLOWER_THRESHOLD']
+    post = db.execute(
+        '''INSERT INTO posts (user_id, content_type, content, description, visibility, fanned_out)
+           VALUES (?, ?, ?, ?, ?, ?) RETURNING id, created_at''',
+        (session['user_id'], content_type, filename or content, description, visibility, fanned_out)
+    ).fetchone()
+    
+    # The author always sees their own post
     db.execute(
-        'INSERT INTO posts (user_id, content_type, content, description, visibility) VALUES (?, ?, ?, ?, ?)',
-        (session['user_id'], content_type, filename or content, description, visibility)
+        'INSERT INTO timeline (user_id, post_id, actor_id, created_at) VALUES (?, ?, ?, ?)',
+        (session['user_id'], post['id'], session['user_id'], post['created_at'])
     )
+    if fanned_out:
+        fan_out_post(db, post['id'], session['user_id'], post['created_at'])
+    adjust_user_stats(db, session['user_id'], posts_count=1)
     db.commit()
     
     return jsonify({'success': True})
@@ -655,50 +2903,65 @@ def create_post():
 @login_required
 def get_post(post_id):
     db = get_db()
-    post = db.execute(
-        '''SELECT p.*, u.username, u.real_name, u.profile_pic,
-           (SELECT COUNT(*) FROM likes WHERE post_id = p.id) as likes_count,
-           (SELECT COUNT(*) FROM comments WHERE post_id = p.id) as comments_count,
-           EXISTS(SELECT 1 FROM likes WHERE post_id = p.id AND user_id = ?) as is_liked,
-           EXISTS(SELECT 1 FROM saved_items WHERE post_id = p.id AND user_id = ?) as is_saved
-           FROM posts p
-           JOIN users u ON p.user_id = u.id
-           WHERE p.id = ?''',
-        (session['user_id'], session['user_id'], post_id)
-    ).fetchone()
+    posts = assemble_posts(db, db.execute(
+        f'SELECT {POST_ROW_COLUMNS} FROM posts p WHERE p.id = ?', (post_id,)
+    ).fetchall())
     
-    if not post:
+    if not posts:
         return jsonify({'error': 'Post not found'}), 404
     
-    return jsonify(dict(post))
+    return jsonify(hydrate_viewer_state(db, session['user_id'], posts)[0])
 
 @app.route('/api/posts/<int:post_id>/like', methods=['POST'])
 @login_required
 def like_post(post_id):
     db = get_db()
     
-    # Check if already liked
-    existing_like = db.execute(
-        'SELECT * FROM likes WHERE post_id = ? AND user_id = ?', (post_id, session['user_id'])
+    post = db.execute(
+        'SELECT id, user_id FROM posts WHERE id = ?', (post_id,)
     ).fetchone()
     
-    if existing_like:
-        db.execute(
-            'DELETE FROM likes WHERE post_id = ? AND user_id = ?', (post_id, session['user_id'])
-        )
-        action = 'unliked'
+    if not post:
+        return jsonify({'error': 'Post not found'}), 404
+    
+    buffered = None
+    if app.config['LIKE_WRITE_BEHIND']:
+        buffered = get_engagement_buffer().toggle(db, 'like', post_id, session['user_id'])
+    if buffered is not None:
+        liked, like_count = buffered
+        delta = 1 if liked else -1
+        action = 'liked' if liked else 'unliked'
     else:
-        db.execute(
-            'INSERT INTO likes (user_id, post_id) VALUES (?, ?)', (session['user_id'], post_id)
-        )
-        action = 'liked'
+        # Check if already liked
+        existing_like = db.execute(
+            'SELECT * FROM likes WHERE post_id = ? AND user_id = ?', (post_id, session['user_id'])
+        ).fetchone()
+        
+        if existing_like:
+            db.execute(
+                'DELETE FROM likes WHERE post_id = ? AND user_id = ?', (post_id, session['user_id'])
+            )
+            delta = -1
+            action = 'unliked'
+        else:
+            db.execute(
+                'INSERT INTO likes (user_id, post_id) VALUES (?, ?)', (session['user_id'], post_id)
+            )
+            delta = 1
+            action = 'liked'
+        
+        # Keep the denormalized counter in the same transaction as the like
+        like_count = db.execute(
+            'UPDATE posts SET likes_count = likes_count + ? WHERE id = ? RETURNING likes_count',
+            (delta, post_id)
+        ).fetchone()[0]
+        adjust_user_stats(db, post['user_id'], likes_count=delta)
+        db.commit()
     
-    db.commit()
+    record_viewer_state(session['user_id'], 'liked', 'post', post_id, delta > 0)
     
-    # Get updated like count
-    like_count = db.execute(
-        'SELECT COUNT(*) FROM likes WHERE post_id = ?', (post_id,)
-    ).fetchone()[0]
+    if action == 'liked':
+        notify(post['user_id'], 'like', 'post', post_id)
     
     return jsonify({'action': action, 'like_count': like_count})
 
@@ -711,56 +2974,95 @@ def comment_on_post(post_id):
         return jsonify({'error': 'Comment content is required'}), 400
     
     db = get_db()
+    
+    post = db.execute(
+        'SELECT id, user_id FROM posts WHERE id = ?', (post_id,)
+    ).fetchone()
+    
+    if not post:
+        return jsonify({'error': 'Post not found'}), 404
+    
     db.execute(
         'INSERT INTO comments (user_id, post_id, content) VALUES (?, ?, ?)',
         (session['user_id'], post_id, content)
     )
-    db.commit()
-    
-    # Get comment count
     comment_count = db.execute(
-        'SELECT COUNT(*) FROM comments WHERE post_id = ?', (post_id,)
+        'UPDATE posts SET comments_count = comments_count + 1 WHERE id = ? RETURNING comments_count',
+        (post_id,)
     ).fetchone()[0]
+    db.commit()
+    
+    notify(post['user_id'], 'comment', 'post', post_id)
     
     return jsonify({'success': True, 'comment_count': comment_count})
 
+POST_COMMENTS_SQL = '''
+    SELECT c.*, u.username, u.real_name, u.profile_pic
+    FROM comments c
+    JOIN users u ON c.user_id = u.id
+    WHERE c.post_id = ? {keyset}
+    ORDER BY c.created_at DESC, c.id DESC
+    LIMIT ?
+'''
+
 @app.route('/api/posts/<int:post_id>/comments', methods=['GET'])
 @login_required
 def get_post_comments(post_id):
+    limit = get_limit(50)
+    keyset_sql, keyset_params = keyset_clause('c', request.args.get('cursor'))
+    
     db = get_db()
     comments = db.execute(
-        '''SELECT c.*, u.username, u.real_name, u.profile_pic
-           FROM comments c
-           JOIN users u ON c.user_id = u.id
-           WHERE c.post_id = ?
-           ORDER BY c.created_at DESC''',
-        (post_id,)
+        POST_COMMENTS_SQL.format(keyset=keyset_sql),
+        (post_id, *keyset_params, limit + 1)
     ).fetchall()
     
-    return jsonify([dict(comment) for comment in comments])
+    return paginated_response(comments, limit)
 
 @app.route('/api/posts/<int:post_id>/save', methods=['POST'])
 @login_required
 def save_post(post_id):
     db = get_db()
     
-    # Check if already saved
-    existing_save = db.execute(
-        'SELECT * FROM saved_items WHERE post_id = ? AND user_id = ?', (post_id, session['user_id'])
+    post = db.execute(
+        'SELECT id FROM posts WHERE id = ?', (post_id,)
     ).fetchone()
     
-    if existing_save:
-        db.execute(
-            'DELETE FROM saved_items WHERE post_id = ? AND user_id = ?', (post_id, session['user_id'])
-        )
-        action = 'unsaved'
+    if not post:
+        return jsonify({'error': 'Post not found'}), 404
+    
+    buffered = None
+    if app.config['LIKE_WRITE_BEHIND']:
+        buffered = get_engagement_buffer().toggle(db, 'save', post_id, session['user_id'])
+    if buffered is not None:
+        saved = buffered[0]
+        delta = 1 if saved else -1
+        action = 'saved' if saved else 'unsaved'
     else:
+        # Check if already saved
+        existing_save = db.execute(
+            'SELECT * FROM saved_items WHERE post_id = ? AND user_id = ?', (post_id, session['user_id'])
+        ).fetchone()
+        
+        if existing_save:
+            db.execute(
+                'DELETE FROM saved_items WHERE post_id = ? AND user_id = ?', (post_id, session['user_id'])
+            )
+            delta = -1
+            action = 'unsaved'
+        else:
+            db.execute(
+                'INSERT INTO saved_items (user_id, post_id) VALUES (?, ?)', (session['user_id'], post_id)
+            )
+            delta = 1
+            action = 'saved'
+        
         db.execute(
-            'INSERT INTO saved_items (user_id, post_id) VALUES (?, ?)', (session['user_id'], post_id)
+            'UPDATE posts SET saves_count = saves_count + ? WHERE id = ?', (delta, post_id)
         )
-        action = 'saved'
+        db.commit()
     
-    db.commit()
+    record_viewer_state(session['user_id'], 'saved', 'post', post_id, delta > 0)
     
     return jsonify({'action': action})
 
@@ -786,14 +3088,33 @@ def repost(post_id):
         db.execute(
             'DELETE FROM reposts WHERE original_post_id = ? AND user_id = ?', (post_id, session['user_id'])
         )
+        removed = db.execute(
+            'DELETE FROM timeline WHERE post_id = ? AND actor_id = ? RETURNING user_id, post_id',
+            (post_id, session['user_id'])
+        ).fetchall()
+        refill_timeline(db, [tuple(row) for row in removed])
+        delta = -1
         action = 'unreposted'
     else:
-        db.execute(
-            'INSERT INTO reposts (user_id, original_post_id) VALUES (?, ?)', (session['user_id'], post_id)
-        )
+        # Reposts by accounts above the fan-out threshold are pulled at read time
+        fanned_out = accepted_follower_count(db, session['user_id']) <= app.config['FANOUT_FOLLOWER_THRESHOLD']
+        shared = db.execute(
+            'INSERT INTO reposts (user_id, original_post_id, fanned_out) VALUES (?, ?, ?) RETURNING created_at',
+            (session['user_id'], post_id, fanned_out)
+        ).fetchone()
+        if fanned_out:
+            fan_out_post(db, post_id, session['user_id'], shared['created_at'])
+        delta = 1
         action = 'reposted'
     
+    db.execute(
+        'UPDATE posts SET reposts_count = reposts_count + ? WHERE id = ?', (delta, post_id)
+    )
     db.commit()
+    record_viewer_state(session['user_id'], 'reposted', 'post', post_id, delta > 0)
+    
+    if action == 'reposted':
+        notify(original_post['user_id'], 'repost', 'post', post_id)
     
     return jsonify({'action': action})
 
@@ -810,8 +3131,19 @@ def delete_post(post_id):
     if not post:
         return jsonify({'error': 'Post not found or unauthorized'}), 404
     
+    # Remove the post's engagement rows with it so the counters and the
+    # base tables can't drift apart
+    db.execute('DELETE FROM likes WHERE post_id = ?', (post_id,))
+    db.execute('DELETE FROM comments WHERE post_id = ?', (post_id,))
+    db.execute('DELETE FROM saved_items WHERE post_id = ?', (post_id,))
+    db.execute('DELETE FROM reposts WHERE original_post_id = ?', (post_id,))
+    db.execute('DELETE FROM timeline WHERE post_id = ?', (post_id,))
     db.execute('DELETE FROM posts WHERE id = ?', (post_id,))
+    if post['content_type'] in ('image', 'video'):
+        release_media(db, post['content'])
+    adjust_user_stats(db, session['user_id'], posts_count=-1, likes_count=-post['likes_count'])
     db.commit()
+    get_object_cache().delete('post', post_id)
     
     return jsonify({'success': True})
 
@@ -823,15 +3155,16 @@ def get_stories():
     
     # Get stories from users that the current user follows and that are not expired
     stories = db.execute(
-        '''SELECT s.*, u.username, u.real_name, u.profile_pic
+        f'''SELECT s.*, u.username, u.real_name, u.profile_pic,
+           {media_variant_columns('s.media_url', 'story')}, {profile_pic_thumb_column()}
            FROM stories s
            JOIN users u ON s.user_id = u.id
            WHERE s.user_id IN (
                SELECT followed_id FROM followers 
                WHERE follower_id = ? AND status = 'accepted'
-           ) AND datetime(s.created_at, '+' || s.duration || ' hours') > datetime('now')
+           ) AND s.expires_at > ?
            ORDER BY s.created_at DESC''',
-        (session['user_id'],)
+        (session['user_id'], utc_timestamp())
     ).fetchall()
     
     return jsonify([dict(story) for story in stories])
@@ -846,47 +3179,44 @@ def create_story():
     if file.filename == '':
         return jsonify({'error': 'No file selected'}), 400
     
-    # Determine media type
-    file_ext = file.filename.split('.')[-1].lower()
-    media_type = 'video' if file_ext in ['mp4', 'mov', 'avi', 'mkv'] else 'image'
-    
-    # Generate unique filename
-    filename = f"story_{session['user_id']}_{datetime.now().strftime('%Y%m%d%H%M%S')}.{file_ext}"
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], 'stories', filename)
-    file.save(filepath)
+    filename = save_upload(file)
     
     db = get_db()
-    db.execute(
-        'INSERT INTO stories (user_id, media_url, media_type) VALUES (?, ?, ?)',
-        (session['user_id'], filename, media_type)
-    )
+    insert_story(db, filename)
     db.commit()
     
     return jsonify({'success': True, 'filename': filename})
 
+def insert_story(db, filename):
+    media_type = 'video' if media_type_of(filename) == 'video' else 'image'
+    duration = app.config['STORY_DURATION_HOURS']
+    db.execute(
+        'INSERT INTO stories (user_id, media_url, media_type, duration, expires_at) VALUES (?, ?, ?, ?, ?)',
+        (session['user_id'], filename, media_type, duration, utc_timestamp(duration))
+    )
+
 # Reels routes
 @app.route('/api/reels', methods=['GET'])
 @login_required
 def get_reels():
-    page = request.args.get('page', 1, type=int)
-    limit = request.args.get('limit', 10, type=int)
-    offset = (page - 1) * limit
+    page = get_page()
+    limit = get_limit(10)
+    cursor = request.args.get('cursor')
+    offset = (page - 1) * limit if cursor is None else 0
+    keyset_sql, keyset_params = keyset_clause('r', cursor, keyword='WHERE')
     
     db = get_db()
     reels = db.execute(
-        '''SELECT r.*, u.username, u.real_name, u.profile_pic,
-           (SELECT COUNT(*) FROM likes WHERE reel_id = r.id) as likes_count,
-           (SELECT COUNT(*) FROM comments WHERE reel_id = r.id) as comments_count,
-           EXISTS(SELECT 1 FROM likes WHERE reel_id = r.id AND user_id = ?) as is_liked,
-           EXISTS(SELECT 1 FROM saved_items WHERE reel_id = r.id AND user_id = ?) as is_saved
+        f'''SELECT r.*, {media_variant_columns('r.video_url', 'reel')}
            FROM reels r
-           JOIN users u ON r.user_id = u.id
-           ORDER BY r.created_at DESC
+           {keyset_sql}
+           ORDER BY r.created_at DESC, r.id DESC
            LIMIT ? OFFSET ?''',
-        (session['user_id'], session['user_id'], limit, offset)
+        (*keyset_params, limit + 1, offset)
     ).fetchall()
     
-    return jsonify([dict(reel) for reel in reels])
+    reels = hydrate_viewer_state(db, session['user_id'], with_user_cards(db, reels), 'reel')
+    return paginated_response(reels, limit)
 
 @app.route('/api/reels/create', methods=['POST'])
 @login_required
@@ -900,20 +3230,296 @@ def create_reel():
     
     description = request.form.get('description', '')
     
-    # Generate unique filename
-    filename = f"reel_{session['user_id']}_{datetime.now().strftime('%Y%m%d%H%M%S')}.{file.filename.split('.')[-1]}"
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], 'reels', filename)
-    file.save(filepath)
+    filename = save_upload(file)
     
     db = get_db()
+    insert_reel(db, filename, description)
+    db.commit()
+    
+    return jsonify({'success': True, 'filename': filename})
+
+def insert_reel(db, filename, description):
     db.execute(
         'INSERT INTO reels (user_id, video_url, description) VALUES (?, ?, ?)',
         (session['user_id'], filename, description)
     )
+
+# Chunked uploads. A client opens a session, PUTs the file in chunks at byte
+# offsets (re-sending any chunk that failed, or asking how much arrived after a
+# dropped connection), then finalizes with a SHA-256 checksum. Chunks stream
+# to a part file outside the static folder with constant memory, and the
+# finished file goes through the same path as a regular reel or story upload.
+CHUNKED_UPLOAD_KINDS = ('reel', 'story')
+
+def upload_part_path(upload_id):
+    return os.path.join(app.instance_path, 'uploads', f'{upload_id}.part')
+
+def get_upload_session(db, upload_id):
+    return db.execute(
+        'SELECT * FROM upload_sessions WHERE id = ? AND user_id = ?', (upload_id, session['user_id'])
+    ).fetchone()
+
+def upload_status(upload):
+    return {
+        'upload_id': upload['id'],
+        'received_bytes': upload['received_bytes'],
+        'total_size': upload['total_size'],
+        'chunk_size': app.config['UPLOAD_CHUNK_SIZE'],
+    }
+
+@app.route('/api/uploads/init', methods=['POST'])
+@login_required
+def init_upload():
+    kind = request.form.get('kind')
+    filename = request.form.get('filename', '')
+    total_size = request.form.get('size', type=int)
+    
+    if kind not in CHUNKED_UPLOAD_KINDS:
+        return jsonify({'error': 'kind must be reel or story'}), 400
+    if not filename or total_size is None or not 0 < total_size <= app.config['UPLOAD_MAX_SIZE']:
+        return jsonify({'error': 'A filename and a valid size are required'}), 400
+    
+    upload_id = uuid.uuid4().hex
+    os.makedirs(os.path.dirname(upload_part_path(upload_id)), exist_ok=True)
+    open(upload_part_path(upload_id), 'wb').close()
+    
+    db = get_db()
+    upload = db.execute(
+        '''INSERT INTO upload_sessions (id, user_id, kind, filename, total_size, sha256, description)
+           VALUES (?, ?, ?, ?, ?, ?, ?) RETURNING *''',
+        (upload_id, session['user_id'], kind, filename, total_size,
+         request.form.get('sha256'), request.form.get('description', ''))
+    ).fetchone()
+    db.commit()
+    
+    return jsonify(upload_status(upload))
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+@login_required
+def get_upload(upload_id):
+    upload = get_upload_session(get_db(), upload_id)
+    if not upload:
+        return jsonify({'error': 'Upload not found'}), 404
+    return jsonify(upload_status(upload))
+
+@app.route('/api/uploads/<upload_id>', methods=['PUT'])
+@login_required
+def append_upload_chunk(upload_id):
+    offset = request.args.get('offset', type=int)
+    length = request.content_length
+    
+    db = get_db()
+    upload = get_upload_session(db, upload_id)
+    if not upload:
+        return jsonify({'error': 'Upload not found'}), 404
+    
+    # Chunks may be re-sent, but must not leave a gap or run past the end
+    if offset is None or length is None or not 0 <= offset <= upload['received_bytes']:
+        return jsonify({'error': 'Chunk offset must be at most the received byte count'}), 400
+    if length > app.config['UPLOAD_CHUNK_SIZE'] or offset + length > upload['total_size']:
+        return jsonify({'error': 'Chunk is too large'}), 400
+    
+    written = 0
+    with open(upload_part_path(upload_id), 'r+b') as part:
+        part.seek(offset)
+        while True:
+            block = request.stream.read(64 * 1024)
+            if not block:
+                break
+            part.write(block)
+            written += len(block)
+    if written != length:
+        return jsonify({'error': 'Incomplete chunk'}), 400
+    
+    upload = db.execute(
+        '''UPDATE upload_sessions SET
+               received_bytes = CASE WHEN received_bytes > ? THEN received_bytes ELSE ? END,
+               updated_at = CURRENT_TIMESTAMP
+           WHERE id = ? RETURNING *''',
+        (offset + written, offset + written, upload_id)
+    ).fetchone()
+    db.commit()
+    
+    return jsonify(upload_status(upload))
+
+@app.route('/api/uploads/<upload_id>/finalize', methods=['POST'])
+@login_required
+def finalize_upload(upload_id):
+    db = get_db()
+    upload = get_upload_session(db, upload_id)
+    if not upload:
+        return jsonify({'error': 'Upload not found'}), 404
+    
+    expected = (request.form.get('sha256') or upload['sha256'] or '').lower()
+    if not expected:
+        return jsonify({'error': 'A sha256 checksum is required'}), 400
+    if upload['received_bytes'] != upload['total_size']:
+        return jsonify({'error': 'Upload is incomplete', **upload_status(upload)}), 409
+    
+    digest = hashlib.sha256()
+    with open(upload_part_path(upload_id), 'rb') as part:
+        for block in iter(lambda: part.read(1024 * 1024), b''):
+            digest.update(block)
+    if digest.hexdigest() != expected:
+        return jsonify({'error': 'Checksum mismatch'}), 422
+    
+    filename = adopt_upload(upload_part_path(upload_id), upload['filename'], expected)
+    if upload['kind'] == 'reel':
+        insert_reel(db, filename, request.form.get('description', upload['description']))
+    else:
+        insert_story(db, filename)
+    db.execute('DELETE FROM upload_sessions WHERE id = ?', (upload_id,))
     db.commit()
     
     return jsonify({'success': True, 'filename': filename})
 
+# Social graph. Each worker caches friend lists as sorted int arrays (8 bytes
+# per friend) and answers membership and mutual-friend questions with bisect
+# probes into the longer list, O(min(deg) log max(deg)). Friendship changes
+# invalidate both users here; other workers catch up when entries expire.
+class SocialGraph:
+    def __init__(self, maxsize, ttl):
+        self._cache = TTLCache(maxsize, ttl)
+    
+    def friends(self, db, user_id):
+        user_id = int(user_id)
+        friends = self._cache.get(user_id)
+        if friends is None:
+            friends = array('q', sorted(row[0] for row in db.execute(
+                'SELECT user2_id FROM friends WHERE user1_id = ? UNION SELECT user1_id FROM friends WHERE user2_id = ?',
+                (user_id, user_id)
+            ).fetchall()))
+            self._cache.set(user_id, friends)
+        return friends
+    
+    def invalidate(self, *user_ids):
+        for user_id in user_ids:
+            self._cache.delete(int(user_id))
+    
+    @staticmethod
+    def _contains(ids, value):
+        i = bisect.bisect_left(ids, value)
+        return i < len(ids) and ids[i] == value
+    
+    def are_friends(self, db, a, b):
+        return self._contains(self.friends(db, a), int(b))
+    
+    def mutual_friends(self, db, a, b):
+        """Sorted ids of the friends a and b have in common."""
+        small, large = sorted((self.friends(db, a), self.friends(db, b)), key=len)
+        return [friend_id for friend_id in small if self._contains(large, friend_id)]
+    
+    def mutual_friend_summaries(self, db, a, b, n):
+        """Return (mutual friend count, summaries of up to n of them)."""
+        mutual = self.mutual_friends(db, a, b)
+        summaries = []
+        for start in range(0, len(mutual), 100):
+            if len(summaries) >= n:
+                break
+            chunk = mutual[start:start + 100]
+            summaries.extend(dict(row) for row in db.execute(
+                f'''SELECT id, username, real_name, profile_pic FROM users
+                   WHERE is_banned = FALSE AND id IN ({', '.join('?' * len(chunk))})
+                   ORDER BY id LIMIT ?''',
+                (*chunk, n - len(summaries))
+            ).fetchall())
+        return len(mutual), summaries
+
+social_graph = SocialGraph(app.config['FRIEND_GRAPH_CACHE_SIZE'], app.config['FRIEND_GRAPH_CACHE_TTL'])
+
+# Friend suggestions. Candidates are scored from the friend and follow graphs
+# plus shared profile details, and the top FRIEND_SUGGESTIONS_TOP_K per user
+# are stored in friend_suggestions, so the route is one indexed read. A new
+# friendship rescores both people at once and queues their friends, whose
+# friends-of-friends changed, for their next read or refresh-friend-suggestions.
+SUGGESTION_WEIGHTS = {
+    'mutual_friend': 3.0,
+    'followed_by_following': 1.0,
+    'location': 2.0,
+    'university': 2.0,
+    'secondary_school': 1.0,
+}
+SUGGESTION_ATTRIBUTE_PEERS = 200  # newest users sharing each profile detail
+
+def compute_friend_suggestions(db, user_id, k):
+    """Return up to k (score, mutual_count, candidate_id) tuples, best first."""
+    user = db.execute(
+        'SELECT location, university, secondary_school FROM users WHERE id = ?', (user_id,)
+    ).fetchone()
+    if user is None:
+        return []
+    
+    friends = social_graph.friends(db, user_id)
+    excluded = set(friends) | {user_id} | {row[0] for row in db.execute(
+        'SELECT followed_id FROM followers WHERE follower_id = ?', (user_id,)
+    ).fetchall()}
+    
+    # Each friend's friend list adds one mutual friend to every id on it
+    mutual = Counter()
+    for friend_id in friends:
+        mutual.update(social_graph.friends(db, friend_id))
+    followed = Counter(row[0] for row in db.execute(
+        """SELECT f2.followed_id FROM followers f1
+           JOIN followers f2 ON f2.follower_id = f1.followed_id AND f2.status = 'accepted'
+           WHERE f1.follower_id = ? AND f1.status = 'accepted'""",
+        (user_id,)
+    ).fetchall())
+    
+    candidates = set(mutual) | set(followed)
+    for attribute in ('location', 'university', 'secondary_school'):
+        if user[attribute]:
+            candidates.update(row[0] for row in db.execute(
+                f'SELECT id FROM users WHERE {attribute} = ? ORDER BY id DESC LIMIT ?',
+                (user[attribute], SUGGESTION_ATTRIBUTE_PEERS)
+            ).fetchall())
+    candidates -= excluded
+    
+    scored = []
+    candidates = sorted(candidates)
+    for start in range(0, len(candidates), 500):
+        chunk = candidates[start:start + 500]
+        rows = db.execute(
+            f'''SELECT id, location, university, secondary_school FROM users
+               WHERE is_banned = FALSE AND id IN ({', '.join('?' * len(chunk))})''',
+            chunk
+        ).fetchall()
+        for row in rows:
+            score = (SUGGESTION_WEIGHTS['mutual_friend'] * mutual[row['id']] +
+                     SUGGESTION_WEIGHTS['followed_by_following'] * followed[row['id']])
+            for attribute in ('location', 'university', 'secondary_school'):
+                if user[attribute] and row[attribute] == user[attribute]:
+                    score += SUGGESTION_WEIGHTS[attribute]
+            scored.append((score, mutual[row['id']], row['id']))
+    
+    top = heapq.nlargest(k, scored)
+    if len(top) < k:
+        # Pad with the newest users so new accounts still get suggestions
+        seen = excluded | {candidate for _, _, candidate in top}
+        for row in db.execute(
+            'SELECT id FROM users WHERE is_banned = FALSE ORDER BY id DESC LIMIT ?', (k + len(seen),)
+        ).fetchall():
+            if len(top) >= k:
+                break
+            if row[0] not in seen:
+                top.append((0.0, 0, row[0]))
+    return top
+
+def store_friend_suggestions(db, user_id):
+    """Recompute and store user_id's suggestions; the caller commits."""
+    top = compute_friend_suggestions(db, user_id, app.config['FRIEND_SUGGESTIONS_TOP_K'])
+    db.execute('DELETE FROM friend_suggestions WHERE user_id = ?', (user_id,))
+    db.executemany(
+        'INSERT INTO friend_suggestions (user_id, suggested_id, score, mutual_count) VALUES (?, ?, ?, ?)',
+        [(user_id, candidate, score, mutual_count) for score, mutual_count, candidate in top]
+    )
+    db.execute('DELETE FROM friend_suggestion_queue WHERE user_id = ?', (user_id,))
+
+def queue_friend_suggestions(db, user_ids):
+    db.executemany(
+        'INSERT INTO friend_suggestion_queue (user_id) VALUES (?) ON CONFLICT (user_id) DO NOTHING',
+        [(user_id,) for user_id in user_ids]
+    )
+
 # Friends and Followers routes
 @app.route('/api/friends/follow', methods=['POST'])
 @login_required
@@ -938,11 +3544,21 @@ def follow_user():
         'SELECT * FROM followers WHERE follower_id = ? AND followed_id = ?', (session['user_id'], user_id)
     ).fetchone()
     
+    follower_delta = 0
     if existing_follow:
         # If already following, unfollow
         db.execute(
             'DELETE FROM followers WHERE follower_id = ? AND followed_id = ?', (session['user_id'], user_id)
         )
+        removed = db.execute(
+            'DELETE FROM timeline WHERE user_id = ? AND actor_id = ? RETURNING user_id, post_id',
+            (session['user_id'], user_id)
+        ).fetchall()
+        refill_timeline(db, [tuple(row) for row in removed])
+        if existing_follow['status'] == 'accepted':
+            follower_delta = -1
+            adjust_user_stats(db, user_id, followers_count=-1)
+            adjust_user_stats(db, session['user_id'], following_count=-1)
         action = 'unfollowed'
     else:
         # Check if user has a locked profile
@@ -956,9 +3572,20 @@ def follow_user():
             'INSERT INTO followers (follower_id, followed_id, status) VALUES (?, ?, ?)',
             (session['user_id'], user_id, status)
         )
+        if status == 'accepted':
+            backfill_timeline(db, session['user_id'], user_id)
+            follower_delta = 1
+            adjust_user_stats(db, user_id, followers_count=1)
+            adjust_user_stats(db, session['user_id'], following_count=1)
         action = 'followed'
     
     db.commit()
+    following_cache.delete(session['user_id'])
+    if follower_delta:
+        get_suggest_index(db).adjust_followers(int(user_id), follower_delta)
+    
+    if action == 'followed':
+        notify(user_id, 'follow' if status == 'accepted' else 'friend_request')
     
     return jsonify({'action': action})
 
@@ -980,23 +3607,30 @@ def get_friend_requests():
 @app.route('/api/friends/requests/respond', methods=['POST'])
 @login_required
 def respond_to_friend_request():
-    follower_id = request.form.get('follower_id')
+    follower_id = request.form.get('follower_id', type=int)
     action = request.form.get('action')  # 'accept' or 'reject'
     
     if not follower_id or not action:
         return jsonify({'error': 'Follower ID and action are required'}), 400
     
     db = get_db()
+    became_friends = False
+    follower_delta = 0
     
     if action == 'accept':
-        db.execute(
-            'UPDATE followers SET status = "accepted" WHERE follower_id = ? AND followed_id = ?',
+        accepted = db.execute(
+            "UPDATE followers SET status = 'accepted' WHERE follower_id = ? AND followed_id = ? AND status != 'accepted'",
             (follower_id, session['user_id'])
-        )
+        ).rowcount
+        if accepted > 0:
+            backfill_timeline(db, follower_id, session['user_id'])
+            follower_delta = 1
+            adjust_user_stats(db, session['user_id'], followers_count=1)
+            adjust_user_stats(db, follower_id, following_count=1)
         
         # Check if this creates a mutual follow (friends)
-        mutual_follow = db.execute(
-            'SELECT * FROM followers WHERE follower_id = ? AND followed_id = ? AND status = "accepted"',
+        mutual_follow = accepted > 0 and db.execute(
+            "SELECT * FROM followers WHERE follower_id = ? AND followed_id = ? AND status = 'accepted'",
             (session['user_id'], follower_id)
         ).fetchone()
         
@@ -1014,108 +3648,156 @@ def respond_to_friend_request():
                     'INSERT INTO friends (user1_id, user2_id) VALUES (?, ?)',
                     (min(session['user_id'], follower_id), max(session['user_id'], follower_id))
                 )
+                adjust_user_stats(db, session['user_id'], friends_count=1)
+                adjust_user_stats(db, follower_id, friends_count=1)
+                became_friends = True
     else:  # reject
-        db.execute(
-            'DELETE FROM followers WHERE follower_id = ? AND followed_id = ?',
+        removed = db.execute(
+            'DELETE FROM followers WHERE follower_id = ? AND followed_id = ? RETURNING status',
             (follower_id, session['user_id'])
-        )
+        ).fetchone()
+        if removed and removed['status'] == 'accepted':
+            follower_delta = -1
+            adjust_user_stats(db, session['user_id'], followers_count=-1)
+            adjust_user_stats(db, follower_id, following_count=-1)
+            # Like an unfollow: take this account's entries out of their timeline
+            dropped = db.execute(
+                'DELETE FROM timeline WHERE user_id = ? AND actor_id = ? RETURNING user_id, post_id',
+                (follower_id, session['user_id'])
+            ).fetchall()
+            refill_timeline(db, [tuple(row) for row in dropped])
     
     db.commit()
+    following_cache.delete(follower_id)
+    if follower_delta:
+        get_suggest_index(db).adjust_followers(int(session['user_id']), follower_delta)
+    
+    if became_friends:
+        # Only drop the cached friend lists once the friendship is committed,
+        # or another request could cache them again without it; then rescore
+        social_graph.invalidate(session['user_id'], follower_id)
+        queue_friend_suggestions(
+            db, set(social_graph.friends(db, session['user_id'])) | set(social_graph.friends(db, follower_id))
+        )
+        store_friend_suggestions(db, session['user_id'])
+        store_friend_suggestions(db, follower_id)
+        db.commit()
     
     return jsonify({'success': True})
 
 @app.route('/api/friends/suggestions', methods=['GET'])
 @login_required
 def get_friend_suggestions():
-    limit = request.args.get('limit', 10, type=int)
+    limit = get_limit(10)
     
     db = get_db()
     
-    # Get suggestions: friends of friends, people in same location/school, etc.
+    # Suggestions are precomputed; rescore first if they are out of date
+    stale = db.execute(
+        'SELECT 1 FROM friend_suggestion_queue WHERE user_id = ?', (session['user_id'],)
+    ).fetchone()
+    if stale:
+        store_friend_suggestions(db, session['user_id'])
+        db.commit()
+    
     suggestions = db.execute(
-        '''SELECT u.*, 
-           (SELECT COUNT(*) FROM friends f 
-            WHERE (f.user1_id = u.id OR f.user2_id = u.id) 
-            AND (f.user1_id IN (SELECT user2_id FROM friends WHERE user1_id = ?) 
-                 OR f.user2_id IN (SELECT user1_id FROM friends WHERE user2_id = ?)
-                 OR f.user1_id IN (SELECT user1_id FROM friends WHERE user2_id = ?) 
-                 OR f.user2_id IN (SELECT user2_id FROM friends WHERE user1_id = ?))
-           ) as mutual_count
-           FROM users u
-           WHERE u.id != ? 
+        '''SELECT u.*, fs.mutual_count, fs.score
+           FROM friend_suggestions fs
+           JOIN users u ON u.id = fs.suggested_id
+           WHERE fs.user_id = ?
            AND u.is_banned = FALSE
-           AND u.id NOT IN (
-               SELECT followed_id FROM followers WHERE follower_id = ?
+           AND NOT EXISTS (
+               SELECT 1 FROM followers WHERE follower_id = fs.user_id AND followed_id = fs.suggested_id
            )
-           ORDER BY mutual_count DESC, u.created_at DESC
+           ORDER BY fs.score DESC, fs.suggested_id DESC
            LIMIT ?''',
-        (session['user_id'], session['user_id'], session['user_id'], session['user_id'], 
-         session['user_id'], session['user_id'], limit)
+        (session['user_id'], limit)
     ).fetchall()
     
     return jsonify([dict(suggestion) for suggestion in suggestions])
 
 # Messages routes
+INBOX_SQL = '''
+    SELECT c.id, c.last_activity, c.peer_id as user_id, c.group_id, u.username, u.real_name, u.profile_pic,
+           g.name as group_name, g.profile_pic as group_profile_pic,
+           COALESCE(g.last_message_at, c.last_message_at) as last_message_time,
+           COALESCE(g.last_message_id, c.last_message_id) as last_message_id,
+           COALESCE(g.last_message_preview, c.last_message_preview) as last_message_preview,
+           CASE WHEN c.group_id IS NULL THEN c.unread_count
+                ELSE g.message_count - c.read_count END as unread_count
+    FROM conversations c
+    LEFT JOIN users u ON u.id = c.peer_id
+    LEFT JOIN groups g ON g.id = c.group_id
+    WHERE c.user_id = ? AND c.last_activity IS NOT NULL {keyset}
+    ORDER BY c.last_activity DESC, c.id DESC
+    LIMIT ?
+'''
+
 @app.route('/api/messages', methods=['GET'])
 @login_required
 def get_messages():
     user_id = request.args.get('user_id')
-    group_id = request.args.get('group_id')
-    limit = request.args.get('limit', 50, type=int)
+    group_id = request.args.get('group_id', type=int)
+    limit = get_limit(50)
+    keyset_sql, keyset_params = keyset_clause('m', request.args.get('cursor'))
     
     db = get_db()
     
     if user_id:
         # Direct messages
         messages = db.execute(
-            '''SELECT m.*, u.username, u.real_name, u.profile_pic
+            f'''SELECT m.*, u.username, u.real_name, u.profile_pic,
+               {media_variant_columns('m.media_url', 'message')}
                FROM messages m
                JOIN users u ON m.sender_id = u.id
-               WHERE (m.sender_id = ? AND m.receiver_id = ?)
-               OR (m.sender_id = ? AND m.receiver_id = ?)
-               ORDER BY m.created_at DESC
+               WHERE ((m.sender_id = ? AND m.receiver_id = ?)
+               OR (m.sender_id = ? AND m.receiver_id = ?)) {keyset_sql}
+               AND (m.expires_at IS NULL OR m.expires_at > ?)
+               ORDER BY m.created_at DESC, m.id DESC
                LIMIT ?''',
-            (session['user_id'], user_id, user_id, session['user_id'], limit)
+            (session['user_id'], user_id, user_id, session['user_id'], *keyset_params, utc_timestamp(), limit + 1)
         ).fetchall()
+        
+        # Opening a conversation reads it
+        counts = mark_conversation_read(db, session['user_id'], user_id)
+        db.commit()
+        if counts:
+            store_unread_counts(session['user_id'], *counts)
     elif group_id:
+        if not group_membership.is_member(db, group_id, session['user_id']):
+            return jsonify({'error': 'Not a member of this group'}), 403
+        
         # Group messages
         messages = db.execute(
-            '''SELECT m.*, u.username, u.real_name, u.profile_pic
+            f'''SELECT m.*, u.username, u.real_name, u.profile_pic,
+               {media_variant_columns('m.media_url', 'message')}
                FROM messages m
                JOIN users u ON m.sender_id = u.id
-               WHERE m.group_id = ?
-               ORDER BY m.created_at DESC
+               WHERE m.group_id = ? {keyset_sql}
+               ORDER BY m.created_at DESC, m.id DESC
                LIMIT ?''',
-            (group_id, limit)
+            (group_id, *keyset_params, limit + 1)
         ).fetchall()
+        
+        mark_group_read(db, session['user_id'], group_id)
+        db.commit()
     else:
         # Get recent conversations
+        keyset_sql, keyset_params = keyset_clause('c', request.args.get('cursor'), time_column='last_activity')
         conversations = db.execute(
-            '''SELECT u.id as user_id, u.username, u.real_name, u.profile_pic, 
-                      MAX(m.created_at) as last_message_time,
-                      (SELECT COUNT(*) FROM messages 
-                       WHERE (sender_id = u.id AND receiver_id = ?) 
-                       OR (sender_id = ? AND receiver_id = u.id) 
-                       AND is_read = FALSE) as unread_count
-               FROM users u
-               JOIN messages m ON (m.sender_id = u.id OR m.receiver_id = u.id)
-               WHERE (m.sender_id = ? AND m.receiver_id != ?)
-               OR (m.receiver_id = ? AND m.sender_id != ?)
-               GROUP BY u.id
-               ORDER BY last_message_time DESC''',
-            (session['user_id'], session['user_id'], session['user_id'], session['user_id'], 
-             session['user_id'], session['user_id'])
+            INBOX_SQL.format(keyset=keyset_sql),
+            (session['user_id'], *keyset_params, limit + 1)
         ).fetchall()
         
-        return jsonify([dict(conv) for conv in conversations])
+        return paginated_response(conversations, limit, sort_key='last_activity')
     
-    return jsonify([dict(msg) for msg in messages])
+    return paginated_response(messages, limit)
 
 @app.route('/api/messages/send', methods=['POST'])
 @login_required
 def send_message():
     receiver_id = request.form.get('receiver_id')
-    group_id = request.form.get('group_id')
+    group_id = request.form.get('group_id', type=int)
     content = request.form.get('content', '')
     message_type = request.form.get('message_type', 'text')
     
@@ -1124,15 +3806,15 @@ def send_message():
     
     db = get_db()
     
+    if group_id and not group_membership.is_member(db, group_id, session['user_id']):
+        return jsonify({'error': 'Not a member of this group'}), 403
+    
     # Handle file upload if applicable
     media_url = None
     if message_type != 'text' and 'file' in request.files:
         file = request.files['file']
         if file.filename != '':
-            filename = f"message_{session['user_id']}_{datetime.now().strftime('%Y%m%d%H%M%S')}.{file.filename.split('.')[-1]}"
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], 'messages', filename)
-            file.save(filepath)
-            media_url = filename
+            media_url = save_upload(file)
     
     # Set expiration for disappearing messages
     expires_at = None
@@ -1142,16 +3824,77 @@ def send_message():
         ).fetchone()
         
         if settings and settings['disappearing_messages_duration'] > 0:
-            expires_at = datetime.now() + timedelta(hours=settings['disappearing_messages_duration'])
+            expires_at = utc_timestamp(settings['disappearing_messages_duration'])
     
-    db.execute(
-        'INSERT INTO messages (sender_id, receiver_id, group_id, content, message_type, media_url, expires_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+    message = db.execute(
+        '''INSERT INTO messages (sender_id, receiver_id, group_id, content, message_type, media_url, expires_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?) RETURNING *''',
         (session['user_id'], receiver_id, group_id, content, message_type, media_url, expires_at)
-    )
+    ).fetchone()
+    counts = record_message(db, message)
     db.commit()
     
+    # Push the message to the open streams of everyone who should see it
+    payload = dict(message, username=session['username'])
+    if receiver_id:
+        publish_event(receiver_id, 'message', payload)
+        notify(receiver_id, 'message', 'user', session['user_id'])
+        if counts:
+            publish_event(receiver_id, 'unread', store_unread_counts(receiver_id, *counts))
+    elif group_id:
+        for member_id in group_membership.members(db, group_id)[0]:
+            if member_id != session['user_id']:
+                publish_event(member_id, 'message', payload)
+    
     return jsonify({'success': True})
 
+# Group membership. Each group's member and admin IDs are cached per worker
+# as sorted arrays, so membership checks on group reads and sends, member
+# counts and message fan-out don't query group_members. Routes that change
+# a group's members invalidate it; other workers catch up within the TTL,
+# and a failed membership check is confirmed against the table first.
+class GroupMembership:
+    def __init__(self, maxsize, ttl):
+        self._cache = TTLCache(maxsize, ttl)
+    
+    def members(self, db, group_id):
+        """Return (member ids, admin ids) of group_id as sorted arrays."""
+        group_id = int(group_id)
+        entry = self._cache.get(group_id)
+        if entry is None:
+            rows = db.execute(
+                'SELECT user_id, is_admin FROM group_members WHERE group_id = ? ORDER BY user_id', (group_id,)
+            ).fetchall()
+            entry = (array('q', (row[0] for row in rows)), array('q', (row[0] for row in rows if row[1])))
+            self._cache.set(group_id, entry)
+        return entry
+    
+    def invalidate(self, group_id):
+        self._cache.delete(int(group_id))
+    
+    def _confirm(self, db, group_id, user_id, admin):
+        # A miss may be a join or promotion on another worker, so confirm it
+        # before refusing
+        row = db.execute(
+            'SELECT is_admin FROM group_members WHERE group_id = ? AND user_id = ?', (group_id, user_id)
+        ).fetchone()
+        if row is None or (admin and not row[0]):
+            return False
+        self.invalidate(group_id)
+        return True
+    
+    def is_member(self, db, group_id, user_id):
+        if SocialGraph._contains(self.members(db, group_id)[0], int(user_id)):
+            return True
+        return self._confirm(db, group_id, user_id, admin=False)
+    
+    def is_admin(self, db, group_id, user_id):
+        if SocialGraph._contains(self.members(db, group_id)[1], int(user_id)):
+            return True
+        return self._confirm(db, group_id, user_id, admin=True)
+
+group_membership = GroupMembership(app.config['GROUP_MEMBERSHIP_CACHE_SIZE'], app.config['GROUP_MEMBERSHIP_CACHE_TTL'])
+
 # Groups routes
 @app.route('/api/groups', methods=['GET'])
 @login_required
@@ -1185,19 +3928,19 @@ def create_group():
     unique_link = ''.join(random.choices(string.ascii_letters + string.digits, k=10))
     
     # Create group
-    db.execute(
-        'INSERT INTO groups (name, description, unique_link, created_by) VALUES (?, ?, ?, ?)',
+    group_id = db.execute(
+        'INSERT INTO groups (name, description, unique_link, created_by) VALUES (?, ?, ?, ?) RETURNING id',
         (name, description, unique_link, session['user_id'])
-    )
-    
-    group_id = db.execute('SELECT last_insert_rowid()').fetchone()[0]
+    ).fetchone()[0]
     
     # Add creator as admin
     db.execute(
         'INSERT INTO group_members (group_id, user_id, is_admin) VALUES (?, ?, ?)',
         (group_id, session['user_id'], True)
     )
+    add_group_conversation(db, group_id, session['user_id'])
     db.commit()
+    group_membership.invalidate(group_id)
     
     return jsonify({'success': True, 'group_id': group_id, 'unique_link': unique_link})
 
@@ -1206,19 +3949,18 @@ def create_group():
 def get_group(group_id):
     db = get_db()
     group = db.execute(
-        '''SELECT g.*, 
-           (SELECT COUNT(*) FROM group_members WHERE group_id = g.id) as member_count,
-           EXISTS(SELECT 1 FROM group_members WHERE group_id = g.id AND user_id = ?) as is_member,
-           EXISTS(SELECT 1 FROM group_members WHERE group_id = g.id AND user_id = ? AND is_admin = TRUE) as is_admin
-           FROM groups g
-           WHERE g.id = ?''',
-        (session['user_id'], session['user_id'], group_id)
+        'SELECT * FROM groups WHERE id = ?', (group_id,)
     ).fetchone()
     
     if not group:
         return jsonify({'error': 'Group not found'}), 404
     
-    return jsonify(dict(group))
+    is_member = group_membership.is_member(db, group_id, session['user_id'])
+    is_admin = is_member and group_membership.is_admin(db, group_id, session['user_id'])
+    return jsonify(dict(
+        group, member_count=len(group_membership.members(db, group_id)[0]),
+        is_member=is_member, is_admin=is_admin
+    ))
 
 @app.route('/api/groups/<int:group_id>/join', methods=['POST'])
 @login_required
@@ -1233,71 +3975,485 @@ def join_group(group_id):
     if not group:
         return jsonify({'error': 'Group not found'}), 404
     
-    # Check if already a member
-    existing_member = db.execute(
-        'SELECT * FROM group_members WHERE group_id = ? AND user_id = ?', (group_id, session['user_id'])
-    ).fetchone()
-    
-    if existing_member:
+    if group_membership.is_member(db, group_id, session['user_id']):
         return jsonify({'error': 'Already a member'}), 400
     
     # Check if group requires approval
     if group['approve_new_members']:
-        # In a real app, you would create a membership request
-        # For simplicity, we'll just add as pending
+        # Queue the request; repeats of a pending request change nothing
+        queued = db.execute(
+            '''INSERT INTO group_join_requests (group_id, user_id) VALUES (?, ?)
+               ON CONFLICT (group_id, user_id) DO UPDATE SET
+                   status = 'pending', created_at = CURRENT_TIMESTAMP, decided_at = NULL, decided_by = NULL
+               WHERE group_join_requests.status != 'pending'
+               RETURNING id''',
+            (group_id, session['user_id'])
+        ).fetchone()
+        db.commit()
+        if queued:
+            for admin_id in group_membership.members(db, group_id)[1]:
+                notify(admin_id, 'group_join_request', 'group', group_id)
         return jsonify({'success': True, 'status': 'pending_approval'})
     else:
         db.execute(
             'INSERT INTO group_members (group_id, user_id) VALUES (?, ?)',
             (group_id, session['user_id'])
         )
+        add_group_conversation(db, group_id, session['user_id'])
         db.commit()
+        group_membership.invalidate(group_id)
         return jsonify({'success': True, 'status': 'joined'})
 
+# Join requests. Admins page through a group's pending requests newest
+# first and approve or reject any number of them in one transaction, each
+# step a single executemany over the chosen users.
+@app.route('/api/groups/<int:group_id>/requests', methods=['GET'])
+@login_required
+def get_group_join_requests(group_id):
+    limit = get_limit(50)
+    keyset_sql, keyset_params = keyset_clause('r', request.args.get('cursor'))
+    
+    db = get_db()
+    if not group_membership.is_admin(db, group_id, session['user_id']):
+        return jsonify({'error': 'Only group admins can review join requests'}), 403
+    
+    requests = db.execute(
+        f'''SELECT r.id, r.user_id, r.created_at
+           FROM group_join_requests r
+           WHERE r.group_id = ? AND r.status = 'pending' {keyset_sql}
+           ORDER BY r.created_at DESC, r.id DESC
+           LIMIT ?''',
+        (group_id, *keyset_params, limit + 1)
+    ).fetchall()
+    
+    return paginated_response(requests, limit, hydrate=lambda page: with_user_cards(db, page))
+
+@app.route('/api/groups/<int:group_id>/requests/respond', methods=['POST'])
+@login_required
+def respond_to_group_join_requests(group_id):
+    action = request.form.get('action')  # 'approve' or 'reject'
+    user_ids = request.form.getlist('user_id', type=int)
+    
+    if action not in ('approve', 'reject') or not user_ids:
+        return jsonify({'error': 'An action and at least one user_id are required'}), 400
+    
+    db = get_db()
+    if not group_membership.is_admin(db, group_id, session['user_id']):
+        return jsonify({'error': 'Only group admins can review join requests'}), 403
+    
+    pairs = [(group_id, user_id) for user_id in dict.fromkeys(user_ids)]
+    if action == 'approve':
+        # Only users with a pending request become members
+        db.executemany(
+            '''INSERT INTO group_members (group_id, user_id)
+               SELECT group_id, user_id FROM group_join_requests
+               WHERE group_id = ? AND user_id = ? AND status = 'pending'
+               ON CONFLICT (group_id, user_id) DO NOTHING''',
+            pairs
+        )
+        db.executemany(
+            '''INSERT INTO conversations (user_id, group_id, read_count, last_activity)
+               SELECT gm.user_id, g.id, g.message_count, g.last_message_at FROM group_members gm
+               JOIN groups g ON g.id = gm.group_id
+               WHERE gm.group_id = ? AND gm.user_id = ?
+               ON CONFLICT (user_id, group_id) WHERE group_id IS NOT NULL DO NOTHING''',
+            pairs
+        )
+    status = 'approved' if action == 'approve' else 'rejected'
+    processed = db.executemany(
+        """UPDATE group_join_requests SET status = ?, decided_at = CURRENT_TIMESTAMP, decided_by = ?
+           WHERE group_id = ? AND user_id = ? AND status = 'pending'""",
+        [(status, session['user_id'], *pair) for pair in pairs]
+    ).rowcount
+    db.commit()
+    if action == 'approve':
+        group_membership.invalidate(group_id)
+    
+    return jsonify({'success': True, 'status': status, 'processed': processed})
+
 # Notifications routes
+NOTIFICATIONS_SQL = '''
+    SELECT n.*, u.username, u.real_name, u.profile_pic
+    FROM notifications n
+    LEFT JOIN users u ON n.source_id = u.id
+    WHERE n.user_id = ? {keyset}
+    ORDER BY n.created_at DESC, n.id DESC
+    LIMIT ?
+'''
+
 @app.route('/api/notifications', methods=['GET'])
 @login_required
 def get_notifications():
-    limit = request.args.get('limit', 20, type=int)
+    limit = get_limit(20)
+    keyset_sql, keyset_params = keyset_clause('n', request.args.get('cursor'))
     
     db = get_db()
     notifications = db.execute(
-        '''SELECT n.*, u.username, u.real_name, u.profile_pic
-           FROM notifications n
-           LEFT JOIN users u ON n.source_id = u.id
-           WHERE n.user_id = ?
-           ORDER BY n.created_at DESC
-           LIMIT ?''',
-        (session['user_id'], limit)
+        NOTIFICATIONS_SQL.format(keyset=keyset_sql),
+        (session['user_id'], *keyset_params, limit + 1)
     ).fetchall()
     
-    # Mark as read
+    # Mark as read. Read notifications never coalesce again, so their
+    # actors are no longer needed
+    db.execute(
+        '''DELETE FROM notification_actors WHERE notification_id IN (
+               SELECT id FROM notifications WHERE user_id = ? AND is_read = FALSE
+           )''',
+        (session['user_id'],)
+    )
     db.execute(
         'UPDATE notifications SET is_read = TRUE WHERE user_id = ? AND is_read = FALSE',
         (session['user_id'],)
     )
+    row = db.execute(
+        '''UPDATE users SET unread_notifications = 0 WHERE id = ?
+           RETURNING unread_notifications, unread_messages''',
+        (session['user_id'],)
+    ).fetchone()
     db.commit()
+    store_unread_counts(session['user_id'], row[0], row[1])
     
-    return jsonify([dict(notif) for notif in notifications])
+    notifications = [dict(notif, message=notification_message(notif)) for notif in notifications]
+    return paginated_response(notifications, limit)
 
 @app.route('/api/notifications/count', methods=['GET'])
 @login_required
 def get_unread_notification_count():
-    db = get_db()
-    count = db.execute(
-        'SELECT COUNT(*) FROM notifications WHERE user_id = ? AND is_read = FALSE',
-        (session['user_id'],)
-    ).fetchone()[0]
+    counts = get_unread_counts(get_db(), session['user_id'])
     
-    return jsonify({'count': count})
+    return jsonify({'count': counts['notifications'], 'messages': counts['messages']})
+
+# Event stream route
+@app.route('/api/stream')
+@login_required
+def event_stream():
+    user_id = session['user_id']
+    broker = get_broker()
+    events = broker.subscribe(user_id)
+    heartbeat = app.config['STREAM_HEARTBEAT_SECONDS']
+    
+    # Server-Sent Events; waiting on the queue touches no database connection
+    def generate():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    event = events.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                yield f"event: {event['event']}\ndata: {json.dumps(event['data'], default=str)}\n\n"
+        finally:
+            broker.unsubscribe(user_id, events)
+    
+    return app.response_class(
+        generate(),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+# Type-ahead suggestions. Each worker keeps every searchable user in a sorted
+# list of (lowercased name token, user id) keys, so a prefix lookup is a bisect
+# over the matching range. Ranking a short prefix's whole range per keystroke
+# is too slow, so the SUGGEST_TOP_K most followed users of each prefix asked
+# for are kept (for SUGGEST_CACHED_PREFIXES prefixes at most) and patched as
+# follower counts change. register, update_user_profile, follows and bans
+# patch the index in place; other workers' changes arrive with the next
+# periodic reload, which runs in the background.
+SUGGEST_TOP_K = 51  # the largest page, plus the viewer's own entry
+SUGGEST_CACHED_PREFIXES = 10000
+
+class SuggestIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = []
+        self._users = {}
+        self._tokens_of = {}  # user id -> name tokens
+        self._usernames = {}  # lowercased username -> user ids
+        self._top = self._new_top()  # prefix -> ids of its most followed users, best first
+        self.loaded_at = None
+    
+    @staticmethod
+    def _new_top():
+        return TTLCache(SUGGEST_CACHED_PREFIXES, app.config['SUGGEST_INDEX_REFRESH'])
+    
+    @staticmethod
+    def _tokens(user):
+        names = [user['username'] or ''] + (user['real_name'] or '').split()
+        return {name.lower() for name in names if name}
+    
+    def _rank(self, user_id):
+        user = self._users[user_id]
+        return -user['followers'], user['username'].lower(), user_id
+    
+    def _prefixes(self, user_id):
+        return {token[:n] for token in self._tokens_of[user_id] for n in range(1, len(token) + 1)}
+    
+    def load(self, db):
+        rows = db.execute(
+            '''SELECT u.id, u.username, u.real_name, u.profile_pic, COALESCE(s.followers_count, 0) as followers
+               FROM users u LEFT JOIN user_stats s ON s.user_id = u.id
+               WHERE u.is_banned = FALSE'''
+        ).fetchall()
+        users = {row['id']: dict(row) for row in rows}
+        tokens_of = {user_id: tuple(self._tokens(user)) for user_id, user in users.items()}
+        keys = sorted((token, user_id) for user_id, tokens in tokens_of.items() for token in tokens)
+        usernames = {}
+        for user_id, user in users.items():
+            usernames.setdefault(user['username'].lower(), set()).add(user_id)
+        top = self._new_top()
+        with self._lock:
+            self._users, self._tokens_of, self._keys = users, tokens_of, keys
+            self._usernames, self._top = usernames, top
+            self.loaded_at = time.monotonic()
+    
+    def _discard(self, user_id):
+        user = self._users.get(user_id)
+        if user:
+            # The next best user of these prefixes is unknown; find it on demand
+            for prefix in self._prefixes(user_id):
+                self._top.delete(prefix)
+            for token in self._tokens_of.pop(user_id):
+                i = bisect.bisect_left(self._keys, (token, user_id))
+                if i < len(self._keys) and self._keys[i] == (token, user_id):
+                    del self._keys[i]
+            self._usernames.get(user['username'].lower(), set()).discard(user_id)
+            del self._users[user_id]
+        return user
+    
+    def _promote(self, user_id):
+        # Called after user_id gained followers or was added: the kept lists
+        # stay exact by letting it in wherever it now ranks high enough
+        for prefix in self._prefixes(user_id):
+            top = self._top.get(prefix)
+            if top is None:
+                continue
+            if user_id in top:
+                top.remove(user_id)
+            top.append(user_id)
+            top.sort(key=self._rank)
+            del top[SUGGEST_TOP_K:]
+    
+    def upsert(self, user):
+        """Add or refresh one user; user needs id, username, real_name and profile_pic."""
+        with self._lock:
+            old = self._discard(user['id'])
+            entry = {key: user[key] for key in ('id', 'username', 'real_name', 'profile_pic')}
+            entry['followers'] = old['followers'] if old else 0
+            self._users[entry['id']] = entry
+            self._tokens_of[entry['id']] = tuple(self._tokens(entry))
+            self._usernames.setdefault(entry['username'].lower(), set()).add(entry['id'])
+            for token in self._tokens_of[entry['id']]:
+                bisect.insort(self._keys, (token, entry['id']))
+            self._promote(entry['id'])
+    
+    def remove(self, user_id):
+        with self._lock:
+            self._discard(user_id)
+    
+    def adjust_followers(self, user_id, delta):
+        with self._lock:
+            user = self._users.get(user_id)
+            if user:
+                user['followers'] = max(user['followers'] + delta, 0)
+                if delta > 0:
+                    self._promote(user_id)
+                else:
+                    for prefix in self._prefixes(user_id):
+                        self._top.delete(prefix)
+    
+    def _range(self, prefix):
+        return (bisect.bisect_left(self._keys, (prefix,)),
+                bisect.bisect_left(self._keys, (prefix + '\U0010ffff',)))
+    
+    def _most_followed(self, prefix):
+        """Ids of the SUGGEST_TOP_K most followed users matching prefix."""
+        top = self._top.get(prefix)
+        if top is None:
+            start, end = self._range(prefix)
+            ids = {self._keys[i][1] for i in range(start, end)}
+            top = heapq.nsmallest(SUGGEST_TOP_K, ids, key=self._rank)
+            self._top.set(prefix, top)
+        return top
+    
+    def _matches(self, user_id, prefix):
+        return any(token.startswith(prefix) for token in self._tokens_of.get(user_id, ()))
+    
+    def suggest(self, prefix, viewer_id, following, friends, limit):
+        """Users whose username or a real name word starts with prefix.
+        
+        Exact username matches come first, then the viewer's friends, then
+        people the viewer follows, then everyone else by follower count.
+        """
+        prefix = prefix.lower()
+        with self._lock:
+            # Whoever makes the page is an exact match, a friend or followed
+            # account, or among the most followed users with the prefix
+            exact = self._usernames.get(prefix, set())
+            # Check whichever is shorter: the related ids or the prefix's range
+            start, end = self._range(prefix)
+            related = []
+            for ids, contains in ((friends, partial(SocialGraph._contains, friends)), (following, following.__contains__)):
+                if len(ids) < end - start:
+                    related.append({user_id for user_id in ids if self._matches(user_id, prefix)})
+                else:
+                    related.append({self._keys[i][1] for i in range(start, end) if contains(self._keys[i][1])})
+            matched_friends, matched_following = related
+            candidates = exact | matched_friends | matched_following
+            candidates.update(self._most_followed(prefix))
+            candidates.discard(viewer_id)
+            matches = [self._users[user_id] for user_id in candidates if user_id in self._users]
+        
+        ranked = heapq.nsmallest(
+            limit, matches,
+            key=lambda user: (user['id'] not in exact, user['id'] not in matched_friends,
+                              user['id'] not in matched_following, -user['followers'], user['username'].lower())
+        )
+        return [dict(user, is_following=user['id'] in following) for user in ranked]
+
+_suggest_index = None
+_suggest_index_pid = None
+_suggest_reloading = False
+_suggest_load_lock = threading.Lock()
+following_cache = TTLCache(app.config['FOLLOWING_CACHE_SIZE'], app.config['FOLLOWING_CACHE_TTL'])
+
+def reload_suggest_index(index):
+    global _suggest_reloading
+    try:
+        with app.app_context():
+            index.load(get_db())
+    except Exception:
+        app.logger.exception('Could not reload the suggestion index')
+    finally:
+        with _pool_lock:
+            _suggest_reloading = False
+
+def get_suggest_index(db):
+    """Return this worker's index, loading it on first use.
+    
+    Once loaded, a stale index keeps answering while one background thread
+    reloads it.
+    """
+    global _suggest_index, _suggest_index_pid, _suggest_reloading
+    with _pool_lock:
+        if _suggest_index_pid != os.getpid():
+            _suggest_index = SuggestIndex()
+            _suggest_index_pid = os.getpid()
+            _suggest_reloading = False
+        index = _suggest_index
+        stale = index.loaded_at is not None and time.monotonic() - index.loaded_at > app.config['SUGGEST_INDEX_REFRESH']
+        reload = stale and not _suggest_reloading
+        if reload:
+            _suggest_reloading = True
+    
+    if index.loaded_at is None:
+        # Requests arriving during the first load wait for it instead of
+        # starting their own
+        with _suggest_load_lock:
+            if index.loaded_at is None:
+                index.load(db)
+    elif reload:
+        threading.Thread(target=reload_suggest_index, args=(index,), daemon=True).start()
+    return index
+
+def get_following_ids(db, user_id):
+    following = following_cache.get(int(user_id))
+    if following is None:
+        following = frozenset(
+            row[0] for row in db.execute(
+                "SELECT followed_id FROM followers WHERE follower_id = ? AND status = 'accepted'", (user_id,)
+            ).fetchall()
+        )
+        following_cache.set(int(user_id), following)
+    return following
+
+def refresh_suggestions(db, user_id):
+    """Re-read one user's names into this worker's suggestion index."""
+    user = db.execute(
+        'SELECT id, username, real_name, profile_pic FROM users WHERE id = ? AND is_banned = FALSE', (user_id,)
+    ).fetchone()
+    index = get_suggest_index(db)
+    if user:
+        index.upsert(user)
+    else:
+        index.remove(int(user_id))
 
 # Search routes
+@app.route('/api/search/suggest', methods=['GET'])
+@login_required
+def search_suggest():
+    query = request.args.get('q', '').strip()
+    limit = get_limit(10, 50)
+    
+    if not query:
+        return jsonify([])
+    
+    db = get_db()
+    index = get_suggest_index(db)
+    following = get_following_ids(db, session['user_id'])
+    friends = social_graph.friends(db, session['user_id'])
+    return jsonify(index.suggest(query, session['user_id'], following, friends, limit))
+
+def fts_match_query(text):
+    """Turn free text into an FTS5 query: every word must match, the last as a prefix."""
+    terms = re.findall(r'\w+', text)
+    if not terms:
+        return None
+    return ' '.join(f'"{term}"' for term in terms) + '*'
+
+def search_filter(table, alias, columns, query):
+    """Return (join, condition, order, params) matching query against columns.
+    
+    On SQLite this uses the FTS5 index from migration 8, ranked by BM25;
+    other backends fall back to LIKE and leave the ordering to the caller.
+    """
+    if database_dialect() != 'sqlite':
+        condition = ' OR '.join(f'{alias}.{column} LIKE ?' for column in columns)
+        return '', f'({condition})', None, [f'%{query}%'] * len(columns)
+    
+    match = fts_match_query(query)
+    if match is None:
+        return '', 'FALSE', None, []
+    fts = f'{table}_fts'
+    return f'JOIN {fts} ON {fts}.rowid = {alias}.id', f'{fts} MATCH ?', f'bm25({fts})', [match]
+
+# {join}, {condition} and {order} take search_filter()'s output
+SEARCH_USERS_SQL = """
+    SELECT u.*,
+    EXISTS(SELECT 1 FROM followers WHERE follower_id = ? AND followed_id = u.id AND status = 'accepted') as is_following
+    FROM users u {join}
+    WHERE {condition}
+    AND u.is_banned = FALSE
+    ORDER BY {order}
+    LIMIT ?
+"""
+
+SEARCH_GROUPS_SQL = '''
+    SELECT g.*,
+    (SELECT COUNT(*) FROM group_members WHERE group_id = g.id) as member_count,
+    EXISTS(SELECT 1 FROM group_members WHERE group_id = g.id AND user_id = ?) as is_member
+    FROM groups g {join}
+    WHERE {condition}
+    ORDER BY {order}
+    LIMIT ?
+'''
+
+SEARCH_POSTS_SQL = f'''
+    SELECT {POST_ROW_COLUMNS}
+    FROM posts p {{join}}
+    WHERE {{condition}} AND p.visibility IN ('public',
+        CASE WHEN p.user_id IN (SELECT followed_id FROM followers WHERE follower_id = ? AND status = 'accepted') THEN 'friends' ELSE 'public' END,
+        CASE WHEN p.user_id = ? THEN 'private' ELSE 'public' END)
+    ORDER BY {{order}}
+    LIMIT ?
+'''
+
 @app.route('/api/search', methods=['GET'])
 @login_required
 def search():
     query = request.args.get('q', '')
     type_filter = request.args.get('type', 'all')  # all, users, groups, posts
-    limit = request.args.get('limit', 20, type=int)
+    limit = get_limit(20)
     
     if not query:
         return jsonify({'error': 'Search query is required'}), 400
@@ -1306,47 +4462,28 @@ def search():
     results = {}
     
     if type_filter in ['all', 'users']:
+        join, condition, order, params = search_filter('users', 'u', ('username', 'real_name'), query)
         users = db.execute(
-            '''SELECT u.*, 
-               EXISTS(SELECT 1 FROM followers WHERE follower_id = ? AND followed_id = u.id AND status = 'accepted') as is_following
-               FROM users u
-               WHERE (u.username LIKE ? OR u.real_name LIKE ?) 
-               AND u.is_banned = FALSE
-               ORDER BY u.username
-               LIMIT ?''',
-            (session['user_id'], f'%{query}%', f'%{query}%', limit)
+            SEARCH_USERS_SQL.format(join=join, condition=condition, order=order or 'u.username'),
+            (session['user_id'], *params, limit)
         ).fetchall()
         results['users'] = [dict(user) for user in users]
     
     if type_filter in ['all', 'groups']:
+        join, condition, order, params = search_filter('groups', 'g', ('name', 'description'), query)
         groups = db.execute(
-            '''SELECT g.*, 
-               (SELECT COUNT(*) FROM group_members WHERE group_id = g.id) as member_count,
-               EXISTS(SELECT 1 FROM group_members WHERE group_id = g.id AND user_id = ?) as is_member
-               FROM groups g
-               WHERE g.name LIKE ? OR g.description LIKE ?
-               ORDER BY g.name
-               LIMIT ?''',
-            (session['user_id'], f'%{query}%', f'%{query}%', limit)
+            SEARCH_GROUPS_SQL.format(join=join, condition=condition, order=order or 'g.name'),
+            (session['user_id'], *params, limit)
         ).fetchall()
         results['groups'] = [dict(group) for group in groups]
     
     if type_filter in ['all', 'posts']:
+        join, condition, order, params = search_filter('posts', 'p', ('description',), query)
         posts = db.execute(
-            '''SELECT p.*, u.username, u.real_name, u.profile_pic,
-               (SELECT COUNT(*) FROM likes WHERE post_id = p.id) as likes_count,
-               (SELECT COUNT(*) FROM comments WHERE post_id = p.id) as comments_count,
-               EXISTS(SELECT 1 FROM likes WHERE post_id = p.id AND user_id = ?) as is_liked
-               FROM posts p
-               JOIN users u ON p.user_id = u.id
-               WHERE p.description LIKE ? AND p.visibility IN ('public', 
-                   CASE WHEN p.user_id IN (SELECT followed_id FROM followers WHERE follower_id = ? AND status = 'accepted') THEN 'friends' ELSE 'public' END,
-                   CASE WHEN p.user_id = ? THEN 'private' ELSE 'public' END)
-               ORDER BY p.created_at DESC
-               LIMIT ?''',
-            (session['user_id'], f'%{query}%', session['user_id'], session['user_id'], limit)
+            SEARCH_POSTS_SQL.format(join=join, condition=condition, order=order or 'p.created_at DESC'),
+            (*params, session['user_id'], session['user_id'], limit)
         ).fetchall()
-        results['posts'] = [dict(post) for post in posts]
+        results['posts'] = hydrate_viewer_state(db, session['user_id'], assemble_posts(db, posts))
     
     return jsonify(results)
 
@@ -1412,6 +4549,12 @@ def admin_get_users():
     
     return jsonify([dict(user) for user in users])
 
+@app.route('/api/admin/cache-stats', methods=['GET'])
+@admin_required
+def admin_cache_stats():
+    # Counts are per worker process
+    return jsonify({'pid': os.getpid(), 'objects': get_object_cache().stats()})
+
 @app.route('/api/admin/users/<int:user_id>/ban', methods=['POST'])
 @admin_required
 def admin_ban_user(user_id):
@@ -1422,6 +4565,8 @@ def admin_ban_user(user_id):
         'UPDATE users SET is_banned = TRUE WHERE id = ?', (user_id,)
     )
     db.commit()
+    get_object_cache().delete('user', user_id)
+    refresh_suggestions(db, user_id)
     
     return jsonify({'success': True})
 
@@ -1484,10 +4629,433 @@ def admin_resolve_report(report_id):
     
     return jsonify({'success': True})
 
-# File serving route
+# File serving routes. Media store paths name their content, so they are
+# cached forever with the SHA-256 as a strong ETag; other files revalidate.
+# Range requests (video seeking) and conditional GETs are answered by
+# send_from_directory, or by the front proxy when serving is offloaded.
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+def set_cache_policy(response, max_age, immutable=False):
+    response.headers['Cache-Control'] = f'public, max-age={max_age}' + (', immutable' if immutable else '')
+    return response
+
 @app.route('/uploads/<path:filename>')
 def serve_upload(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    immutable = filename.startswith(MEDIA_STORE + '/')
+    max_age = IMMUTABLE_MAX_AGE if immutable else app.config['UPLOAD_CACHE_MAX_AGE']
+    # Strong ETag straight from the content hash in the file name
+    etag = os.path.splitext(os.path.basename(filename))[0] if immutable else True
+    
+    prefix = app.config['UPLOAD_ACCEL_REDIRECT_PREFIX']
+    if prefix:
+        path = safe_join(app.config['UPLOAD_FOLDER'], filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        response = app.response_class(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = f"{prefix.rstrip('/')}/{filename}"
+        if immutable:
+            response.set_etag(etag)
+        return set_cache_policy(response, max_age, immutable)
+    
+    response = send_from_directory(app.config['UPLOAD_FOLDER'], filename, max_age=max_age, etag=etag)
+    return set_cache_policy(response, max_age, immutable)
+
+# Static assets. Templates link them through asset_url(), which adds a content
+# hash so a deploy changes the URL and the old one can be cached forever.
+# Copies written by compress-static (.br, .gz) are served to clients that
+# accept them, as long as they are newer than the original.
+STATIC_ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+_asset_versions = {}
+
+def asset_version(filename):
+    path = os.path.join(app.static_folder, filename)
+    mtime = os.path.getmtime(path)
+    cached = _asset_versions.get(filename)
+    if cached is None or cached[0] != mtime:
+        with open(path, 'rb') as f:
+            cached = (mtime, hashlib.sha256(f.read()).hexdigest()[:12])
+        _asset_versions[filename] = cached
+    return cached[1]
+
+@app.template_global()
+def asset_url(filename):
+    return url_for('static', filename=filename, v=asset_version(filename))
+
+def serve_static(filename):
+    original = safe_join(app.static_folder, filename)
+    if original is None or not os.path.isfile(original):
+        abort(404)
+    # Only the current version is immutable: a stale or made-up v must not
+    # pin whatever the file holds now in caches for a year
+    versioned = request.args.get('v') == asset_version(filename)
+    max_age = IMMUTABLE_MAX_AGE if versioned else app.config['STATIC_CACHE_MAX_AGE']
+    
+    for encoding, suffix in STATIC_ENCODINGS:
+        compressed = original + suffix
+        if (request.accept_encodings[encoding] and os.path.isfile(compressed)
+                and os.path.getmtime(compressed) >= os.path.getmtime(original)):
+            response = send_from_directory(
+                app.static_folder, filename + suffix, max_age=max_age,
+                mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            )
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(app.static_folder, filename, max_age=max_age)
+    
+    response.vary.add('Accept-Encoding')
+    return set_cache_policy(response, max_age, versioned)
+
+app.view_functions['static'] = serve_static
+
+# CLI commands
+@app.cli.command('init-db')
+def init_db_command():
+    """Create the schema and apply pending migrations."""
+    init_db()
+    click.echo('Database initialized.')
+
+@app.cli.command('rebuild-counters')
+def rebuild_counters_command():
+    """Recompute engagement and unread counters from the base tables."""
+    with app.app_context():
+        db = get_db()
+        try:
+            db.executescript(
+                'BEGIN;\n' + COUNTER_REBUILD_SQL + UNREAD_REBUILD_SQL + USER_STATS_REBUILD_SQL + '\nCOMMIT;'
+            )
+        except Exception:
+            db.rollback()
+            raise
+    unread_cache.clear()
+    user_stats_cache.clear()
+    click.echo('Engagement and unread counters rebuilt.')
+
+SEARCH_INDEXES = ('users', 'groups', 'posts')
+
+@app.cli.command('rebuild-search-index')
+@click.option('--table', 'tables', multiple=True, type=click.Choice(SEARCH_INDEXES),
+              help='Only rebuild this index (repeatable).')
+@click.option('--merge', type=int, default=0,
+              help='Merge up to this many pages of index segments instead of rebuilding.')
+def rebuild_search_index_command(tables, merge):
+    """Rebuild the full-text search indexes from their source tables.
+    
+    Each index is rebuilt in its own transaction. --merge does a bounded
+    amount of incremental segment merging, cheap enough to run from cron.
+    """
+    if database_dialect() != 'sqlite':
+        click.echo('Full-text search indexes only exist on SQLite.')
+        return
+    with app.app_context():
+        db = get_db()
+        for table in tables or SEARCH_INDEXES:
+            fts = f'{table}_fts'
+            if merge:
+                db.execute(f"INSERT INTO {fts} ({fts}, rank) VALUES ('merge', ?)", (merge,))
+            else:
+                db.execute(f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')")
+            db.commit()
+            click.echo(f'{fts} {"merged" if merge else "rebuilt"}.')
+
+@app.cli.command('refresh-friend-suggestions')
+@click.option('--all', 'refresh_all', is_flag=True, help='Rescore every user, not just queued ones.')
+@click.option('--batch-size', default=100, help='Users rescored per transaction.')
+def refresh_friend_suggestions_command(refresh_all, batch_size):
+    """Recompute stored friend suggestions for queued (or all) users."""
+    with app.app_context():
+        db = get_db()
+        source = 'SELECT id FROM users WHERE is_banned = FALSE' if refresh_all else \
+            'SELECT user_id FROM friend_suggestion_queue'
+        user_ids = [row[0] for row in db.execute(source).fetchall()]
+        for start in range(0, len(user_ids), batch_size):
+            for user_id in user_ids[start:start + batch_size]:
+                store_friend_suggestions(db, user_id)
+            db.commit()
+    click.echo(f'Friend suggestions refreshed for {len(user_ids)} users.')
+
+def stored_uploads():
+    """Yield the path of every upload file, legacy folders and media store alike."""
+    for folder in [*UPLOAD_FOLDERS.values(), MEDIA_STORE]:
+        for root, _, filenames in os.walk(os.path.join(app.config['UPLOAD_FOLDER'], folder)):
+            for filename in sorted(filenames):
+                yield os.path.relpath(os.path.join(root, filename), app.config['UPLOAD_FOLDER']).replace(os.sep, '/')
+
+@app.cli.command('process-media')
+@click.option('--force', is_flag=True, help='Regenerate variants that already exist.')
+def process_media_command(force):
+    """Generate variants for existing uploads."""
+    with app.app_context():
+        db = get_db()
+        done = {row[0] for row in db.execute('SELECT DISTINCT media_path FROM media_variants').fetchall()}
+        processed = 0
+        for media_path in stored_uploads():
+            if media_type_of(media_path) is None or (media_path in done and not force):
+                continue
+            try:
+                processed += process_media(db, media_path) > 0
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                click.echo(f'{media_path}: {e}', err=True)
+    click.echo(f'Variants generated for {processed} uploads.')
+
+@app.cli.command('compress-static')
+def compress_static_command():
+    """Write precompressed .gz (and .br, with brotli installed) copies of CSS and JS."""
+    written = 0
+    for filename in sorted(os.listdir(app.static_folder)):
+        if not filename.endswith(('.css', '.js')):
+            continue
+        path = os.path.join(app.static_folder, filename)
+        with open(path, 'rb') as f:
+            data = f.read()
+        with open(path + '.gz', 'wb') as f:
+            f.write(gzip.compress(data, compresslevel=9))
+        written += 1
+        if brotli is not None:
+            with open(path + '.br', 'wb') as f:
+                f.write(brotli.compress(data, quality=11))
+            written += 1
+    click.echo(f'Wrote {written} compressed files.')
+
+# Columns that may hold an upload: a media store path, or the bare name of a
+# legacy file in the folder of the given kind
+MEDIA_REFERENCES = (
+    ('posts', 'content', 'post'),
+    ('reels', 'video_url', 'reel'),
+    ('stories', 'media_url', 'story'),
+    ('messages', 'media_url', 'message'),
+    ('users', 'profile_pic', 'profile'),
+    ('groups', 'profile_pic', 'profile'),
+)
+
+@app.cli.command('gc-media')
+@click.option('--recount', is_flag=True, help='Recompute reference counts from the referencing tables first.')
+def gc_media_command(recount):
+    """Delete unreferenced media blobs, legacy uploads and variants, and stray files."""
+    with app.app_context():
+        db = get_db()
+        if recount:
+            counts = Counter()
+            for table, column, _ in MEDIA_REFERENCES:
+                counts.update(row[0] for row in db.execute(
+                    f"SELECT {column} FROM {table} WHERE {column} LIKE '{MEDIA_STORE}/%'"
+                ).fetchall())
+            paths = [row[0] for row in db.execute('SELECT path FROM media_blobs').fetchall()]
+            db.executemany(
+                'UPDATE media_blobs SET ref_count = ? WHERE path = ?', [(counts[path], path) for path in paths]
+            )
+            db.commit()
+        
+        unreferenced = [row[0] for row in db.execute(
+            'SELECT path FROM media_blobs WHERE ref_count <= 0'
+        ).fetchall()]
+        blobs = sum(collect_blob(db, path) for path in unreferenced)
+        
+        # Files left behind by uploads whose transaction rolled back, legacy
+        # uploads nothing names any more, and variants of either. Only files
+        # older than an hour are touched, so in-flight uploads are left alone.
+        known = {row[0] for row in db.execute('SELECT path FROM media_blobs').fetchall()}
+        for table, column, kind in MEDIA_REFERENCES:
+            known.update(row[0] for row in db.execute(
+                f"SELECT DISTINCT {upload_path_sql(column, kind)} FROM {table} WHERE {column} IS NOT NULL"
+            ).fetchall())
+        cutoff = time.time() - 3600
+        strays = [
+            path for path in stored_uploads()
+            if path not in known and os.path.getmtime(os.path.join(app.config['UPLOAD_FOLDER'], path)) < cutoff
+        ]
+        
+        variants = db.execute('SELECT media_path, variant_path FROM media_variants').fetchall()
+        orphaned = [(row[0], row[1]) for row in variants if row[0] not in known]
+        db.executemany('DELETE FROM media_variants WHERE media_path = ? AND variant_path = ?', orphaned)
+        recorded = {row[1] for row in variants}
+        for root, _, filenames in os.walk(os.path.join(app.config['UPLOAD_FOLDER'], 'variants')):
+            for filename in sorted(filenames):
+                full_path = os.path.join(root, filename)
+                path = os.path.relpath(full_path, app.config['UPLOAD_FOLDER']).replace(os.sep, '/')
+                if path not in recorded and os.path.getmtime(full_path) < cutoff:
+                    strays.append(path)
+        commit_removing_files(db, [variant_path for _, variant_path in orphaned] + strays)
+    click.echo(f'Removed {blobs} unreferenced blobs, {len(orphaned)} orphaned variants and {len(strays)} stray files.')
+
+@app.cli.command('purge-uploads')
+def purge_uploads_command():
+    """Delete chunked upload sessions idle for UPLOAD_SESSION_HOURS."""
+    cutoff = datetime.utcnow() - timedelta(hours=app.config['UPLOAD_SESSION_HOURS'])
+    with app.app_context():
+        db = get_db()
+        stale = db.execute(
+            'DELETE FROM upload_sessions WHERE updated_at < ? RETURNING id', (cutoff.strftime('%Y-%m-%d %H:%M:%S'),)
+        ).fetchall()
+        db.commit()
+    for row in stale:
+        if os.path.exists(upload_part_path(row[0])):
+            os.remove(upload_part_path(row[0]))
+    click.echo(f'Purged {len(stale)} stale uploads.')
+
+@app.cli.command('purge-expired')
+@click.option('--batch-size', default=None, type=int, help='Rows deleted per transaction.')
+def purge_expired_command(batch_size):
+    """Delete expired stories and disappearing messages now."""
+    stories, messages = purge_expired(batch_size or app.config['EXPIRY_BATCH_SIZE'])
+    click.echo(f'Purged {stories} stories and {messages} messages.')
+
+# Statements on the hot routes, with sample arguments. The routes' own SQL
+# constants are used wherever a route has one, so a change to a route's
+# query is what gets checked. check-query-plans and tests/test_query_plans.py
+# fail if any of them needs a full table scan, so a dropped or mismatched
+# index shows up before it reaches production.
+SAMPLE_TIME = '2024-01-01 00:00:00'
+SAMPLE_CURSOR = encode_cursor(SAMPLE_TIME, 1)
+
+def sample_keyset(alias, **columns):
+    return keyset_clause(alias, SAMPLE_CURSOR, **columns)[0]
+
+def sample_search(template, table, alias, columns, before, after):
+    join, condition, order, params = search_filter(table, alias, columns, 'al')
+    return (template.format(join=join, condition=condition, order=order or f'{alias}.id'),
+            (*before, *params, *after))
+
+HOT_QUERIES = {
+    'get_posts_timeline': (
+        FEED_TIMELINE_SQL.format(keyset=sample_keyset('t', id_column='post_id')), (1, SAMPLE_TIME, 1, 11)
+    ),
+    'get_posts_pulled': (FEED_PULLED_POSTS_SQL.format(keyset=sample_keyset('p')), (1, SAMPLE_TIME, 1, 11)),
+    'get_posts_pulled_reposts': (
+        FEED_PULLED_REPOSTS_SQL.format(keyset=sample_keyset('r', id_column='original_post_id')),
+        (1, SAMPLE_TIME, 1, 11)
+    ),
+    'timeline_unfollow': (
+        'DELETE FROM timeline WHERE user_id = ? AND actor_id = ?',
+        (1, 2)
+    ),
+    'timeline_refill_reposts': (
+        '''SELECT r.original_post_id FROM reposts r
+           JOIN followers f ON f.followed_id = r.user_id AND f.status = 'accepted'
+           WHERE f.follower_id = ? AND r.original_post_id = ? AND r.fanned_out = TRUE''',
+        (1, 1)
+    ),
+    'profile_user': (PROFILE_USER_SQL, (1, 2)),
+    'profile_stats': (USER_STATS_SQL, (1,)),
+    'post_is_liked': ('SELECT 1 FROM likes WHERE post_id = ? AND user_id = ?', (1, 1)),
+    'post_is_saved': ('SELECT 1 FROM saved_items WHERE post_id = ? AND user_id = ?', (1, 1)),
+    'hydrate_liked': ('SELECT post_id FROM likes WHERE user_id = ? AND post_id IN (?, ?)', (1, 1, 2)),
+    'hydrate_saved': ('SELECT reel_id FROM saved_items WHERE user_id = ? AND reel_id IN (?, ?)', (1, 1, 2)),
+    'hydrate_reposted': (
+        'SELECT original_post_id FROM reposts WHERE user_id = ? AND original_post_id IN (?, ?)', (1, 1, 2)
+    ),
+    'hydrate_blocked': ('SELECT blocked_id FROM blocks WHERE blocker_id = ? AND blocked_id IN (?, ?)', (1, 1, 2)),
+    'get_reels': (
+        '''SELECT r.id FROM reels r WHERE (r.created_at, r.id) < (?, ?)
+           ORDER BY r.created_at DESC, r.id DESC LIMIT 10''',
+        ('2024-01-01 00:00:00', 1)
+    ),
+    'get_post_comments': (POST_COMMENTS_SQL.format(keyset=sample_keyset('c')), (1, SAMPLE_TIME, 1, 51)),
+    'get_stories': (
+        '''SELECT s.id FROM stories s
+           WHERE s.user_id IN (
+               SELECT followed_id FROM followers
+               WHERE follower_id = ? AND status = 'accepted'
+           ) AND s.expires_at > ?
+           ORDER BY s.created_at DESC''',
+        (1, '2024-01-01 00:00:00')
+    ),
+    'purge_expired_stories': (
+        'SELECT id FROM stories WHERE expires_at <= ? ORDER BY expires_at LIMIT 500',
+        ('2024-01-01 00:00:00',)
+    ),
+    'purge_expired_messages': (
+        'SELECT id FROM messages WHERE expires_at <= ? ORDER BY expires_at LIMIT 500',
+        ('2024-01-01 00:00:00',)
+    ),
+    'get_messages_direct': (
+        '''SELECT m.id FROM messages m
+           WHERE ((m.sender_id = ? AND m.receiver_id = ?)
+           OR (m.sender_id = ? AND m.receiver_id = ?)) AND (m.created_at, m.id) < (?, ?)
+           AND (m.expires_at IS NULL OR m.expires_at > ?)
+           ORDER BY m.created_at DESC, m.id DESC LIMIT 50''',
+        (1, 2, 2, 1, '2024-01-01 00:00:00', 1, '2024-01-01 00:00:00')
+    ),
+    'get_messages_group': (
+        '''SELECT m.id FROM messages m WHERE m.group_id = ? AND (m.created_at, m.id) < (?, ?)
+           ORDER BY m.created_at DESC, m.id DESC LIMIT 50''',
+        (1, '2024-01-01 00:00:00', 1)
+    ),
+    'get_inbox': (INBOX_SQL.format(keyset=sample_keyset('c', time_column='last_activity')), (1, SAMPLE_TIME, 1, 51)),
+    'search_users': sample_search(SEARCH_USERS_SQL, 'users', 'u', ('username', 'real_name'), (1,), (20,)),
+    'search_groups': sample_search(SEARCH_GROUPS_SQL, 'groups', 'g', ('name', 'description'), (1,), (20,)),
+    'search_posts': sample_search(SEARCH_POSTS_SQL, 'posts', 'p', ('description',), (), (1, 1, 20)),
+    'get_friend_suggestions': (
+        '''SELECT u.id FROM friend_suggestions fs JOIN users u ON u.id = fs.suggested_id
+           WHERE fs.user_id = ? AND u.is_banned = FALSE
+           ORDER BY fs.score DESC, fs.suggested_id DESC LIMIT 10''',
+        (1,)
+    ),
+    'get_notifications': (NOTIFICATIONS_SQL.format(keyset=sample_keyset('n')), (1, SAMPLE_TIME, 1, 21)),
+    'notification_count_actor': (NOTIFICATION_COUNT_ACTOR_SQL, (1, 'like:post:1', 2)),
+    'unread_notification_count': (
+        'SELECT COUNT(*) FROM notifications WHERE user_id = ? AND is_read = FALSE',
+        (1,)
+    ),
+    'followers_count': (
+        "SELECT COUNT(*) FROM followers WHERE followed_id = ? AND status = 'accepted'",
+        (1,)
+    ),
+    'friends_count': (
+        'SELECT COUNT(*) FROM friends WHERE user1_id = ? OR user2_id = ?',
+        (1, 1)
+    ),
+    'get_groups': (
+        'SELECT g.id FROM groups g JOIN group_members gm ON g.id = gm.group_id WHERE gm.user_id = ?',
+        (1,)
+    ),
+    'get_group_join_requests': (
+        '''SELECT r.id FROM group_join_requests r
+           WHERE r.group_id = ? AND r.status = 'pending' AND (r.created_at, r.id) < (?, ?)
+           ORDER BY r.created_at DESC, r.id DESC LIMIT 50''',
+        (1, '2024-01-01 00:00:00', 1)
+    ),
+}
+
+# Pages that must come straight off an index in order, without a sort
+INDEX_ORDERED_QUERIES = {
+    'get_posts_timeline', 'get_reels', 'get_post_comments', 'purge_expired_stories', 'purge_expired_messages',
+    'get_messages_group', 'get_notifications', 'get_group_join_requests', 'get_inbox',
+}
+
+def find_table_scans(db):
+    """Return {query name: [plan lines]} for hot queries that scan a table.
+    
+    Queries in INDEX_ORDERED_QUERIES are also reported when they sort.
+    """
+    offenders = {}
+    for name, (sql, params) in HOT_QUERIES.items():
+        plan = db.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+        scans = [row['detail'] for row in plan
+                 if row['detail'].startswith('SCAN ') and 'INDEX' not in row['detail']
+                 or name in INDEX_ORDERED_QUERIES and row['detail'].startswith('USE TEMP B-TREE')]
+        if scans:
+            offenders[name] = scans
+    return offenders
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    """Fail if any hot query needs a full table scan."""
+    if database_dialect() != 'sqlite':
+        click.echo('Query plan checks only run against SQLite.')
+        return
+    init_db()
+    with app.app_context():
+        offenders = find_table_scans(get_db())
+    
+    for name, scans in offenders.items():
+        click.echo(f'{name}: {"; ".join(scans)}', err=True)
+    
+    if offenders:
+        raise SystemExit(1)
+    click.echo(f'{len(HOT_QUERIES)} hot queries checked, no table scans.')
 
 if __name__ == '__main__':
     init_db()
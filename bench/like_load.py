@@ -0,0 +1,111 @@
+"""Like throughput on one hot post, with and without write-behind.
+
+Every simulated user toggles their like on the same post over and over
+from its own thread, in one or more worker processes, against a throwaway
+SQLite database. Each run reports likes/s and checks that posts.likes_count
+and user_stats agree with the likes table afterwards.
+
+    python bench/like_load.py [--processes 1] [--threads 16] [--toggles 401] [--mode both]
+
+With more than one process, write-behind is expected to fall back to
+synchronous writes.
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as appmod  # noqa: E402
+
+app = appmod.app
+
+def toggle_likes(user_id, toggles):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = user_id
+        session['username'] = f'user{user_id}'
+    for _ in range(toggles):
+        client.post('/api/posts/1/like')
+
+def run_worker(user_ids, toggles, ready, start):
+    threads = [threading.Thread(target=toggle_likes, args=(user_id, toggles)) for user_id in user_ids]
+    ready.wait()
+    start.wait()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if app.config['LIKE_WRITE_BEHIND']:
+        appmod.get_engagement_buffer().flush()
+
+def run(write_behind, args):
+    app.config['DATABASE'] = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    app.config['TESTING'] = True
+    app.config['EXPIRY_INTERVAL'] = None
+    app.config['LIKE_WRITE_BEHIND'] = write_behind
+    app.config['LIKE_JOURNAL_FSYNC'] = not args.no_fsync
+    shutil.rmtree(os.path.join(app.instance_path, 'journal'), ignore_errors=True)
+    appmod.init_db()
+    
+    with app.app_context():
+        db = appmod.get_db()
+        users = args.processes * args.threads
+        db.executemany(
+            'INSERT INTO users (username, password, unique_key, real_name) VALUES (?, ?, ?, ?)',
+            [(f'bench{i}', 'x', f'key{i}', 'Bench') for i in range(users)]
+        )
+        author = db.execute("SELECT id FROM users WHERE username = 'bench0'").fetchone()[0]
+        db.execute("INSERT INTO posts (user_id, content_type, content) VALUES (?, 'text', 'hot')", (author,))
+        db.commit()
+        user_ids = [row[0] for row in db.execute("SELECT id FROM users WHERE username LIKE 'bench%' ORDER BY id")]
+    
+    # Workers fork with a copy of the app; each opens its own pool and buffer
+    context = multiprocessing.get_context('fork')
+    ready = context.Barrier(args.processes + 1)
+    start = context.Event()
+    workers = [
+        context.Process(target=run_worker, args=(
+            user_ids[i * args.threads:(i + 1) * args.threads], args.toggles, ready, start
+        ))
+        for i in range(args.processes)
+    ]
+    for worker in workers:
+        worker.start()
+    ready.wait()
+    began = time.perf_counter()
+    start.set()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - began
+    
+    with app.app_context():
+        db = appmod.get_db()
+        counter, rows = db.execute('SELECT likes_count, (SELECT COUNT(*) FROM likes) FROM posts').fetchone()
+        stats = db.execute('SELECT likes_count FROM user_stats WHERE user_id = ?', (author,)).fetchone()
+    stats = stats[0] if stats else 0
+    status = 'ok' if counter == rows == stats else 'MISMATCH'
+    label = 'write-behind' if write_behind else 'synchronous'
+    print(f'{label:13} {len(user_ids) * args.toggles / elapsed:8.0f} likes/s   '
+          f'likes_count={counter} rows={rows} user_stats={stats} {status}')
+    return status == 'ok'
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=16, help='users (threads) per process')
+    parser.add_argument('--toggles', type=int, default=401, help='like toggles per user (odd leaves every user liking)')
+    parser.add_argument('--mode', choices=('off', 'on', 'both'), default='both')
+    parser.add_argument('--no-fsync', action='store_true', help='run write-behind with LIKE_JOURNAL_FSYNC off')
+    args = parser.parse_args()
+    
+    modes = {'off': [False], 'on': [True], 'both': [False, True]}[args.mode]
+    consistent = all([run(write_behind, args) for write_behind in modes])
+    sys.exit(0 if consistent else 1)
+
+if __name__ == '__main__':
+    main()
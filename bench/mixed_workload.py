@@ -0,0 +1,181 @@
+"""Requests/s for a mixed read/write workload, default vs tuned SQLite.
+
+Worker processes with several threads each replay a mix of feed, profile,
+badge and conversation reads with likes, comments, posts and messages
+against a throwaway SQLite database. The "default" run uses SQLite's own
+settings (rollback journal, synchronous=FULL, no mmap, small page cache,
+128 cached statements) and a fresh connection per request, which is what
+get_db() did before connections were tuned and pooled; the "tuned" run
+uses the SQLITE_* settings from config.py and the per-worker pool.
+
+    python bench/mixed_workload.py [--processes 4] [--threads 8] [--requests 300] [--writes 0.3]
+
+Failed requests (for example "database is locked") are counted, not retried.
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as appmod  # noqa: E402
+
+app = appmod.app
+
+DEFAULT_SETTINGS = {
+    'SQLITE_JOURNAL_MODE': 'DELETE',
+    'SQLITE_SYNCHRONOUS': 'FULL',
+    'SQLITE_BUSY_TIMEOUT_MS': 5000,  # sqlite3.connect's default timeout
+    'SQLITE_MMAP_SIZE': 0,
+    'SQLITE_CACHE_SIZE_KB': 2000,
+    'SQLITE_TEMP_STORE': 'DEFAULT',
+    'SQLITE_CACHED_STATEMENTS': 128,
+}
+
+class UnpooledConnections(appmod.ConnectionPool):
+    """Opens a connection per request and closes it afterwards."""
+    
+    def release(self, db):
+        try:
+            db.close()
+        finally:
+            self._slots.release()
+
+def one_request(client, user_id, user_ids, post_ids, writes, rng):
+    other = rng.choice(user_ids)
+    post_id = rng.choice(post_ids)
+    if rng.random() < writes:
+        return rng.choice((
+            lambda: client.post(f'/api/posts/{post_id}/like'),
+            lambda: client.post(f'/api/posts/{post_id}/comment', data={'content': 'nice'}),
+            lambda: client.post('/api/posts/create', data={'description': 'bench post'}),
+            lambda: client.post('/api/messages/send', data={'receiver_id': other, 'content': 'hi'}),
+        ))()
+    return rng.choice((
+        lambda: client.get('/api/posts', query_string={'cursor': ''}),
+        lambda: client.get('/api/user/profile', query_string={'user_id': other}),
+        lambda: client.get('/api/notifications/count'),
+        lambda: client.get('/api/messages'),
+        lambda: client.get(f'/api/posts/{post_id}/comments'),
+    ))()
+
+def run_user(user_id, user_ids, post_ids, args, failures):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = user_id
+        session['username'] = f'bench{user_id}'
+    rng = random.Random(user_id)
+    for _ in range(args.requests):
+        try:
+            response = one_request(client, user_id, user_ids, post_ids, args.writes, rng)
+            failed = response.status_code >= 500
+        except Exception:
+            failed = True
+        if failed:
+            failures.append(user_id)
+
+def run_worker(user_ids, all_user_ids, post_ids, args, tuned, ready, start, failed_total):
+    if not tuned:
+        appmod._pool = UnpooledConnections(appmod.connect_db, app.config['DB_POOL_SIZE'], app.config['DB_POOL_TIMEOUT'])
+        appmod._pool_key = (os.getpid(), app.config['DATABASE'])
+    failures = []
+    threads = [threading.Thread(target=run_user, args=(user_id, all_user_ids, post_ids, args, failures))
+               for user_id in user_ids]
+    ready.wait()
+    start.wait()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    appmod.get_notification_pipeline().flush()
+    with failed_total.get_lock():
+        failed_total.value += len(failures)
+
+def seed(args):
+    users = args.processes * args.threads
+    with app.app_context():
+        db = appmod.get_db()
+        db.executemany(
+            'INSERT INTO users (username, password, unique_key, real_name) VALUES (?, ?, ?, ?)',
+            [(f'bench{i}', 'x', f'key{i}', 'Bench') for i in range(users)]
+        )
+        user_ids = [row[0] for row in db.execute("SELECT id FROM users WHERE username LIKE 'bench%' ORDER BY id")]
+        rng = random.Random(0)
+        db.executemany(
+            "INSERT INTO followers (follower_id, followed_id, status) VALUES (?, ?, 'accepted') ON CONFLICT DO NOTHING",
+            [(user_id, followed) for user_id in user_ids for followed in rng.sample(user_ids, min(20, users))
+             if followed != user_id]
+        )
+        db.executemany(
+            "INSERT INTO posts (user_id, content_type, content, description) VALUES (?, 'text', '', 'seed')",
+            [(rng.choice(user_ids),) for _ in range(args.posts)]
+        )
+        db.execute(
+            '''INSERT INTO timeline (user_id, post_id, actor_id, created_at)
+               SELECT f.follower_id, p.id, p.user_id, p.created_at
+               FROM followers f JOIN posts p ON p.user_id = f.followed_id WHERE TRUE
+               ON CONFLICT DO NOTHING'''
+        )
+        db.commit()
+        post_ids = [row[0] for row in db.execute('SELECT id FROM posts')]
+    return user_ids, post_ids
+
+def run(tuned, args):
+    saved = {key: app.config[key] for key in DEFAULT_SETTINGS}
+    if not tuned:
+        app.config.update(DEFAULT_SETTINGS)
+    app.config['DATABASE'] = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    app.config['TESTING'] = True
+    app.config['EXPIRY_INTERVAL'] = None
+    app.config['LIKE_WRITE_BEHIND'] = False
+    appmod.init_db()
+    user_ids, post_ids = seed(args)
+    # Forked workers must open their own connections
+    appmod.get_pool().close()
+    
+    context = multiprocessing.get_context('fork')
+    ready = context.Barrier(args.processes + 1)
+    start = context.Event()
+    failed_total = context.Value('i', 0)
+    workers = [
+        context.Process(target=run_worker, args=(
+            user_ids[i * args.threads:(i + 1) * args.threads], user_ids, post_ids, args, tuned,
+            ready, start, failed_total
+        ))
+        for i in range(args.processes)
+    ]
+    for worker in workers:
+        worker.start()
+    ready.wait()
+    began = time.perf_counter()
+    start.set()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - began
+    app.config.update(saved)
+    
+    total = len(user_ids) * args.requests
+    label = 'tuned' if tuned else 'default'
+    print(f'{label:8} {total / elapsed:8.0f} req/s   {total} requests in {elapsed:.1f}s, '
+          f'{failed_total.value} failed')
+    return total / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=8, help='users (threads) per process')
+    parser.add_argument('--requests', type=int, default=300, help='requests per user')
+    parser.add_argument('--writes', type=float, default=0.3, help='share of requests that write')
+    parser.add_argument('--posts', type=int, default=2000, help='posts seeded before the run')
+    args = parser.parse_args()
+    
+    before = run(False, args)
+    after = run(True, args)
+    print(f'speed-up x{after / before:.2f}')
+
+if __name__ == '__main__':
+    main()
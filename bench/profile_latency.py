@@ -0,0 +1,79 @@
+"""Profile-view latency for a user whose posts have 100k likes.
+
+Builds a throwaway SQLite database, then times GET /api/user/profile for
+that user with the stats cache cold and warm, next to the COUNT(*) over
+likes that the profile used to run on every view.
+
+    python bench/profile_latency.py [--likes 100000] [--views 200]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as appmod  # noqa: E402
+
+app = appmod.app
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--likes', type=int, default=100000)
+    parser.add_argument('--fans', type=int, default=2000, help='distinct users doing the liking')
+    parser.add_argument('--views', type=int, default=200)
+    args = parser.parse_args()
+    
+    app.config['DATABASE'] = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    app.config['TESTING'] = True
+    appmod.init_db()
+    
+    client = app.test_client()
+    client.post('/register', data={'username': 'star', 'password': 'secret1!', 'real_name': 'Star'})
+    client.post('/login', data={'username': 'star', 'password': 'secret1!'})
+    posts = (args.likes + args.fans - 1) // args.fans
+    with app.app_context():
+        db = appmod.get_db()
+        star_id = db.execute("SELECT id FROM users WHERE username = 'star'").fetchone()['id']
+        db.executemany(
+            "INSERT INTO users (username, password, unique_key) VALUES (?, 'x', ?)",
+            [(f'fan{i}', f'key{i}') for i in range(args.fans)]
+        )
+        first_fan = db.execute("SELECT id FROM users WHERE username = 'fan0'").fetchone()['id']
+        db.executemany(
+            "INSERT INTO posts (user_id, content_type, description) VALUES (?, 'text', 'post')",
+            [(star_id,)] * posts
+        )
+        first_post = db.execute('SELECT MIN(id) FROM posts WHERE user_id = ?', (star_id,)).fetchone()[0]
+        db.executemany(
+            'INSERT INTO likes (user_id, post_id) VALUES (?, ?)',
+            [(first_fan + i % args.fans, first_post + i // args.fans) for i in range(args.likes)]
+        )
+        db.commit()
+    app.test_cli_runner().invoke(args=['rebuild-counters'])
+    
+    with app.app_context():
+        db = appmod.get_db()
+        start = time.perf_counter()
+        for _ in range(20):
+            db.execute(
+                '''SELECT COUNT(*) FROM likes
+                   WHERE post_id IN (SELECT id FROM posts WHERE user_id = ?)
+                   OR reel_id IN (SELECT id FROM reels WHERE user_id = ?)''',
+                (star_id, star_id)
+            ).fetchone()
+        print(f'old likes COUNT(*):   {(time.perf_counter() - start) / 20 * 1000:8.3f} ms')
+    
+    appmod.user_stats_cache.clear()
+    start = time.perf_counter()
+    response = client.get('/api/user/profile', query_string={'user_id': star_id})
+    print(f'profile view (cold):  {(time.perf_counter() - start) * 1000:8.3f} ms')
+    
+    start = time.perf_counter()
+    for _ in range(args.views):
+        response = client.get('/api/user/profile', query_string={'user_id': star_id})
+    print(f'profile view (warm):  {(time.perf_counter() - start) / args.views * 1000:8.3f} ms')
+    print(f"likes_count = {response.get_json()['likes_count']} (expected {args.likes})")
+
+if __name__ == '__main__':
+    main()
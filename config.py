@@ -8,5 +8,120 @@ SECRET_KEY = os.urandom(24)
 ADMIN_USERNAME = 'admin'
 ADMIN_PASS = 'Admin123!'  # Change this in production
 
-# Database configuration
+# Database configuration: an SQLite file name or a postgresql:// URL
 DATABASE = 'sociafam.db'
+
+# Largest page any list endpoint returns, whatever limit a client asks for
+MAX_PAGE_SIZE = 100
+
+# Home timeline fan-out. Authors with more accepted followers than the
+# threshold are not fanned out on write; their posts are merged in at read time.
+FANOUT_FOLLOWER_THRESHOLD = 10000
+TIMELINE_BACKFILL_LIMIT = 200
+
+# SQLite connection tuning, applied to every connection the pool opens
+SQLITE_JOURNAL_MODE = 'WAL'
+SQLITE_SYNCHRONOUS = 'NORMAL'
+SQLITE_BUSY_TIMEOUT_MS = 5000
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024  # bytes
+SQLITE_CACHE_SIZE_KB = 64 * 1024
+SQLITE_TEMP_STORE = 'MEMORY'
+SQLITE_CACHED_STATEMENTS = 512
+
+# Connection pool shared by the request threads of each worker
+DB_POOL_SIZE = 10
+DB_POOL_TIMEOUT = 30  # seconds to wait for a free connection
+
+# Real-time event stream (/api/stream). Set PUBSUB_URL to a redis:// URL to
+# deliver events published on one worker to streams held by the others.
+PUBSUB_URL = None
+STREAM_HEARTBEAT_SECONDS = 15
+STREAM_QUEUE_SIZE = 100
+
+# Notification pipeline: queued notifications are coalesced and written in
+# batches every NOTIFICATION_FLUSH_INTERVAL seconds, or sooner once
+# NOTIFICATION_BATCH_SIZE distinct notifications are waiting
+NOTIFICATION_FLUSH_INTERVAL = 1.0
+NOTIFICATION_BATCH_SIZE = 500
+
+# Per-user unread notification/message counts cached in each worker
+UNREAD_CACHE_SIZE = 100000
+UNREAD_CACHE_TTL = 10  # seconds
+
+# Type-ahead suggestions: each worker reloads its in-memory name index every
+# SUGGEST_INDEX_REFRESH seconds and caches who each viewer follows
+SUGGEST_INDEX_REFRESH = 300  # seconds
+FOLLOWING_CACHE_SIZE = 10000
+FOLLOWING_CACHE_TTL = 60  # seconds
+
+# Per-viewer liked/saved/reposted flags for feed items, kept briefly so
+# paging through a feed only looks up items not seen yet
+VIEWER_STATE_CACHE_SIZE = 10000
+VIEWER_STATE_CACHE_TTL = 10  # seconds
+
+# Post bodies and user summary cards, cached by ID in each worker, or in a
+# Redis shared by all workers when OBJECT_CACHE_URL is a redis:// URL. Per-worker
+# caches hear each other's invalidations through PUBSUB_URL; without it an
+# entry is kept for OBJECT_CACHE_UNSYNCED_TTL at most
+OBJECT_CACHE_URL = None
+OBJECT_CACHE_SIZE = 50000
+OBJECT_CACHE_TTL = 60  # seconds
+OBJECT_CACHE_UNSYNCED_TTL = 5  # seconds
+
+# Write-behind likes and saves: toggles are answered from memory, journaled
+# under instance/journal and written every LIKE_FLUSH_INTERVAL seconds in
+# one transaction. Only buffers while a single worker process is running;
+# with more, toggles are written synchronously. LIKE_JOURNAL_FSYNC makes
+# each toggle wait for its journal entry to reach the disk (fsyncs are
+# shared by concurrent toggles). Needs a POSIX platform
+LIKE_WRITE_BEHIND = False
+LIKE_FLUSH_INTERVAL = 0.5  # seconds
+LIKE_JOURNAL_FSYNC = True
+
+# Friend suggestions stored per user by the suggestion engine
+FRIEND_SUGGESTIONS_TOP_K = 50
+
+# Friend lists cached per worker by the social graph
+FRIEND_GRAPH_CACHE_SIZE = 100000
+FRIEND_GRAPH_CACHE_TTL = 300  # seconds
+
+# Member and admin IDs of each group, cached per worker
+GROUP_MEMBERSHIP_CACHE_SIZE = 10000
+GROUP_MEMBERSHIP_CACHE_TTL = 300  # seconds
+
+# Per-user profile stats cached in each worker
+USER_STATS_CACHE_SIZE = 100000
+USER_STATS_CACHE_TTL = 30  # seconds
+
+# Media pipeline: uploads are stored as-is and MEDIA_WORKERS background
+# threads write resized WebP variants (needs Pillow) and video poster frames
+# (needs ffmpeg on the PATH)
+MEDIA_WORKERS = 2
+MEDIA_IMAGE_VARIANTS = {'thumb': 320, 'display': 1080}  # longest side in pixels
+MEDIA_WEBP_QUALITY = 80
+FFMPEG_PATH = 'ffmpeg'
+
+# Chunked uploads for reels and stories: chunks of up to UPLOAD_CHUNK_SIZE bytes
+# are streamed to disk; sessions idle for UPLOAD_SESSION_HOURS are purged
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_MAX_SIZE = 1024 * 1024 * 1024
+UPLOAD_SESSION_HOURS = 24
+
+# File caching. Content-addressed uploads (media/...) and versioned static
+# URLs are served as immutable; everything else is cached for these max-ages
+UPLOAD_CACHE_MAX_AGE = 86400  # seconds
+STATIC_CACHE_MAX_AGE = 3600  # seconds
+
+# Offload upload serving to the front proxy: an nginx internal location that
+# aliases static/uploads (e.g. '/protected-uploads'), or USE_X_SENDFILE for
+# Apache/lighttpd
+UPLOAD_ACCEL_REDIRECT_PREFIX = None
+USE_X_SENDFILE = False
+
+# Stories expire STORY_DURATION_HOURS after posting. Each worker purges
+# expired stories and disappearing messages every EXPIRY_INTERVAL seconds
+# (None to leave it to the purge-expired command), EXPIRY_BATCH_SIZE rows
+# per transaction
+STORY_DURATION_HOURS = 24
+EXPIRY_INTERVAL = 60
+EXPIRY_BATCH_SIZE = 500
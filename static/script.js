@@ -16,6 +16,7 @@ function checkLoginStatus() {
                 document.getElementById('home').style.display = 'block';
                 document.querySelectorAll('.modal').forEach(modal => modal.style.display = 'none');
                 loadHome();
+                connectEventStream();
                 fetch('/api/profile').then(res => res.json()).then(data => {
                     if (data.is_admin) {
                         document.getElementById('admin-btn').style.display = 'block';
@@ -149,6 +150,7 @@ function login(e) {
                 document.getElementById('login-modal').style.display = 'none';
                 showSection('home');
                 loadHome();
+                connectEventStream();
                 if (data.is_admin) {
                     document.getElementById('admin-btn').style.display = 'block';
                 }
@@ -882,6 +884,9 @@ function loadSearchTab(tab) {
 
 function loadNotifications() {
     showSection('notifications');
+    const badge = document.getElementById('notifications-btn');
+    badge.dataset.count = '0';
+    badge.classList.remove('has-unread');
     fetch('/api/notifications')
         .then(response => {
             if (!response.ok) throw new Error('Not logged in');
@@ -1039,7 +1044,50 @@ function adminDeleteContent(contentId, type) {
     }
 }
 
+let eventStream = null;
+
+function connectEventStream() {
+    if (eventStream) return;
+    // Messages and notifications are pushed by the server instead of polled
+    eventStream = new EventSource('/api/stream');
+    eventStream.addEventListener('notification', () => {
+        const badge = document.getElementById('notifications-btn');
+        badge.dataset.count = (parseInt(badge.dataset.count || '0') + 1).toString();
+        badge.classList.add('has-unread');
+    });
+    eventStream.addEventListener('unread', e => {
+        const data = JSON.parse(e.data);
+        const badge = document.getElementById('inbox-btn');
+        badge.dataset.count = data.messages;
+        badge.classList.toggle('has-unread', data.messages > 0);
+    });
+    eventStream.addEventListener('message', e => {
+        const msg = JSON.parse(e.data);
+        if (msg.group_id) {
+            const groupInput = document.getElementById('group-chat-input-text');
+            if (document.getElementById('group-chat-modal').style.display === 'block' &&
+                groupInput.dataset.groupId == msg.group_id) {
+                loadGroupChat(msg.group_id);
+            }
+        } else {
+            const chatInput = document.getElementById('chat-input-text');
+            if (document.getElementById('chat-modal').style.display === 'block' &&
+                chatInput.dataset.otherId == msg.sender_id) {
+                loadChat(msg.sender_id);
+            }
+        }
+    });
+}
+
+function disconnectEventStream() {
+    if (eventStream) {
+        eventStream.close();
+        eventStream = null;
+    }
+}
+
 function logout() {
+    disconnectEventStream();
     fetch('/api/logout', { method: 'POST' })
         .then(response => response.json())
         .then(data => {
@@ -0,0 +1,43 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as appmod  # noqa: E402
+
+def reset_worker_state():
+    """Forget everything a worker caches, so each test starts from an empty database."""
+    for cache in (appmod.unread_cache, appmod.user_stats_cache, appmod.viewer_state_cache,
+                  appmod.following_cache, appmod.social_graph._cache, appmod.group_membership._cache):
+        cache.clear()
+    appmod._object_cache_pid = None
+    appmod._suggest_index_pid = None
+
+@pytest.fixture
+def app(tmp_path):
+    flask_app = appmod.app
+    saved = dict(flask_app.config)
+    flask_app.config.update(
+        DATABASE=str(tmp_path / 'test.db'), TESTING=True, LIKE_WRITE_BEHIND=False
+    )
+    reset_worker_state()
+    appmod.init_db()
+    yield flask_app
+    appmod.get_notification_pipeline().flush()
+    appmod.get_pool().close()
+    flask_app.config.clear()
+    flask_app.config.update(saved)
+    reset_worker_state()
+
+@pytest.fixture
+def login(app):
+    """Register and log in a user; returns (client, user_id)."""
+    def login(username):
+        client = app.test_client()
+        client.post('/register', data={'username': username, 'password': 'secret1!', 'real_name': username.title()})
+        response = client.post('/login', data={'username': username, 'password': 'secret1!'})
+        assert response.status_code == 200
+        with client.session_transaction() as session:
+            return client, session['user_id']
+    return login
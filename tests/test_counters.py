@@ -0,0 +1,83 @@
+"""Unread counters stay equal to what the base tables say.
+
+A seeded random mix of messages, reads, likes, comments, follows and
+notification reads runs through the routes; after every few steps each
+user's badge counts (cached and stored) and per-conversation unread counts
+are compared with COUNT(*) over notifications and messages.
+"""
+import random
+
+import pytest
+
+import app as appmod
+
+def expected_counts(db, user_id):
+    notifications = db.execute(
+        'SELECT COUNT(*) FROM notifications WHERE user_id = ? AND is_read = FALSE', (user_id,)
+    ).fetchone()[0]
+    messages = db.execute(
+        'SELECT COUNT(*) FROM messages WHERE receiver_id = ? AND is_read = FALSE', (user_id,)
+    ).fetchone()[0]
+    return notifications, messages
+
+def check_counters(app, clients):
+    appmod.get_notification_pipeline().flush()
+    with app.app_context():
+        db = appmod.get_db()
+        for user_id, client in clients.items():
+            notifications, messages = expected_counts(db, user_id)
+            stored = db.execute(
+                'SELECT unread_notifications, unread_messages FROM users WHERE id = ?', (user_id,)
+            ).fetchone()
+            assert tuple(stored) == (notifications, messages)
+            assert client.get('/api/notifications/count').json == {'count': notifications, 'messages': messages}
+        
+        mismatched = db.execute(
+            '''SELECT c.user_id, c.peer_id, c.unread_count, (
+                   SELECT COUNT(*) FROM messages m
+                   WHERE m.sender_id = c.peer_id AND m.receiver_id = c.user_id AND m.is_read = FALSE
+               ) as actual
+               FROM conversations c WHERE c.peer_id IS NOT NULL'''
+        ).fetchall()
+        assert [tuple(row) for row in mismatched if row['unread_count'] != row['actual']] == []
+        
+        for user_id, client in clients.items():
+            for conversation in client.get('/api/messages').json:
+                assert conversation['unread_count'] == db.execute(
+                    'SELECT COUNT(*) FROM messages WHERE sender_id = ? AND receiver_id = ? AND is_read = FALSE',
+                    (conversation['user_id'], user_id)
+                ).fetchone()[0]
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_unread_counters_match_base_tables(app, login, seed):
+    rng = random.Random(seed)
+    users = [login(f'user{i}') for i in range(4)]
+    clients = {user_id: client for client, user_id in users}
+    user_ids = sorted(clients)
+    for client, _ in users:
+        client.post('/api/posts/create', data={'description': 'hello'})
+    with app.app_context():
+        post_ids = [row[0] for row in appmod.get_db().execute('SELECT id FROM posts')]
+    
+    for step in range(120):
+        user_id = rng.choice(user_ids)
+        other = rng.choice([peer for peer in user_ids if peer != user_id])
+        client = clients[user_id]
+        action = rng.choice(['message', 'message', 'open', 'like', 'comment', 'follow', 'notifications', 'inbox'])
+        if action == 'message':
+            client.post('/api/messages/send', data={'receiver_id': other, 'content': f'm{step}'})
+        elif action == 'open':
+            client.get('/api/messages', query_string={'user_id': other})
+        elif action == 'like':
+            client.post(f'/api/posts/{rng.choice(post_ids)}/like')
+        elif action == 'comment':
+            client.post(f'/api/posts/{rng.choice(post_ids)}/comment', data={'content': 'nice'})
+        elif action == 'follow':
+            client.post('/api/friends/follow', data={'user_id': other})
+        elif action == 'notifications':
+            client.get('/api/notifications')
+        else:
+            client.get('/api/messages')
+        if step % 10 == 9:
+            check_counters(app, clients)
+    check_counters(app, clients)
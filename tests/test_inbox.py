@@ -0,0 +1,41 @@
+"""The inbox pages through direct and group conversations by last activity."""
+import app as appmod
+
+def inbox_pages(client, limit):
+    pages, cursor = [], ''
+    while cursor is not None:
+        page = client.get('/api/messages', query_string={'cursor': cursor, 'limit': limit}).json
+        pages.append(page['items'])
+        cursor = page['next_cursor']
+    return pages
+
+def test_inbox_pages_cover_every_conversation_once(app, login):
+    alice, alice_id = login('alice')
+    peers = [login(f'peer{i}') for i in range(4)]
+    for client, _ in peers:
+        client.post('/api/messages/send', data={'receiver_id': alice_id, 'content': 'hi'})
+    group_id = alice.post('/api/groups/create', data={'name': 'club'}).json['group_id']
+    alice.post('/api/messages/send', data={'group_id': group_id, 'content': 'welcome'})
+    
+    pages = inbox_pages(alice, 2)
+    
+    assert [len(page) for page in pages] == [2, 2, 1]
+    entries = [(entry['user_id'], entry['group_id']) for page in pages for entry in page]
+    assert sorted(entries, key=str) == sorted([(peer_id, None) for _, peer_id in peers] + [(None, group_id)], key=str)
+    assert alice.get('/api/messages').json == [entry for page in inbox_pages(alice, 50) for entry in page]
+
+def test_group_message_moves_the_group_up_for_every_member(app, login):
+    alice, alice_id = login('alice')
+    bob, bob_id = login('bob')
+    group_id = alice.post('/api/groups/create', data={'name': 'club'}).json['group_id']
+    bob.post(f'/api/groups/{group_id}/join')
+    alice.post('/api/messages/send', data={'receiver_id': bob_id, 'content': 'direct'})
+    with app.app_context():
+        db = appmod.get_db()
+        db.execute("UPDATE conversations SET last_activity = '2000-01-01 00:00:00'")
+        db.commit()
+    
+    alice.post('/api/messages/send', data={'group_id': group_id, 'content': 'to the group'})
+    
+    first = bob.get('/api/messages', query_string={'cursor': ''}).json['items'][0]
+    assert (first['group_id'], first['last_message_preview'], first['unread_count']) == (group_id, 'to the group', 1)
@@ -0,0 +1,41 @@
+"""Page and cursor arguments of the paginated feeds."""
+import app as appmod
+
+def test_pages_below_one_read_the_first_page(app, login):
+    alice, _ = login('alice')
+    for i in range(3):
+        alice.post('/api/posts/create', data={'description': f'post {i}'})
+    first = alice.get('/api/posts', query_string={'page': 1, 'limit': 2}).json
+    
+    for page in (0, -1, -50):
+        assert alice.get('/api/posts', query_string={'page': page, 'limit': 2}).json == first
+        response = alice.get('/api/reels', query_string={'page': page})
+        assert response.status_code == 200 and response.json == []
+
+def test_invalid_cursor_is_rejected(app, login):
+    alice, _ = login('alice')
+    
+    for url in ('/api/posts', '/api/reels', '/api/notifications', '/api/messages'):
+        response = alice.get(url, query_string={'cursor': 'not a cursor'})
+        assert response.status_code == 400, url
+
+def test_join_requests_page_past_requests_without_a_user_card(app, login):
+    owner, _ = login('owner')
+    group_id = owner.post('/api/groups/create', data={'name': 'club'}).json['group_id']
+    applicants = [login(name)[1] for name in ('ann', 'ben', 'cal')]
+    with app.app_context():
+        db = appmod.get_db()
+        # The newest request's user has no card, so the first page hydrates to nothing
+        db.executemany(
+            'INSERT INTO group_join_requests (group_id, user_id) VALUES (?, ?)',
+            [(group_id, user_id) for user_id in applicants + [9999]]
+        )
+        db.commit()
+    
+    seen, cursor = [], ''
+    while cursor is not None:
+        page = owner.get(f'/api/groups/{group_id}/requests', query_string={'cursor': cursor, 'limit': 1}).json
+        seen += [item['user_id'] for item in page['items']]
+        cursor = page['next_cursor']
+    
+    assert sorted(seen) == sorted(applicants)
@@ -0,0 +1,205 @@
+"""PostgresConnection and the connection pool against a psycopg2 stand-in.
+
+The stand-in runs statements on SQLite after undoing the %s translation,
+so the adapter's own behaviour (placeholders, transactions, commit hooks,
+pool hand-off) is checked without a server. Set SOCIAFAM_TEST_POSTGRES_URL
+to also run a smoke test against a real PostgreSQL database.
+"""
+import os
+import re
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+
+import app as appmod
+
+TRANSACTION_STATUS_IDLE = 0
+TRANSACTION_STATUS_INTRANS = 2
+
+class StandInCursor:
+    def __init__(self, conn):
+        self._conn = conn
+        self._cursor = conn.sqlite.cursor()
+    
+    def _sql(self, sql):
+        self._conn.statements.append(sql)
+        # SQLite accepts an empty IN list; PostgreSQL does not
+        if re.search(r'\bIN\s*\(\s*\)', sql):
+            raise SyntaxError(f'syntax error at or near ")": {sql}')
+        return sql.replace('%s', '?').replace('%%', '%')
+    
+    def execute(self, sql, params=()):
+        self._cursor.execute(self._sql(sql), params)
+    
+    def executemany(self, sql, seq_of_params):
+        self._cursor.executemany(self._sql(sql), seq_of_params)
+    
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+    
+    def fetchone(self):
+        return self._cursor.fetchone()
+    
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+class StandInConnection:
+    def __init__(self, path):
+        self.sqlite = sqlite3.connect(path, check_same_thread=False)
+        self.sqlite.row_factory = sqlite3.Row
+        self.statements = []
+        self.autocommit = False
+        self.closed = False
+        self.fail_commit = False
+    
+    @property
+    def info(self):
+        status = TRANSACTION_STATUS_INTRANS if self.sqlite.in_transaction else TRANSACTION_STATUS_IDLE
+        return SimpleNamespace(transaction_status=status)
+    
+    def cursor(self, cursor_factory=None):
+        return StandInCursor(self)
+    
+    def commit(self):
+        if self.fail_commit:
+            raise RuntimeError('could not serialize access')
+        self.sqlite.commit()
+    
+    def rollback(self):
+        self.sqlite.rollback()
+    
+    def close(self):
+        self.closed = True
+        self.sqlite.close()
+
+def install_standin(monkeypatch, path, dsn):
+    """Route app's psycopg2 connections for dsn to the SQLite file at path."""
+    connections = []
+    def connect(dsn):
+        conn = StandInConnection(path)
+        connections.append(conn)
+        return conn
+    
+    module = SimpleNamespace(
+        connect=connect, connections=connections,
+        extras=SimpleNamespace(DictCursor=object),
+        extensions=SimpleNamespace(TRANSACTION_STATUS_IDLE=TRANSACTION_STATUS_IDLE)
+    )
+    monkeypatch.setattr(appmod, 'psycopg2', module)
+    monkeypatch.setitem(appmod.app.config, 'DATABASE', dsn)
+    return module
+
+@pytest.fixture
+def psycopg2(monkeypatch, tmp_path):
+    path = str(tmp_path / 'standin.db')
+    setup = sqlite3.connect(path)
+    setup.execute('CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT NOT NULL)')
+    setup.close()
+    yield install_standin(monkeypatch, path, f'postgresql://stand-in/{tmp_path.name}')
+    appmod.get_pool().close()
+
+def test_placeholders_are_translated(psycopg2):
+    db = appmod.connect_db()
+    db.execute('INSERT INTO items (name) VALUES (?)', ('50% off?',))
+    db.executemany('INSERT INTO items (name) VALUES (?)', [('a',), ('b',)])
+    row = db.execute("SELECT COUNT(*), SUM(name LIKE '%?%') FROM items WHERE name != ?", ('x',)).fetchone()
+    
+    assert tuple(row) == (3, 1)
+    assert psycopg2.connections[0].statements[-1] == (
+        "SELECT COUNT(*), SUM(name LIKE '%%?%%') FROM items WHERE name != %s"
+    )
+
+def test_after_commit_runs_only_once_committed(psycopg2):
+    db = appmod.connect_db()
+    ran = []
+    
+    db.execute('INSERT INTO items (name) VALUES (?)', ('kept',))
+    db.after_commit(ran.append, 'first')
+    assert db.in_transaction and ran == []
+    db.commit()
+    assert ran == ['first'] and not db.in_transaction
+    
+    db.execute('INSERT INTO items (name) VALUES (?)', ('dropped',))
+    db.after_commit(ran.append, 'rolled back')
+    db.rollback()
+    db.commit()
+    assert ran == ['first']
+    
+    db.execute('INSERT INTO items (name) VALUES (?)', ('failed',))
+    db.after_commit(ran.append, 'failed commit')
+    psycopg2.connections[0].fail_commit = True
+    with pytest.raises(RuntimeError):
+        db.commit()
+    psycopg2.connections[0].fail_commit = False
+    db.rollback()
+    db.commit()
+    assert ran == ['first']
+
+def test_pool_rolls_back_unfinished_transactions(psycopg2):
+    with appmod.app.app_context():
+        db = appmod.get_db()
+        db.execute('INSERT INTO items (name) VALUES (?)', ('abandoned',))
+    
+    with appmod.app.app_context():
+        db = appmod.get_db()
+        assert not db.in_transaction
+        assert db.execute('SELECT COUNT(*) FROM items').fetchone()[0] == 0
+    assert len(psycopg2.connections) == 1
+
+def test_connection_returns_to_the_pool_it_came_from(psycopg2, monkeypatch):
+    monkeypatch.setitem(appmod.app.config, 'DB_POOL_SIZE', 2)
+    with appmod.app.app_context():
+        db = appmod.get_db()
+        old_pool = appmod.get_pool()
+        # The pool is rebuilt while the connection is still borrowed
+        appmod.app.config['DATABASE'] = 'postgresql://stand-in/other'
+        new_pool = appmod.get_pool()
+        assert new_pool is not old_pool and db.pool is old_pool
+    
+    # The old pool closed the connection instead of idling it, and the new
+    # pool's slots were left alone
+    assert psycopg2.connections[0].closed
+    borrowed = [new_pool.acquire() for _ in range(2)]
+    assert all(conn.pool is new_pool for conn in borrowed)
+    for conn in borrowed:
+        new_pool.release(conn)
+    with pytest.raises(ValueError):
+        new_pool.release(db)
+
+def test_notification_batch_filtered_to_nothing(app, login, monkeypatch, tmp_path):
+    alice, alice_id = login('alice')
+    bob, bob_id = login('bob')
+    carol, carol_id = login('carol')
+    alice.post('/api/settings/update', data={'notifications_enabled': 'false'})
+    install_standin(monkeypatch, app.config['DATABASE'], f'postgresql://stand-in/{tmp_path.name}')
+    pipeline = appmod.NotificationPipeline(interval=60, batch_size=100)
+    
+    # Every recipient in the batch has notifications turned off
+    pipeline.enqueue(alice_id, 'follow', bob_id)
+    pipeline.enqueue(alice_id, 'like', carol_id, 'post', 1)
+    pipeline.flush()
+    
+    # A batch with a recipient left still writes through the adapter
+    pipeline.enqueue(bob_id, 'follow', carol_id)
+    pipeline.flush()
+    
+    assert pipeline._pending == {}
+    with app.app_context():
+        rows = appmod.get_db().execute('SELECT user_id, type FROM notifications').fetchall()
+    assert [tuple(row) for row in rows] == [(bob_id, 'follow')]
+    appmod.get_pool().close()
+
+@pytest.mark.skipif(not os.environ.get('SOCIAFAM_TEST_POSTGRES_URL'), reason='SOCIAFAM_TEST_POSTGRES_URL is not set')
+def test_real_postgres_smoke(monkeypatch, login):
+    if appmod.psycopg2 is None:
+        pytest.skip('psycopg2 is not installed')
+    monkeypatch.setitem(appmod.app.config, 'DATABASE', os.environ['SOCIAFAM_TEST_POSTGRES_URL'])
+    appmod.init_db()
+    
+    alice, alice_id = login('pg_alice')
+    bob, _ = login('pg_bob')
+    bob.post('/api/friends/follow', data={'user_id': alice_id})
+    alice.post('/api/posts/create', data={'description': 'hello from postgres'})
+    assert [post['description'] for post in bob.get('/api/posts').json][:1] == ['hello from postgres']
@@ -0,0 +1,15 @@
+"""EXPLAIN QUERY PLAN regression test for the hot routes' statements."""
+import app as appmod
+
+def test_hot_queries_use_indexes(app):
+    with app.app_context():
+        assert appmod.find_table_scans(appmod.get_db()) == {}
+
+def test_hot_queries_share_the_routes_sql():
+    statements = [sql for sql, _ in appmod.HOT_QUERIES.values()]
+    for template in (appmod.FEED_TIMELINE_SQL, appmod.FEED_PULLED_POSTS_SQL, appmod.FEED_PULLED_REPOSTS_SQL,
+                     appmod.POST_COMMENTS_SQL, appmod.NOTIFICATIONS_SQL, appmod.SEARCH_USERS_SQL,
+                     appmod.SEARCH_GROUPS_SQL, appmod.SEARCH_POSTS_SQL, appmod.INBOX_SQL):
+        head = template.split('{')[0]
+        assert any(sql.startswith(head) for sql in statements), head
+    assert appmod.PROFILE_USER_SQL in statements
@@ -0,0 +1,35 @@
+"""The in-memory suggestion index tracks follower counts like user_stats does."""
+import app as appmod
+
+def followers(app, user_id):
+    with app.app_context():
+        db = appmod.get_db()
+        stored = db.execute('SELECT followers_count FROM user_stats WHERE user_id = ?', (user_id,)).fetchone()
+        indexed = appmod.get_suggest_index(db)._users[user_id]['followers']
+    return (stored[0] if stored else 0), indexed
+
+def test_follower_counts_follow_accepts_rejects_and_unfollows(app, login):
+    alice, alice_id = login('alice')
+    bob, bob_id = login('bob')
+    carol, carol_id = login('carol')
+    alice.post('/api/settings/update', data={'profile_locked': 'true'})
+    bob.post('/api/friends/follow', data={'user_id': alice_id})
+    
+    for _ in range(3):
+        alice.post('/api/friends/requests/respond', data={'follower_id': bob_id, 'action': 'accept'})
+    alice.post('/api/friends/requests/respond', data={'follower_id': carol_id, 'action': 'accept'})
+    assert followers(app, alice_id) == (1, 1)
+    
+    alice.post('/api/friends/requests/respond', data={'follower_id': bob_id, 'action': 'reject'})
+    alice.post('/api/friends/requests/respond', data={'follower_id': bob_id, 'action': 'reject'})
+    assert followers(app, alice_id) == (0, 0)
+    
+    carol.post('/api/friends/follow', data={'user_id': bob_id})
+    carol.post('/api/friends/follow', data={'user_id': bob_id})
+    carol.post('/api/friends/follow', data={'user_id': bob_id})
+    assert followers(app, bob_id) == (1, 1)
+    
+    # A pending request that is rejected was never counted
+    bob.post('/api/friends/follow', data={'user_id': alice_id})
+    alice.post('/api/friends/requests/respond', data={'follower_id': bob_id, 'action': 'reject'})
+    assert followers(app, alice_id) == (0, 0)
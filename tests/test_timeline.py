@@ -0,0 +1,49 @@
+"""Home timeline materialization through the follow and request routes."""
+import app as appmod
+
+def timeline_rows(app):
+    with app.app_context():
+        return [tuple(row) for row in appmod.get_db().execute(
+            'SELECT user_id, post_id, actor_id FROM timeline ORDER BY user_id, post_id'
+        )]
+
+def test_accepting_a_missing_request_leaves_the_timeline_alone(app, login):
+    alice, alice_id = login('alice')
+    bob, bob_id = login('bob')
+    alice.post('/api/posts/create', data={'description': 'not for bob'})
+    before = timeline_rows(app)
+    
+    response = alice.post('/api/friends/requests/respond', data={'follower_id': bob_id, 'action': 'accept'})
+    
+    assert response.status_code == 200
+    assert timeline_rows(app) == before
+    assert [post['description'] for post in bob.get('/api/posts').json] == []
+
+def test_accepting_a_request_backfills_once(app, login):
+    alice, alice_id = login('alice')
+    bob, bob_id = login('bob')
+    alice.post('/api/settings/update', data={'profile_locked': 'true'})
+    alice.post('/api/posts/create', data={'description': 'locked post'})
+    bob.post('/api/friends/follow', data={'user_id': alice_id})
+    assert bob.get('/api/posts').json == []
+    
+    alice.post('/api/friends/requests/respond', data={'follower_id': bob_id, 'action': 'accept'})
+    
+    assert [post['description'] for post in bob.get('/api/posts').json] == ['locked post']
+
+def test_unfollow_keeps_posts_another_followed_account_reposted(app, login):
+    alice, _ = login('alice')
+    bob, _ = login('bob')
+    carol, carol_id = login('carol')
+    dave, dave_id = login('dave')
+    alice.post('/api/posts/create', data={'description': 'shared twice'})
+    bob.post('/api/friends/follow', data={'user_id': carol_id})
+    bob.post('/api/friends/follow', data={'user_id': dave_id})
+    with app.app_context():
+        post_id = appmod.get_db().execute('SELECT id FROM posts').fetchone()[0]
+    carol.post(f'/api/posts/{post_id}/repost')
+    dave.post(f'/api/posts/{post_id}/repost')
+    
+    bob.post('/api/friends/follow', data={'user_id': carol_id})
+    
+    assert [post['description'] for post in bob.get('/api/posts').json] == ['shared twice']